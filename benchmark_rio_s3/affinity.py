@@ -0,0 +1,237 @@
+""" Pin worker threads and processes to CPUs
+
+On large multi-socket machines worker threads migrating across cores and NUMA
+nodes add noise to throughput. Placement policies decide which CPUs every
+worker thread may run on:
+
+none    -- leave it to the OS scheduler
+compact -- one CPU per thread, filling hyper-thread siblings, cores and then
+           NUMA nodes in order, i.e. as few cores and nodes as possible
+spread  -- one CPU per thread, round-robin across NUMA nodes and physical
+           cores, hyper-thread siblings are only used once every core has a thread
+numa    -- threads are assigned round-robin to NUMA nodes and may run on any
+           CPU of their node
+
+Only CPUs the process is allowed to run on are used, so a whole process can be
+restricted first (`pin_process`, like `taskset -a`), with thread placement inside
+that set. Uses `os.sched_setaffinity`, which is Linux only, topology comes from
+`/sys/devices/system`, machines without it look like a single NUMA node with
+one CPU per core.
+"""
+import glob
+import os
+import re
+
+__all__ = ['POLICIES', 'placement', 'pin_process', 'parse_cpulist', 'format_cpulist']
+
+POLICIES = ('none', 'compact', 'spread', 'numa')
+
+_SYS = '/sys/devices/system'
+
+
+def parse_cpulist(s):
+    """ "0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11]
+    """
+    cpus = []
+    for part in s.strip().split(','):
+        if not part:
+            continue
+        a, _, b = part.partition('-')
+        cpus.extend(range(int(a), int(b or a) + 1))
+    return cpus
+
+
+def format_cpulist(cpus):
+    """ [0, 1, 2, 3, 8] -> "0-3,8"
+    """
+    cpus = sorted(cpus)
+    parts = []
+    start = prev = None
+    for c in cpus + [None]:
+        if prev is not None and c == prev + 1:
+            prev = c
+            continue
+        if start is not None:
+            parts.append(str(start) if start == prev else '{}-{}'.format(start, prev))
+        start = prev = c
+    return ','.join(parts)
+
+
+def allowed_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def _read_int(fname, default):
+    try:
+        with open(fname, 'rt') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return default
+
+
+def read_topology(cpus=None, sys_dir=_SYS):
+    """ cpu -> (numa node, socket, core) for every allowed CPU
+    """
+    if cpus is None:
+        cpus = allowed_cpus()
+
+    node_of = {}
+    for fname in glob.glob(os.path.join(sys_dir, 'node', 'node*', 'cpulist')):
+        node = int(re.search(r'node(\d+)', fname).group(1))
+        with open(fname, 'rt') as f:
+            for c in parse_cpulist(f.read()):
+                node_of[c] = node
+
+    topo = {}
+    for c in cpus:
+        base = os.path.join(sys_dir, 'cpu', 'cpu{:d}'.format(c), 'topology')
+        topo[c] = (node_of.get(c, 0),
+                   _read_int(os.path.join(base, 'physical_package_id'), 0),
+                   _read_int(os.path.join(base, 'core_id'), c))
+    return topo
+
+
+def numa_nodes(topology):
+    """ NUMA node -> sorted list of CPUs
+    """
+    nodes = {}
+    for c, (node, _, _) in sorted(topology.items()):
+        nodes.setdefault(node, []).append(c)
+    return nodes
+
+
+def cpu_order(policy, topology):
+    """ Order in which CPUs are handed out to threads under 'compact' or 'spread' policy
+    """
+    if policy == 'compact':
+        return sorted(topology, key=lambda c: (topology[c], c))
+
+    if policy == 'spread':
+        per_node = []
+        for node, cpus in sorted(numa_nodes(topology).items()):
+            # first CPU of every core, then the second hyper-thread of every core, ...
+            seen = {}
+            ranked = []
+            for c in sorted(cpus, key=lambda c: (topology[c], c)):
+                core = topology[c][1:]
+                ranked.append((seen.get(core, 0), topology[c][1:], c))
+                seen[core] = seen.get(core, 0) + 1
+            per_node.append([c for *_, c in sorted(ranked)])
+
+        order = []
+        for i in range(max(len(cc) for cc in per_node)):
+            order.extend(cc[i] for cc in per_node if i < len(cc))
+        return order
+
+    raise ValueError('No CPU order for policy: {}'.format(policy))
+
+
+def placement(policy, nthreads, topology=None):
+    """ CPU set for every worker thread, None for 'none' policy
+
+    More threads than CPUs wrap around, i.e. several threads share a CPU.
+    """
+    if policy in (None, 'none'):
+        return None
+    if policy not in POLICIES:
+        raise ValueError('Unknown placement policy: {}, only know: {}'.format(policy, ','.join(POLICIES)))
+
+    if topology is None:
+        topology = read_topology()
+
+    if policy == 'numa':
+        nodes = [cpus for _, cpus in sorted(numa_nodes(topology).items())]
+        return [set(nodes[i % len(nodes)]) for i in range(nthreads)]
+
+    order = cpu_order(policy, topology)
+    return [{order[i % len(order)]} for i in range(nthreads)]
+
+
+def pin_thread(cpus):
+    """ Restrict calling thread to `cpus`, returns CPUs it is allowed to run on afterwards
+    """
+    os.sched_setaffinity(0, cpus)
+    return sorted(os.sched_getaffinity(0))
+
+
+def _thread_ids(task_dir='/proc/self/task'):
+    try:
+        return [int(tid) for tid in os.listdir(task_dir)]
+    except OSError:
+        return [0]
+
+
+def pin_process(cpus):
+    """ Restrict every thread of the calling process to `cpus` (list or "0-3,8" string)
+
+    Threads already running (GDAL, HTTP server, telemetry sampler) are pinned
+    via `/proc/self/task`, threads started afterwards inherit the affinity of
+    the thread that starts them. Without `/proc` only the calling thread is
+    pinned. Returns CPUs the calling thread is allowed to run on afterwards.
+    """
+    if isinstance(cpus, str):
+        cpus = parse_cpulist(cpus)
+    for tid in _thread_ids():
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except ProcessLookupError:
+            pass  # thread exited in the meantime
+    return pin_thread(cpus)
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_cpulist():
+    assert parse_cpulist('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+    assert format_cpulist([11, 0, 1, 2, 3, 8, 10]) == '0-3,8,10-11'
+    assert format_cpulist([5]) == '5'
+
+
+def test_placement():
+    import pytest
+
+    # 2 nodes x 2 cores x 2 hyper-threads, siblings numbered like Linux does: cpu, cpu + 4
+    topo = {c: (n, n, core) for n in (0, 1) for core in (0, 1) for c in (n*2 + core, n*2 + core + 4)}
+    assert numa_nodes(topo) == {0: [0, 1, 4, 5], 1: [2, 3, 6, 7]}
+
+    assert placement('none', 4, topo) is None
+    assert placement('compact', 4, topo) == [{0}, {4}, {1}, {5}]
+    assert placement('spread', 4, topo) == [{0}, {2}, {1}, {3}]
+    assert placement('spread', 10, topo)[4:] == [{4}, {6}, {5}, {7}, {0}, {2}]
+    assert placement('numa', 3, topo) == [{0, 1, 4, 5}, {2, 3, 6, 7}, {0, 1, 4, 5}]
+
+    with pytest.raises(ValueError):
+        placement('bogus', 1, topo)
+
+    # real machine: whatever it is, every thread gets some allowed CPU
+    allowed = set(allowed_cpus())
+    for policy in POLICIES[1:]:
+        assert all(cc and cc <= allowed for cc in placement(policy, 3))
+
+
+def test_pin_process():
+    import threading
+
+    allowed = allowed_cpus()
+    go = threading.Event()
+    seen = []
+
+    def other():
+        go.wait()
+        seen.append(sorted(os.sched_getaffinity(0)))
+
+    th = threading.Thread(target=other)
+    th.start()
+    try:
+        assert pin_process(allowed[:1]) == allowed[:1]
+    finally:
+        go.set()
+        th.join()
+        pin_process(allowed)
+
+    assert seen == [allowed[:1]]
+    assert allowed_cpus() == allowed
@@ -1,6 +1,11 @@
 import sys
 import click
 from .bench import slurp_lines
+from .warmup import DEFAULT_STATE, DEFAULT_TTL
+from .ordering import STRATEGIES
+from .affinity import POLICIES as AFFINITY_POLICIES, parse_cpulist, format_cpulist
+from .history import DEFAULT_DB, KEYS as HISTORY_KEYS
+from .netcheck import NETCHECK_FILE
 
 
 def parse_shape(s):
@@ -25,6 +30,41 @@ def parse_tuple(s, expect_n=None, error_msg='Wrong length'):
     return tt
 
 
+def parse_orders(s):
+    oo = tuple(s.split(','))
+    if not all(o in STRATEGIES for o in oo):
+        raise ValueError('Unknown ordering')
+    return oo
+
+
+def parse_affinities(s):
+    aa = tuple(s.split(','))
+    if not all(a in AFFINITY_POLICIES for a in aa):
+        raise ValueError('Unknown placement policy')
+    return aa
+
+
+def parse_cpus(s):
+    """ "0-3,8" -> "0-3,8", checks it is a valid CPU list
+    """
+    cpus = parse_cpulist(s)
+    if not cpus:
+        raise ValueError('Empty CPU list')
+    return format_cpulist(cpus)
+
+
+def parse_gdal_opt(s, many=False):
+    """ "KEY=VALUE" -> (KEY, VALUE), or "KEY=V1,V2" -> (KEY, [V1, V2]) when many=True
+    """
+    k, sep, v = s.partition('=')
+    k = k.strip().upper()
+    if sep == '' or k == '' or v == '':
+        raise ValueError('Expect KEY=VALUE')
+    if many:
+        return k, v.split(',')
+    return k, v
+
+
 def make_click_parser(func, error_msg):
     def parse(ctx, param, value):
         if value is None:
@@ -37,14 +77,35 @@ def make_click_parser(func, error_msg):
 
 
 click_parse_tuple = make_click_parser(parse_tuple, 'Expect comma separated list of integers')
+click_parse_floats = make_click_parser(lambda s: tuple(float(v) for v in s.split(',')),
+                                       'Expect comma separated list of numbers')
 click_parse_rc = make_click_parser(lambda s: parse_tuple(s, 2), 'Expect row,col')
 click_parse_shape = make_click_parser(parse_shape, 'Expect WxH')
+click_parse_orders = make_click_parser(parse_orders, 'Expect comma separated list of: ' + ','.join(STRATEGIES))
+click_parse_affinities = make_click_parser(parse_affinities,
+                                           'Expect comma separated list of: ' + ','.join(AFFINITY_POLICIES))
+click_parse_cpulist = make_click_parser(parse_cpus, 'Expect CPU list like 0-3,8')
+
+
+def click_parse_gdal_opts(many=False):
+    def parse(ctx, param, value):
+        try:
+            return tuple(parse_gdal_opt(v, many=many) for v in value)
+        except ValueError:
+            raise click.BadParameter('Expect KEY=VALUE{}'.format('[,VALUE..]' if many else ''))
+    return parse
+
 
 cli = click.Group(name='bench-rio-s3', help="Bunch of tools for benchmarking rasterio performance in the cloud")
 
 
 @cli.command(name='run-one')
 @click.option('--prefix', type=str, default='rio', help='Prefix for results file')
+@click.option('--mode', type=click.Choice(['rio', 'windows', 'http']), default='rio',
+              help=('rio: per tile callback (default), windows: `ParallelReader.read_windows` API, '
+                    'http: python range requests, no GDAL'))
+@click.option('--endpoint-url', type=str, default=None,
+              help='Send s3:// requests to this endpoint instead of AWS, e.g. http://localhost:9000')
 @click.option('--block', callback=click_parse_rc,
               default='7,7',
               help='Block to read, default: "7,7"')
@@ -65,12 +126,108 @@ cli = click.Group(name='bench-rio-s3', help="Bunch of tools for benchmarking ras
 @click.option('--aws-unsigned',
               is_flag=True, default=False,
               help='Do not sign S3 requests, only works on public buckets')
+@click.option('--profile',
+              is_flag=True, default=False,
+              help='Sample worker thread stacks during the run, saves .folded file for flamegraphs')
+@click.option('--profile-rate', type=int, default=100,
+              help='Stack sampling rate in Hz, default: 100')
+@click.option('--retries', type=int, default=0,
+              help='How many times to retry failed reads (throttling, timeouts), default: 0')
+@click.option('--retry-backoff', type=float, default=0.1,
+              help='Delay before first retry in seconds, doubles with every retry, default: 0.1')
+@click.option('--rate', type=float, default=None,
+              help='Open loop mode: start reads at this many per second instead of as fast as possible')
+@click.option('--arrival', type=click.Choice(['constant', 'poisson']), default='constant',
+              help='Open loop mode: arrival process, default: constant')
+@click.option('--max-inflight', type=int, default=None,
+              help='Open loop mode: limit on queued plus running reads, default: 2x threads')
+@click.option('--gdal-opt', 'gdal_opts', multiple=True,
+              callback=click_parse_gdal_opts(),
+              help='Extra GDAL config option KEY=VALUE, can be repeated, overrides defaults')
+@click.option('--run-id', type=str, default=None,
+              help='Identifier to record in results, used by `run` to track completed runs')
+@click.option('--scenes', is_flag=True, default=False,
+              help=('Group urls named <scene>_B<band>.TIF into scenes and read the block from all bands '
+                    'of a scene together, with --rate this is scenes per second'))
+@click.option('--bands', type=str, default=None,
+              help='Scene mode: comma-separated list of bands to read, default: most common set of bands')
+@click.option('--live', is_flag=True, default=False,
+              help='Print progress line once a second: throughput, queue depth, reads in flight, errors, memory')
+@click.option('--metrics-port', type=int, default=None,
+              help='Serve the same live numbers in Prometheus format on http://127.0.0.1:<port>/metrics')
+@click.option('--trace', is_flag=True, default=False,
+              help='Record access trace and the bytes read into a .trace file, see `replay` command')
+@click.option('--order', type=click.Choice(STRATEGIES), default='as-is',
+              help=('Order in which urls are read: as-is (default), shuffle, interleave (round-robin '
+                    'across key prefixes) or size (largest first, needs --sizes)'))
+@click.option('--order-seed', type=int, default=0,
+              help='Random seed for shuffle order, default: 0')
+@click.option('--sizes', 'sizes_file', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='File with url and size in bytes on every line, used by size order')
+@click.option('--vsi-cache-size', type=int, default=None,
+              help='VSI cache size per open file in bytes (VSI_CACHE_SIZE), every thread has one file open')
+@click.option('--gdal-cachemax', type=int, default=None,
+              help='GDAL block cache size shared by all threads (GDAL_CACHEMAX), MiB if < 100000 else bytes')
+@click.option('--overview-level', type=int, default=None,
+              help='Read from this overview, 0 is the largest, --block and --block-shape refer to its tiling')
+@click.option('--out-shape', default=None,
+              callback=click_parse_shape,
+              help='Decimate every block to WxH pixels (nearest neighbour), default: block shape')
+@click.option('--tile-cache', type=click.Path(file_okay=False), default=None,
+              help='Keep decoded tiles in this directory and serve repeated reads from there')
+@click.option('--tile-cache-size', type=int, default=1024,
+              help='Tile cache budget in MiB, least recently used tiles are evicted, default: 1024')
+@click.option('--cache-pass', type=click.Choice(['cold', 'warm']), default=None,
+              help='cold: clear tile cache before the run, warm: read every file once before the run')
+@click.option('--etags', 'etags_file', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='File with url and etag on every line, default etag is mtime and size for local files')
+@click.option('--mem-cache', type=int, default=None,
+              help=('Keep decoded tiles in memory shared by all threads, budget in MiB, '
+                    'concurrent reads of the same tile wait for one fetch'))
+@click.option('--netcheck', 'netcheck_file', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Network ceilings saved by `netcheck`, report shows throughput as a fraction of them')
+@click.option('--affinity', type=click.Choice(AFFINITY_POLICIES), default='none',
+              help=('Pin worker threads, compact: one CPU each, fewest cores and NUMA nodes, '
+                    'spread: one CPU each, across NUMA nodes and cores, '
+                    'numa: any CPU of one NUMA node, round-robin, default: none'))
+@click.option('--cpus', type=str, default=None,
+              callback=click_parse_cpulist,
+              help='Run on these CPUs only, e.g. 0-15,32-47, threads are placed within them')
 @click.argument('url_file')
-def run(prefix, block, dtype, block_shape,
+def run(prefix, mode, endpoint_url, block, dtype, block_shape,
         warmup_more, save_pixel_data,
         threads,
         header_size,
         aws_unsigned,
+        profile,
+        profile_rate,
+        retries,
+        retry_backoff,
+        rate,
+        arrival,
+        max_inflight,
+        gdal_opts,
+        run_id,
+        scenes,
+        bands,
+        live,
+        metrics_port,
+        trace,
+        order,
+        order_seed,
+        sizes_file,
+        vsi_cache_size,
+        gdal_cachemax,
+        overview_level,
+        out_shape,
+        tile_cache,
+        tile_cache_size,
+        cache_pass,
+        etags_file,
+        mem_cache,
+        netcheck_file,
+        affinity,
+        cpus,
         url_file):
     """Run individual benchmark.
 
@@ -99,6 +256,10 @@ def run(prefix, block, dtype, block_shape,
     You can use `bench-rio-s3 ls s3://mybucket/path/` to generated this file
     """
     from .bench import run_main
+    from .pprio import RetryPolicy
+
+    if cache_pass is not None and (tile_cache is None or mem_cache):
+        raise click.UsageError('--cache-pass needs --tile-cache and does not apply to --mem-cache')
 
     if header_size is not None and header_size > 0:
         bytes_at_open = header_size*1024
@@ -107,14 +268,42 @@ def run(prefix, block, dtype, block_shape,
 
     run_main(url_file, threads,
              prefix=prefix,
-             mode='rio',
+             mode=mode,
              wmore=warmup_more,
              block=block,
              block_shape=block_shape,
              dtype=dtype,
              npz=save_pixel_data,
              bytes_at_open=bytes_at_open,
-             aws_unsigned=aws_unsigned)
+             aws_unsigned=aws_unsigned,
+             profile=profile_rate if profile else None,
+             retry=RetryPolicy(max_attempts=retries + 1, backoff=retry_backoff),
+             rate=rate,
+             arrival=arrival,
+             max_inflight=max_inflight,
+             gdal_opts=dict(gdal_opts),
+             run_id=run_id,
+             live=live,
+             metrics_port=metrics_port,
+             scenes=scenes,
+             bands=bands.split(',') if bands else None,
+             endpoint_url=endpoint_url,
+             trace=trace,
+             order=order,
+             order_seed=order_seed,
+             sizes_file=sizes_file,
+             vsi_cache_size=vsi_cache_size,
+             gdal_cachemax=gdal_cachemax,
+             overview_level=overview_level,
+             out_shape=out_shape,
+             tile_cache=tile_cache,
+             tile_cache_size=tile_cache_size << 20,
+             cache_pass=cache_pass,
+             etags_file=etags_file,
+             mem_cache_size=mem_cache << 20 if mem_cache else None,
+             netcheck=netcheck_file,
+             affinity=None if affinity == 'none' else affinity,
+             cpus=cpus)
     sys.exit(0)
 
 
@@ -133,13 +322,80 @@ def run(prefix, block, dtype, block_shape,
 @click.option('--skip-bucket-warmup',
               is_flag=True, default=False,
               help="Don't run bucket warmup before running benchmarks")
-@click.option('--header-size', type=int,
-              help='Image header size in KiB, (GDAL_INGESTED_BYTES_AT_OPEN)')
+@click.option('--warmup-threads', type=int, default=32,
+              help='Number of threads to use for bucket warmup, default: 32')
+@click.option('--warmup-ttl', type=float, default=DEFAULT_TTL,
+              help='Only warm urls not warmed within this many seconds, default: {:d}'.format(DEFAULT_TTL))
+@click.option('--warmup-state', type=str, default=DEFAULT_STATE,
+              help='File recording when urls were warmed, default: {}'.format(DEFAULT_STATE))
+@click.option('--header-size', default=None,
+              callback=click_parse_tuple,
+              help='Image header size in KiB, (GDAL_INGESTED_BYTES_AT_OPEN), comma-separated list to sweep')
 @click.option('--aws-unsigned',
               is_flag=True, default=False,
               help='Do not sign S3 requests, only works on public buckets')
-@click.argument('url_file')
-def run_suite(block, warmup_more, threads, times, skip_bucket_warmup, header_size, aws_unsigned, url_file):
+@click.option('--profile',
+              is_flag=True, default=False,
+              help='Sample worker thread stacks during every run')
+@click.option('--gdal-opt', 'gdal_opts', multiple=True,
+              callback=click_parse_gdal_opts(many=True),
+              help=('GDAL config option to sweep KEY=V1,V2,..., can be repeated, '
+                    'e.g. VSI_CACHE_SIZE, CPL_VSIL_CURL_CHUNK_SIZE, GDAL_HTTP_MULTIPLEX, '
+                    'GDAL_HTTP_MAX_RETRY, GDAL_CACHEMAX. All combinations are run for every thread count'))
+@click.option('--retries', type=int, default=0,
+              help='How many times to retry failed reads (throttling, timeouts), default: 0')
+@click.option('--rates', default=None,
+              callback=click_parse_floats,
+              help='Open loop mode: sweep these arrival rates (reads per second) for every thread count')
+@click.option('--arrival', type=click.Choice(['constant', 'poisson']), default='constant',
+              help='Open loop mode: arrival process, default: constant')
+@click.option('--max-inflight', type=int, default=None,
+              help='Open loop mode: limit on queued plus running reads, default: 2x threads')
+@click.option('--mode', type=click.Choice(['rio', 'windows', 'http']), default='rio',
+              help=('rio: per tile callback (default), windows: `ParallelReader.read_windows` API, '
+                    'http: python range requests, no GDAL'))
+@click.option('--endpoint-url', type=str, default=None,
+              help='Send s3:// requests to this endpoint instead of AWS, e.g. http://localhost:9000')
+@click.option('--scenes', is_flag=True, default=False,
+              help='Read all bands of a scene together, urls have to be named <scene>_B<band>.TIF')
+@click.option('--bands', type=str, default=None,
+              help='Scene mode: comma-separated list of bands to read, default: most common set of bands')
+@click.option('--live', is_flag=True, default=False,
+              help='Print progress line once a second during every run')
+@click.option('--order', 'orders', default=None,
+              callback=click_parse_orders,
+              help=('Url order to use, comma-separated list to compare: '
+                    'as-is (default), shuffle, interleave, size (needs --sizes)'))
+@click.option('--order-seed', type=int, default=0,
+              help='Random seed for shuffle order, default: 0')
+@click.option('--sizes', 'sizes_file', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='File with url and size in bytes on every line, used by size order')
+@click.option('--metrics-port', type=int, default=None,
+              help='Serve live numbers of the current run in Prometheus format on this port')
+@click.option('--overview-level', type=int, default=None,
+              help='Read from this overview, 0 is the largest, default block is the center block of the overview')
+@click.option('--out-shape', default=None,
+              callback=click_parse_shape,
+              help='Decimate every block to WxH pixels (nearest neighbour), default: block shape')
+@click.option('--tile-cache', type=click.Path(file_okay=False), default=None,
+              help='Compare cold and warm tile cache runs, cache tiles in this directory')
+@click.option('--tile-cache-size', type=int, default=1024,
+              help='Tile cache budget in MiB, default: 1024')
+@click.option('--mem-cache', type=int, default=None,
+              help='Compare runs without and with an in-memory tile cache of this many MiB')
+@click.option('--netcheck', is_flag=True, default=False,
+              help='Measure network ceilings with the largest thread count first, every run is compared to them')
+@click.option('--affinity', 'affinities', default=None,
+              callback=click_parse_affinities,
+              help=('Placement of worker threads, comma-separated list to compare: '
+                    'none (default), compact, spread, numa'))
+@click.option('--resume', type=click.Path(exists=True, file_okay=False), default=None,
+              help='Continue interrupted suite in this directory, other options are taken from its manifest')
+@click.argument('url_file', required=False)
+def run_suite(block, warmup_more, threads, times, skip_bucket_warmup, warmup_threads, warmup_ttl, warmup_state,
+              header_size, aws_unsigned, profile, retries, rates, arrival, max_inflight, gdal_opts, mode,
+              endpoint_url, scenes, bands, live, orders, order_seed, sizes_file, metrics_port, overview_level,
+              out_shape, tile_cache, tile_cache_size, mem_cache, netcheck, affinities, resume, url_file):
     """Run benchmark suite.
 
     You need to supply a list of urls to use for testing. These should be
@@ -159,96 +415,470 @@ def run_suite(block, warmup_more, threads, times, skip_bucket_warmup, header_siz
     \b
     1. Figure out tif parameters dtype, block_shape using first file in the list
     2. Create folder for benchmark results
-    3. Warmup bucket by reading all the files with many threads once
+    3. Warmup bucket by reading files with many threads once, only files
+       not warmed within `--warmup-ttl` by a previous suite are read
     4. Run benchmark with different number of threads
        - New process is launched for every run
+       - Repetitions are the outer loop and thread counts are spread out,
+         so a partial suite still covers the whole range
+
+    Planned and completed runs are recorded in `manifest.json` in the output
+    directory. If the suite is interrupted, continue it with
+
+    \b
+     > bench-rio-s3 run --resume <output-dir>
 
     """
     from pathlib import Path
-    from datetime import datetime
-    import os
-    import rasterio
-    import math
-
-    def setup_output_dir(urls):
-        def find_first_available_dir(base):
-            if not Path(base).exists():
-                return Path(base)
-            for i in range(1, 100):
-                p = Path(base + '-{:02d}'.format(i))
-                if not p.exists():
-                    return p
-            return None
+    from types import SimpleNamespace
+    from .suite import DEFAULT_THREADS, plan_suite, resume_suite, run_suite
+
+    if resume is None and url_file is None:
+        raise click.UsageError('Need URL_FILE or --resume')
+    if orders and 'size' in orders and sizes_file is None:
+        raise click.UsageError('Size order needs --sizes')
+    if tile_cache and mem_cache:
+        raise click.UsageError('Use either --tile-cache or --mem-cache, not both')
+    if (tile_cache or mem_cache) and mode == 'http':
+        raise click.UsageError('Tile cache is not supported in http mode')
+
+    # suite settings are named after the options of this command
+    opts = SimpleNamespace(**click.get_current_context().params)
+    try:
+        if resume is not None:
+            manifest = resume_suite(resume, log=click.echo)
+        else:
+            manifest = plan_suite(url_file, opts,
+                                  threads=threads or DEFAULT_THREADS,
+                                  block=block,
+                                  times=times,
+                                  log=click.echo)
+        run_suite(manifest, live=live, metrics_port=metrics_port, log=click.echo)
+    except (ValueError, RuntimeError) as e:
+        raise click.ClickException(str(e))
+
+    click.echo('Completed, results saved in:\n   {}'.format(Path.cwd().name))
+    sys.exit(0)
+
+
+@cli.command(name='warmup')
+@click.option('--block', callback=click_parse_rc,
+              default=None,
+              help='Block to read, default: "center" block')
+@click.option('-n', '--threads', type=int, default=32,
+              help='Number of threads to use, default: 32')
+@click.option('--ttl', type=float, default=DEFAULT_TTL,
+              help='Only warm urls not warmed within this many seconds, default: {:d}'.format(DEFAULT_TTL))
+@click.option('--state', 'state_file', type=str, default=DEFAULT_STATE,
+              help='File recording when urls were warmed, default: {}'.format(DEFAULT_STATE))
+@click.option('--force', is_flag=True, default=False,
+              help='Warm every url, ignoring the state file')
+@click.option('--aws-unsigned',
+              is_flag=True, default=False,
+              help='Do not sign S3 requests, only works on public buckets')
+@click.option('--endpoint-url', type=str, default=None,
+              help='Send s3:// requests to this endpoint instead of AWS, e.g. http://localhost:9000')
+@click.argument('url_file')
+def run_bucket_warmup(block, threads, ttl, state_file, force, aws_unsigned, endpoint_url, url_file):
+    """Warm up bucket by reading one block from every url.
 
-        out_dir = find_first_available_dir(''.join(datetime.now().isoformat().split(':')[:2]))
-
-        if out_dir is None or out_dir.exists():
-            raise click.ClickException('Output directory: {} already exists'.format(out_dir))
-
-        out_dir.mkdir()
-        out_dir = out_dir.resolve()
-
-        os.chdir(str(out_dir))
-
-        with open('urls.txt', 'wt') as f:
-            f.write('\n'.join(urls) + '\n')
-
-        return out_dir
-
-    def external_run_bench(*args):
-        from subprocess import check_call
-        args = [sys.executable, sys.argv[0], 'run-one', *args]
-        return check_call(args)
-
-    def fetch_file_info(fname):
-        idx = 0
-        with rasterio.open(fname, 'r') as src:
-            bshape = src.block_shapes[idx]
-            shape_in_blocks = tuple(math.ceil(N/n) for N, n in zip(src.shape, bshape))
-            return dict(dtype=src.dtypes[idx],
-                        block_shape=bshape,
-                        shape=src.shape,
-                        shape_in_blocks=shape_in_blocks)
-
-    def build_args(finfo, block, nthreads, prefix=None):
-        args = ['--dtype={}'.format(finfo['dtype']),
-                '--block-shape={}x{}'.format(*finfo['block_shape']),
-                '--block={},{}'.format(*block),
-                '--{}warmup-more'.format('' if warmup_more else 'no-'),
-                '--threads={}'.format(nthreads),
-                'urls.txt']
-        if prefix is not None:
-            args.insert(-1, '--prefix={}'.format(prefix))
-        if header_size is not None:
-            args.insert(-1, '--header-size={}'.format(header_size))
-        if aws_unsigned:
-            args.insert(-1, '--aws-unsigned')
-        return args
-
-    threads = threads or [1, 2, 4, 8, 16, 20, 24, 28, 32, 38]
+    When each url was warmed is recorded in a state file, urls warmed less
+    than `--ttl` seconds ago are skipped. `run` does this before every suite.
+    """
+    from .bench import fetch_file_info, endpoint_gdal_opts
+    from .warmup import run_warmup, format_warmup
 
     urls = slurp_lines(url_file)
-    click.echo('Fetching info for {}'.format(urls[0]))
-    finfo = fetch_file_info(urls[0])
+    gdal_opts = endpoint_gdal_opts(endpoint_url) if endpoint_url else {}
+
+    if block is None:
+        env = dict(gdal_opts, AWS_NO_SIGN_REQUEST='YES') if aws_unsigned else gdal_opts
+        block = tuple(n//2 for n in fetch_file_info(urls[0], gdal_opts=env)['shape_in_blocks'])
+
+    ww = run_warmup(urls, block,
+                    nthreads=threads,
+                    ttl=ttl,
+                    state_file=state_file,
+                    force=force,
+                    aws_unsigned=aws_unsigned,
+                    gdal_opts=gdal_opts)
+    click.echo(format_warmup(ww))
+    sys.exit(0)
+
+
+@cli.command(name='replay')
+@click.option('--timing', type=click.Choice(['original', 'fast']), default='original',
+              help='original: start reads at recorded times (default), fast: as fast as possible')
+@click.option('-n', '--threads', type=int, default=None,
+              help='Number of processing threads to use, default: same as recorded run')
+@click.option('--mode', type=click.Choice(['rio', 'windows', 'http']), default='rio',
+              help='Reader to replay with, default: rio')
+@click.option('--latency-scale', type=float, default=1.0,
+              help='Multiply recorded latencies by this, 0 -- serve without delay, default: 1')
+@click.option('--header-size', type=int, default=None,
+              help='Image header size in KiB, default: same as recorded run')
+@click.option('--warmup-more/--no-warmup-more',
+              is_flag=True, default=True,
+              help='Fetch one file per thread prior to recording benchmark data, on by default')
+@click.option('--gdal-opt', 'gdal_opts', multiple=True,
+              callback=click_parse_gdal_opts(),
+              help='Extra GDAL config option KEY=VALUE, can be repeated, overrides defaults')
+@click.option('--prefix', type=str, default='RPL', help='Prefix for results file')
+@click.argument('trace_file')
+def run_replay(timing, threads, mode, latency_scale, header_size, warmup_more, gdal_opts, prefix, trace_file):
+    """Replay recorded access trace against a local endpoint.
+
+    Record a trace with `bench-rio-s3 run-one --trace ...`, this saves a
+    `.trace` file next to the results. Replay serves bytes captured in the
+    trace from a local HTTP server, every response is delayed by the recorded
+    open or read time. The same reads are then issued in the recorded order,
+    either at recorded start times or as fast as possible.
+
+    With S3 taken out of the picture, results of replays can be compared
+    between GDAL versions, configs and code changes.
+    """
+    from .replay import replay_trace
+
+    try:
+        replay_trace(trace_file,
+                     timing=timing,
+                     nthreads=threads,
+                     mode=mode,
+                     latency_scale=latency_scale,
+                     header_size=header_size,
+                     wmore=warmup_more,
+                     gdal_opts=dict(gdal_opts),
+                     prefix=prefix)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    sys.exit(0)
+
+
+@cli.command(name='codecs')
+@click.option('--block', callback=click_parse_rc,
+              default=None,
+              help='Block to read, default: "center" block')
+@click.option('-n', '--threads', default='1,2,4,8,16,32',
+              callback=click_parse_tuple,
+              help='Number of processing threads to run benchmark with, comma-separated list of integers')
+@click.option('--codecs', type=str, default=None,
+              help='Comma-separated list of codecs to test, default: none,deflate,deflate-p2,lzw,lzw-p2,zstd,zstd-p2')
+@click.option('--sources', type=str, default='decode,warm,cold,http',
+              help='Comma-separated list of sources to read from, default: decode,warm,cold,http')
+@click.option('--max-files', type=int, default=64,
+              help='Use at most that many urls from the list, default: 64')
+@click.option('--out-dir', type=str, default='codec-bench',
+              help='Where to store re-encoded tiles and results, default: codec-bench')
+@click.option('--aws-unsigned',
+              is_flag=True, default=False,
+              help='Do not sign S3 requests, only works on public buckets')
+@click.argument('url_file')
+def run_codecs(block, threads, codecs, sources, max_files, out_dir, aws_unsigned, url_file):
+    """Measure decode cost of different compression settings.
+
+    Fetches one block from every url, re-encodes it with every codec and then
+    reads those tiles back from memory (decode only), from local files (page
+    cache warm and cold) and over HTTP from a local server. Reports wall and
+    thread CPU time per tile, throughput and scaling for every thread count,
+    and a table of recommended codecs for every source.
+    """
+    from .bench import fetch_file_info
+    from .codec_bench import run_codec_bench
+
+    urls = slurp_lines(url_file)[:max_files]
+    if block is None:
+        finfo = fetch_file_info(urls[0], gdal_opts=dict(AWS_NO_SIGN_REQUEST='YES') if aws_unsigned else None)
+        block = tuple(n//2 for n in finfo['shape_in_blocks'])
+
+    try:
+        run_codec_bench(urls, block, out_dir,
+                        threads=threads,
+                        codecs=codecs.split(',') if codecs else None,
+                        sources=tuple(sources.split(',')),
+                        aws_unsigned=aws_unsigned,
+                        log=click.echo)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    sys.exit(0)
+
+
+@cli.command(name='dispatch')
+@click.option('-n', '--threads', default='1,2,4,8,16,32,64,128',
+              callback=click_parse_tuple,
+              help='Thread counts to measure, default: 1,2,4,8,16,32,64,128')
+@click.option('--workloads', type=str, default=None,
+              help='Comma-separated subset of: noop,sleep,cpu,heavy, default: all')
+@click.option('--queue-size', type=int, default=None,
+              help='Work queue size, default: same as readers use')
+@click.option('--out', type=str, default='dispatch.json',
+              help='Save results to this JSON file, default: dispatch.json')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Compare against results saved by an earlier run')
+@click.option('--tolerance', type=float, default=0.1,
+              help='Relative change that counts as a regression, default: 0.1')
+def run_dispatch_bench(threads, workloads, queue_size, out, baseline, tolerance):
+    """Microbenchmark the parallel dispatch layer.
+
+    Pushes items through `ParallelStreamProc` with synthetic work: no-op,
+    fixed sleep, CPU-bound python and heavy-tailed sleeps, no network
+    involved. Reports items per second, dispatch latency and scaling
+    efficiency for every thread count.
+
+    Exits with code 1 if --baseline is given and any case regressed by more
+    than --tolerance.
+    """
+    from .dispatch_bench import dispatch_bench
+
+    try:
+        regressed = dispatch_bench(threads=threads,
+                                   workloads=workloads.split(',') if workloads else None,
+                                   qmaxsize=queue_size,
+                                   out=out,
+                                   baseline=baseline,
+                                   tolerance=tolerance,
+                                   log=click.echo,
+                                   progress=lambda msg: click.echo(msg, err=True))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    sys.exit(1 if regressed else 0)
+
+
+@cli.command(name='history')
+@click.option('--db', type=str, default=DEFAULT_DB,
+              help='History database, default: {}'.format(DEFAULT_DB))
+@click.option('-n', '--threads', type=int, default=None,
+              help='Only runs with this many threads')
+@click.option('--mode', type=click.Choice(['rio', 'windows', 'http']), default=None,
+              help='Only runs in this mode')
+@click.option('--block', type=str, default=None,
+              help='Only runs that read this block, e.g. 4,4')
+@click.option('--config', type=str, default=None,
+              help='Only runs with exactly this configuration string, as shown in the report')
+@click.option('--gdal-opt', 'gdal_opts', multiple=True,
+              callback=click_parse_gdal_opts(),
+              help='Only runs that had GDAL option KEY=VALUE set, can be repeated')
+@click.option('--gdal', type=str, default=None,
+              help='Only runs with this GDAL version')
+@click.option('--instance-type', type=str, default=None,
+              help='Only runs on this EC2 instance type')
+@click.option('--host', 'hostname', type=str, default=None,
+              help='Only runs on this host')
+@click.option('--since', type=str, default=None,
+              help='Only runs on or after this date, YYYY-MM-DD')
+@click.option('--by', type=click.Choice(HISTORY_KEYS), default='nthreads',
+              help='Group runs by this for summary and plot, default: nthreads')
+@click.option('--plot', type=str, default=None,
+              help='Save plot of throughput over time to this file')
+@click.argument('dirs', nargs=-1)
+def run_history(db, threads, mode, block, config, gdal_opts, gdal, instance_type, hostname, since, by, plot,
+                dirs):
+    """Query results history across suites.
+
+    Result directories given on the command line are first added to the
+    history database, including sub-directories, files already added are
+    skipped unless they changed. Then runs matching all the filters are
+    listed oldest first with a summary per --by group.
+    """
+    from .history import show_history
+
+    try:
+        show_history(db, dirs,
+                     gdal_opts=gdal_opts,
+                     since=since,
+                     by=by,
+                     plot=plot,
+                     log=click.echo,
+                     nthreads=threads,
+                     mode=mode,
+                     block=block,
+                     config=config,
+                     gdal=gdal,
+                     instance_type=instance_type,
+                     hostname=hostname)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    sys.exit(0)
+
+
+@cli.command(name='predict')
+@click.option('-n', '--threads', default=None,
+              callback=click_parse_tuple,
+              help='Thread counts to predict, default: measured ones and powers of 2 up to 128')
+@click.option('--processes', default='1',
+              callback=click_parse_tuple,
+              help='Process counts to predict, every process running that many threads, default: 1')
+@click.option('--cpus', type=int, default=None,
+              help='CPU count of the machine to predict for, default: CPU count recorded with the results')
+@click.argument('directory', default='.')
+def run_predict(threads, processes, cpus, directory):
+    """Predict throughput and latency for unmeasured thread counts.
+
+    Fits a queueing model to per-tile network and CPU times of the results
+    in DIRECTORY, e.g. a short sweep with a few thread counts, and predicts
+    throughput and latency percentiles for other thread and process counts.
+    Prediction error is estimated by leaving each measured thread count out
+    of the fit in turn.
+    """
+    from .reports import load_dir
+    from .predict import predict, gen_predict_report
+
+    data = load_dir(directory)
+    try:
+        pr = predict(data, threads=threads, processes=processes, cores=cpus)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(gen_predict_report(pr))
+    sys.exit(0)
+
+
+@cli.command(name='netcheck')
+@click.option('-n', '--threads', type=int, default=32,
+              help='Number of worker threads, use the thread count where tile throughput plateaus, default: 32')
+@click.option('--seconds', type=float, default=10,
+              help='Approximate duration of each probe, default: 10')
+@click.option('--small-size', type=int, default=16,
+              help='Size of small range requests in KiB, default: 16')
+@click.option('--large-size', type=int, default=16,
+              help='Size of large sequential requests in MiB, default: 16')
+@click.option('--aws-unsigned',
+              is_flag=True, default=False,
+              help='Do not sign S3 requests, only works on public buckets')
+@click.option('--endpoint-url', type=str, default=None,
+              help='Send s3:// requests to this endpoint instead of AWS, e.g. http://localhost:9000')
+@click.option('--out', type=click.Path(dir_okay=False), default=NETCHECK_FILE,
+              help='Save ceilings to this file, default: {}'.format(NETCHECK_FILE))
+@click.argument('url_file')
+def run_netcheck_cmd(threads, seconds, small_size, large_size, aws_unsigned, endpoint_url, out, url_file):
+    """Measure raw network ceilings: requests per second and MB/s.
+
+    Reads the same objects as the tile benchmark without GDAL: many small
+    range requests at random offsets give the request rate ceiling, large
+    sequential requests give the bandwidth ceiling. Pass the saved file to
+    `run-one --netcheck` to see tile throughput as a fraction of both, or use
+    `run --netcheck` to do it all in one go.
+    """
+    from .netcheck import run_netcheck, save_netcheck, gen_netcheck_report
+
+    try:
+        nc = run_netcheck(slurp_lines(url_file),
+                          nthreads=threads,
+                          seconds=seconds,
+                          small_size=small_size << 10,
+                          large_size=large_size << 20,
+                          aws_unsigned=aws_unsigned,
+                          endpoint_url=endpoint_url,
+                          log=click.echo)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    save_netcheck(nc, out)
+    click.echo(gen_netcheck_report(nc))
+    click.echo('Saved to: {}'.format(out))
+    sys.exit(0)
+
+
+@cli.command(name='coordinate')
+@click.option('--agents', type=int, required=True,
+              help='Number of agents to wait for')
+@click.option('--host', type=str, default='0.0.0.0',
+              help='Interface to listen on, default: 0.0.0.0')
+@click.option('--port', type=int, default=8765,
+              help='Port to listen on, default: 8765')
+@click.option('-n', '--threads', type=int, default=8,
+              help='Number of processing threads to use on every agent, default: 8')
+@click.option('--block', callback=click_parse_rc,
+              default=None,
+              help='Block to read, default: "center" block')
+@click.option('--warmup-more/--no-warmup-more',
+              is_flag=True, default=True,
+              help='Fetch one file per thread on every agent prior to recording benchmark data, on by default')
+@click.option('--header-size', type=int,
+              help='Image header size in KiB, (GDAL_INGESTED_BYTES_AT_OPEN)')
+@click.option('--aws-unsigned',
+              is_flag=True, default=False,
+              help='Do not sign S3 requests, only works on public buckets')
+@click.option('--start-delay', type=float, default=2.0,
+              help='Seconds between all agents finishing warmup and synchronised start, default: 2')
+@click.option('--affinity', type=click.Choice(AFFINITY_POLICIES), default='none',
+              help='Placement of worker threads on every agent, see `run-one --help`, default: none')
+@click.option('--prefix', type=str, default='RIO', help='Prefix for results file')
+@click.argument('url_file')
+def run_coordinator(agents, host, port, threads, block, warmup_more, header_size, aws_unsigned,
+                    start_delay, affinity, prefix, url_file):
+    """Run benchmark across many hosts.
+
+    Waits for AGENTS agents (`bench-rio-s3 agent http://<this-host>:<port>`)
+    to register, splits urls between them and starts them all at the same
+    time. Per tile timings are corrected for clock offset between hosts and
+    merged into one results file in the current directory, per-agent results
+    are saved in `agents/`. Use `bench-rio-s3 report` on the output as usual.
+    """
+    from .bench import fetch_file_info
+    from .distributed import coordinate
 
+    urls = slurp_lines(url_file)
+    finfo = fetch_file_info(urls[0], gdal_opts=dict(AWS_NO_SIGN_REQUEST='YES') if aws_unsigned else None)
     if block is None:
         block = tuple(n//2 for n in finfo['shape_in_blocks'])
 
-    out_dir = setup_output_dir(urls)
+    run_kwargs = dict(nthreads=threads,
+                      block=block,
+                      block_shape=finfo['block_shape'],
+                      dtype=finfo['dtype'],
+                      wmore=warmup_more,
+                      bytes_at_open=header_size*1024 if header_size else None,
+                      aws_unsigned=aws_unsigned,
+                      affinity=affinity)
+
+    coordinate(urls, agents, run_kwargs,
+               host=host,
+               port=port,
+               start_delay=start_delay,
+               prefix=prefix,
+               log=click.echo)
+    sys.exit(0)
 
-    if not skip_bucket_warmup:
-        args = build_args(finfo, block, 32, prefix='WRM')
-        click.echo('Running with args: "{}"'.format(' '.join(args)))
-        for _ in range(1):
-            external_run_bench(*args)
 
-    for nth in threads:
-        args = build_args(finfo, block, nth, prefix='RIO')
-        click.echo('Running with args: "{}"'.format(' '.join(args)))
-        for _ in range(times):
-            external_run_bench(*args)
+@cli.command(name='agent')
+@click.option('--name', type=str, default=None,
+              help='Name to report to coordinator, default: hostname')
+@click.option('--cpus', type=str, default=None,
+              callback=click_parse_cpulist,
+              help='Run agent on these CPUs only, e.g. 0-15 for the first NUMA node')
+@click.argument('coordinator_url')
+def run_agent(name, cpus, coordinator_url):
+    """Run benchmark shard handed out by coordinator.
 
-    click.echo('Completed, results saved in:\n   {}'.format(out_dir.name))
+    \b
+    Example: bench-rio-s3 agent http://10.0.0.5:8765
+    """
+    from .distributed import run_agent
+
+    xx = run_agent(coordinator_url, name=name, cpus=cpus)
+    click.echo('Done: {} files in {:.2f} sec'.format(len(xx.stats), xx.t_total))
+    sys.exit(0)
+
+
+@cli.command(name='zipf')
+@click.option('-n', '--count', type=int, default=None,
+              help='Number of urls to generate, default: 10x input')
+@click.option('-s', '--exponent', type=float, default=1.1,
+              help='Zipf exponent, higher means fewer urls get most of the reads, default: 1.1')
+@click.option('--seed', type=int, default=0,
+              help='Random seed, default: 0')
+@click.argument('url_file')
+def run_zipf(count, exponent, seed, url_file):
+    """Generate repeated-access url list with Zipf distributed popularity.
+
+    Output is meant for benchmarking tile caches, e.g.
+
+    \b
+     > bench-rio-s3 zipf urls.txt > zipf.txt
+     > bench-rio-s3 run-one --mem-cache 256 -n 16 zipf.txt
+    """
+    from .loadgen import zipf_urls
+
+    urls = slurp_lines(url_file)
+    print('\n'.join(zipf_urls(urls, count or 10*len(urls), s=exponent, seed=seed)))
     sys.exit(0)
 
 
@@ -280,6 +910,25 @@ def run_s3_ls(filter, regex, prefix):
     sys.exit(0)
 
 
+@cli.command(name='info')
+@click.option('--aws-unsigned',
+              is_flag=True, default=False,
+              help='Do not sign S3 requests, only works on public buckets')
+@click.argument('url')
+def run_info(aws_unsigned, url):
+    """Show pixel type, tiling and overviews of a file.
+
+    Prints shape and tiling of the full resolution image and of every
+    overview level, and how many bytes precede the first tile.
+    """
+    from .bench import fetch_file_info, format_file_info
+
+    finfo = fetch_file_info(url, gdal_opts=dict(AWS_NO_SIGN_REQUEST='YES') if aws_unsigned else None)
+    click.echo('dtype: {}'.format(finfo['dtype']))
+    click.echo(format_file_info(finfo))
+    sys.exit(0)
+
+
 @cli.command(name='report')
 @click.argument('directory', default='.')
 def gen_report(directory):
@@ -343,3 +992,7 @@ def test_parsers():
     assert parse_shape('512') == (512, 512)
     assert parse_shape('640x480') == (480, 640)
     assert parse_tuple('3,4') == (3, 4)
+    assert parse_gdal_opt('vsi_cache_size=1000') == ('VSI_CACHE_SIZE', '1000')
+    assert parse_gdal_opt('GDAL_HTTP_MULTIPLEX=YES,NO', many=True) == ('GDAL_HTTP_MULTIPLEX', ['YES', 'NO'])
+    assert parse_affinities('none,spread') == ('none', 'spread')
+    assert parse_cpus('3,0-2') == '0-3'
@@ -3,7 +3,7 @@ import hashlib
 import sys
 from types import SimpleNamespace
 from . import pprio_bench
-from .reports import gen_stats_report
+from .reports import gen_stats_report, format_order, format_level, format_cache, format_affinity
 
 
 def find_next_available_file(fname_pattern, max_n=1000, start=1):
@@ -26,9 +26,16 @@ def mk_fname(params, ext='pickle', prefix=None):
     if prefix is None:
         prefix = 'results'
 
-    fmt = ('{prefix}_{p.block[0]:d}_{p.block[1]:d}B{p.band}'
+    band = params.band
+    if getattr(params, 'nbands', None):
+        band = 'x{:d}'.format(params.nbands)
+    if getattr(params, 'overview_level', None) is not None:
+        band = '{}O{:d}'.format(band, params.overview_level)
+
+    fmt = ('{prefix}_{p.block[0]:d}_{p.block[1]:d}B{band}'
            '__{p.nthreads:02d}_%03d.{ext}').format(prefix=prefix,
                                                    p=params,
+                                                   band=band,
                                                    ext=ext)
 
     return find_next_available_file(fmt)
@@ -77,6 +84,105 @@ def update_params(pp, **kwargs):
     return pp
 
 
+def fetch_file_info(fname, gdal_opts=None, overview_level=None):
+    """ Image and tiling of the first band
+
+    overview_level -- None| report dtype, shape and tiling of this overview
+                      instead of full resolution image
+
+    Also has `overviews`: shape and tiling of every overview level, and
+    `header_size`: offset of the first tile in the file (all levels), for
+    cloud optimized files that is the size of all the headers.
+    """
+    import rasterio
+    import math
+
+    def layout(src):
+        bshape = src.block_shapes[0]
+        offset = src.get_tag_item('BLOCK_OFFSET_0_0', 'TIFF', bidx=1)
+        return dict(shape=src.shape,
+                    block_shape=bshape,
+                    shape_in_blocks=tuple(math.ceil(N/n) for N, n in zip(src.shape, bshape)),
+                    offset=None if offset is None else int(offset))
+
+    with rasterio.Env(**(gdal_opts or {})):
+        with rasterio.open(fname, 'r') as src:
+            dtype = src.dtypes[0]
+            factors = src.overviews(1)
+            info = layout(src)
+
+        overviews = []
+        for level, factor in enumerate(factors):
+            with rasterio.open(fname, 'r', overview_level=level) as src:
+                overviews.append(dict(layout(src), level=level, factor=factor))
+
+    if overview_level is not None:
+        if not 0 <= overview_level < len(overviews):
+            raise ValueError('No overview level {} in {}, it has {:d} levels'.format(
+                overview_level, fname, len(overviews)))
+        selected = overviews[overview_level]
+    else:
+        selected = info
+
+    offsets = [x['offset'] for x in [info] + overviews if x['offset']]
+
+    return dict(dtype=dtype,
+                block_shape=selected['block_shape'],
+                shape=selected['shape'],
+                shape_in_blocks=selected['shape_in_blocks'],
+                overview_level=overview_level,
+                full=info,
+                overviews=overviews,
+                header_size=min(offsets) if offsets else None)
+
+
+def format_file_info(finfo):
+    """ Pyramid of the file as a table, one line per level, selected level marked with *
+    """
+    lines = ['{:>7s} {:>6s} {:>11s} {:>9s} {:>7s}'.format('level', 'factor', 'shape', 'blocks', 'tiles')]
+    for x in [dict(finfo['full'], level='full', factor=1)] + finfo['overviews']:
+        selected = x['level'] == ('full' if finfo['overview_level'] is None else finfo['overview_level'])
+        lines.append('{:>7} {:>6} {:>11s} {:>9s} {:>7s}{}'.format(
+            x['level'], x['factor'],
+            '{}x{}'.format(*x['shape'][::-1]),
+            '{}x{}'.format(*x['block_shape'][::-1]),
+            '{}x{}'.format(*x['shape_in_blocks'][::-1]),
+            ' *' if selected else ''))
+    if finfo['header_size'] is not None:
+        lines.append('header: {:,d} bytes before the first tile'.format(finfo['header_size']))
+    return '\n'.join(lines)
+
+
+def endpoint_gdal_opts(endpoint_url):
+    """ GDAL config options to send s3:// requests to a custom endpoint
+    """
+    from urllib.parse import urlparse
+    u = urlparse(endpoint_url)
+    return dict(AWS_S3_ENDPOINT=u.netloc,
+                AWS_HTTPS='YES' if u.scheme == 'https' else 'NO',
+                AWS_VIRTUAL_HOSTING='FALSE')
+
+
+def save_run_trace(xx, urls, rdr, fname, endpoint_url=None, aws_unsigned=False, warmup=None):
+    """ Build access trace of a `read_blocks(.., trace=True)` run, capture bytes it read and save it
+
+    warmup -- None| (result, urls) of the warmup read, see `replay.make_trace`
+    """
+    from .replay import make_trace, capture_bytes, save_trace
+
+    def get_request_maker():
+        from .s3tools import s3_get_object_request_maker, auto_find_region
+        region_name = 'us-east-1' if endpoint_url else auto_find_region()
+        return s3_get_object_request_maker(region_name,
+                                           endpoint_url=endpoint_url,
+                                           unsigned=aws_unsigned)
+
+    tr = make_trace(xx, urls, rdr.thread_ids(), header_size=rdr._bytes_at_open or 16*1024, warmup=warmup)
+    capture_bytes(tr, get_request_maker=get_request_maker)
+    save_trace(tr, fname)
+    return tr
+
+
 def run_main(file_list_file,
              nthreads,
              prefix='RIO',
@@ -88,13 +194,88 @@ def run_main(file_list_file,
              dtype='uint16',
              npz=False,
              bytes_at_open=None,
-             aws_unsigned=False):
+             aws_unsigned=False,
+             profile=None,
+             retry=None,
+             rate=None,
+             arrival='constant',
+             max_inflight=None,
+             gdal_opts=None,
+             run_id=None,
+             live=False,
+             metrics_port=None,
+             scenes=False,
+             bands=None,
+             endpoint_url=None,
+             trace=False,
+             arrivals=None,
+             replay=None,
+             order='as-is',
+             order_seed=0,
+             sizes_file=None,
+             vsi_cache_size=None,
+             gdal_cachemax=None,
+             overview_level=None,
+             out_shape=None,
+             tile_cache=None,
+             tile_cache_size=None,
+             cache_pass=None,
+             etags_file=None,
+             mem_cache_size=None,
+             netcheck=None,
+             affinity=None,
+             cpus=None):
+    """ Run one benchmark and save results
+
+    file_list_file -- file with urls, one per line, "-" for stdin, or a list of urls
+    trace          -- also record an access trace with captured bytes, saved next to results
+    arrivals       -- start offsets in seconds for every url, overrides `rate`
+    replay         -- None| dict describing replayed trace, stored in params
+    order          -- order in which urls are processed, see `ordering.STRATEGIES`
+    order_seed     -- random seed for 'shuffle' order
+    sizes_file     -- url sizes for 'size' order, see `ordering.load_sizes`
+    vsi_cache_size -- VSI cache per open file in bytes
+    gdal_cachemax  -- GDAL block cache size, bytes or MiB if less than 100000
+    overview_level -- None| read blocks of this overview, `block` and
+                      `block_shape` then refer to overview tiling
+    out_shape      -- None| (ny, nx) to decimate every block to, default is block shape
+    tile_cache     -- None| directory of the on-disk tile cache, see `tilecache.DiskTileCache`
+    tile_cache_size-- byte budget of the tile cache, default 1GiB
+    cache_pass     -- None| 'cold' -- clear the cache before the measured run,
+                      'warm' -- read all files once before the measured run,
+                      None -- use the cache as it is
+    etags_file     -- None| url etags for tile cache keys, see `tilecache.load_etags`
+    mem_cache_size -- None| byte budget of an in-memory tile cache shared by
+                      worker threads, see `tilecache.MemoryTileCache`, it starts
+                      empty for the measured run
+    netcheck       -- None| file saved by `netcheck.save_netcheck`, network
+                      ceilings to compare tile throughput against
+    affinity       -- None| placement policy of worker threads, see `affinity.POLICIES`
+    cpus           -- None| "0-3,8" restrict the whole process to these CPUs
+                      before starting worker threads, like `taskset`
+    """
+    from .ordering import make_order, load_sizes
+    from .history import env_info
     import pickle
+    from contextlib import ExitStack
 
     def without(xx, skip):
         return SimpleNamespace(**{k: v for k, v in xx.__dict__.items() if k not in skip})
 
-    files = slurp_lines(file_list_file)
+    if isinstance(file_list_file, str):
+        files = slurp_lines(file_list_file)
+    else:
+        files = list(file_list_file)
+
+    groups = None
+    if scenes:
+        from .scenes import group_by_scene
+        groups, bands, skipped = group_by_scene(files, bands=bands)
+        if len(groups) == 0:
+            raise ValueError('No complete scenes found, expect urls like <scene>_B<band>.TIF')
+        if skipped:
+            print('Skipping {:d} urls that are not part of a complete scene'.format(len(skipped)))
+        files = [u for _, uu in groups for u in uu]
 
     pp = SimpleNamespace(block=block,
                          block_shape=block_shape,
@@ -104,7 +285,35 @@ def run_main(file_list_file,
                          aws_unsigned=aws_unsigned,
                          mode=mode,
                          ssl=ssl,
+                         rate=rate,
+                         arrival=arrival if rate else None,
+                         run_id=run_id,
+                         order=order or 'as-is',
                          band=1)
+    if order == 'shuffle':
+        pp.order_seed = order_seed
+    if arrivals is not None:
+        # offered rate of a recorded schedule
+        pp.rate = len(arrivals)/max(arrivals[-1], 1e-3)
+        pp.arrival = 'recorded'
+    if replay is not None:
+        pp.replay = replay
+    if overview_level is not None:
+        pp.overview_level = overview_level
+    if out_shape is not None:
+        pp.out_shape = tuple(out_shape)
+    if tile_cache is not None:
+        pp.tile_cache = tile_cache
+        pp.cache_pass = cache_pass
+    if mem_cache_size:
+        pp.mem_cache_size = mem_cache_size
+    if affinity is not None:
+        pp.affinity = affinity
+    if cpus is not None:
+        from .affinity import pin_process, format_cpulist
+        pp.cpus = format_cpulist(pin_process(cpus))
+    if groups is not None:
+        pp.bands = bands
 
     print('''Files:
 {}
@@ -112,46 +321,178 @@ def run_main(file_list_file,
 {}
     files   - {:d}
     threads - {:d}
-    mode    - {}{}
+    mode    - {}{}{}{}{}{}{}{}{}{}
     '''.format('\n'.join(files[:3]),
                '\n'.join(files[-2:]),
                len(files),
                pp.nthreads,
-               mode, ' (no S3 signing)' if aws_unsigned else ''))
-
-    procs = {'rio': pprio_bench.PReadRIO_bench}
+               mode, ' (no S3 signing)' if aws_unsigned else '',
+               '\n    scenes  - {:d} x bands {}'.format(len(groups), ','.join(bands)) if groups else '',
+               '\n    rate    - {:g} per second ({})'.format(rate, arrival) if rate else '',
+               '\n    order   - {}'.format(format_order(pp)) if pp.order != 'as-is' else '',
+               '\n    level   - {}'.format(format_level(pp)) if format_level(pp) != 'full' else '',
+               '\n    cache   - {} ({} pass)'.format(tile_cache, format_cache(pp)) if tile_cache else '',
+               '\n    cache   - memory {:.1f} MiB'.format(mem_cache_size/(1 << 20)) if mem_cache_size else '',
+               '\n    affinity- {}'.format(format_affinity(pp)) if affinity or cpus else '',
+               ''.join('\n    gdal    - {}={}'.format(k, v) for k, v in (gdal_opts or {}).items())))
+
+    if order == 'size' and sizes_file is None:
+        raise ValueError('Need a file with url sizes for size order')
+    order_fn = make_order(order,
+                          seed=order_seed,
+                          sizes=load_sizes(sizes_file) if order == 'size' else None)
+
+    procs = {'rio': pprio_bench.PReadRIO_bench,
+             'windows': pprio_bench.PReadWindows_bench,
+             'http': pprio_bench.PReadHTTP_bench}
 
     if mode not in procs:
-        raise ValueError('Unknown mode: {} only know: rio'.format(mode))
+        raise ValueError('Unknown mode: {} only know: {}'.format(mode, ','.join(procs)))
     ProcClass = procs[mode]
 
+    extra = {}
+    if affinity is not None:
+        extra['affinity'] = affinity
+    if vsi_cache_size is not None:
+        pp.vsi_cache_size = extra['vsi_cache_size'] = vsi_cache_size
+    if gdal_cachemax is not None:
+        pp.gdal_cachemax = extra['gdal_cachemax'] = gdal_cachemax
+    if overview_level is not None:
+        extra['overview_level'] = overview_level
+    if extra and mode == 'http':
+        raise ValueError('GDAL cache and overview options have no effect in http mode')
+
+    if cache_pass not in (None, 'cold', 'warm'):
+        raise ValueError('Unknown cache pass: {}, only know: cold,warm'.format(cache_pass))
+    if cache_pass is not None and (tile_cache is None or mem_cache_size):
+        raise ValueError('Cache pass only applies to the on-disk tile cache, use it with tile_cache')
+    if tile_cache is not None:
+        from .tilecache import DiskTileCache, load_etags
+
+        if mode == 'http':
+            raise ValueError('Tile cache is not supported in http mode')
+        cache = DiskTileCache(tile_cache,
+                              max_bytes=tile_cache_size or (1 << 30),
+                              etags=load_etags(etags_file) if etags_file else None)
+        extra['tile_cache'] = cache
+        pp.tile_cache_size = cache.max_bytes
+
+    if mem_cache_size:
+        from .tilecache import MemoryTileCache, load_etags
+
+        if tile_cache is not None:
+            raise ValueError('Use either on-disk or in-memory tile cache, not both')
+        if mode == 'http':
+            raise ValueError('Tile cache is not supported in http mode')
+        cache = MemoryTileCache(mem_cache_size,
+                                etags=load_etags(etags_file) if etags_file else None)
+        extra['tile_cache'] = cache
+
+    if out_shape is not None and mode != 'rio':
+        raise ValueError('Decimated reads are only supported in rio mode')
+    out_shape = getattr(pp, 'out_shape', pp.block_shape)
+
+    if trace and mode != 'http':
+        # GDAL logs every range request it makes with CPL_DEBUG, see `replay.RangeLog`
+        gdal_opts = dict(gdal_opts or {}, CPL_DEBUG='ON')
+
+    if endpoint_url is not None:
+        pp.endpoint_url = endpoint_url
+        if mode == 'http':
+            extra['endpoint_url'] = endpoint_url
+        else:
+            gdal_opts = dict(endpoint_gdal_opts(endpoint_url), **(gdal_opts or {}))
+
     rdr = ProcClass(nthreads=pp.nthreads,
                     region_name=None,  # None -- auto-guess
                     use_ssl=ssl,
                     bytes_at_open=bytes_at_open,
-                    aws_unsigned=aws_unsigned)
+                    aws_unsigned=aws_unsigned,
+                    retry=retry,
+                    gdal_opts=gdal_opts,
+                    **extra)
     rdr.warmup()
+    placement = rdr.affinity.cpus
 
     if wmore:
         nwarm = min(len(files), pp.nthreads)
         print('Will read {} files for warmup first'.format(nwarm))
 
-        pix = np.ndarray((nwarm, *pp.block_shape), dtype=pp.dtype)
-        _, ww = rdr.read_blocks(files[-nwarm:], pp.block, dst=pix)
+        pix = np.ndarray((nwarm, *out_shape), dtype=pp.dtype)
+        _, ww = rdr.read_blocks(files[-nwarm:], pp.block, dst=pix, trace=trace)
         print('Done in {:.3f} seconds'.format(ww.t_total))
 
-    pix = np.ndarray((len(files), *pp.block_shape), dtype=pp.dtype)
-    _, xx = rdr.read_blocks(files, pp.block, dst=pix)
+    if groups is not None:
+        pix = np.ndarray((len(groups), len(bands), *out_shape), dtype=pp.dtype)
+    else:
+        pix = np.ndarray((len(files), *out_shape), dtype=pp.dtype)
+
+    if mem_cache_size:
+        cache.clear()  # drop tiles of the warmup read
+    elif cache_pass == 'cold':
+        print('Clearing tile cache: {}'.format(tile_cache))
+        cache.clear()
+    elif cache_pass == 'warm':
+        print('Priming tile cache: {}'.format(tile_cache))
+        if groups is not None:
+            _, cc = rdr.read_scenes(groups, pp.block, dst=pix)
+        else:
+            _, cc = rdr.read_blocks(files, pp.block, dst=pix)
+        print('Done in {:.3f} seconds, {:d} tiles were cached already'.format(cc.t_total, cc.tile_cache.hits))
+
+    with ExitStack() as stack:
+        prof = None
+        if profile:
+            from .profiler import StackSampler
+            prof = stack.enter_context(StackSampler(rdr.thread_ids(), rate=profile))
+
+        tm = None
+        if live or metrics_port is not None:
+            from .telemetry import Telemetry
+            tm = stack.enter_context(Telemetry(total=len(files),
+                                               queue_depth=rdr.queue_depth,
+                                               out=sys.stderr if live else None))
+            if metrics_port is not None:
+                url = stack.enter_context(tm.serve(port=metrics_port))
+                print('Serving metrics at: {}/metrics'.format(url))
+
+        if arrivals is None and rate:
+            from .loadgen import arrival_times
+            arrivals = arrival_times(len(groups) if groups else len(files), rate, arrival)
+
+        if groups is not None:
+            _, xx = rdr.read_scenes(groups, pp.block, dst=pix,
+                                    arrivals=arrivals,
+                                    max_inflight=max_inflight,
+                                    telemetry=tm,
+                                    trace=trace,
+                                    order=order_fn)
+        else:
+            _, xx = rdr.read_blocks(files, pp.block, dst=pix,
+                                    arrivals=arrivals,
+                                    max_inflight=max_inflight,
+                                    telemetry=tm,
+                                    trace=trace,
+                                    order=order_fn)
 
     for k, v in pp.__dict__.items():
         if not hasattr(xx.params, k):
             setattr(xx.params, k, v)
+    xx.params.block_shape = pp.block_shape  # not the output shape of decimated reads
 
+    xx.placement = placement  # CPUs of every worker thread, None when not pinned
     xx.result_hash = array_digest(pix)
+    xx.env = env_info()
+    if netcheck is not None:
+        from .netcheck import load_netcheck
+        xx.netcheck = load_netcheck(netcheck)
 
     if wmore:
         xx._warmup = ww
 
+    if prof is not None:
+        xx.profile = prof.summary()
+
     print('Result hash: {}'.format(xx.result_hash))
 
     fnames = {ext: mk_fname(xx.params, ext=ext, prefix=prefix)
@@ -162,10 +503,25 @@ def run_main(file_list_file,
     print('''Saved results to:
     - {}'''.format(fnames['pickle']))
 
+    if prof is not None:
+        fname = fnames['pickle'][:-len('pickle')] + 'folded'
+        prof.write_folded(fname)
+        print('    - {}'.format(fname))
+
     if npz:
         np.savez(fnames['npz'], data=pix)
         print('    - {}'.format(fnames['npz']))
 
+    if trace:
+        fname = fnames['pickle'][:-len('pickle')] + 'trace'
+        save_run_trace(xx, files, rdr, fname, endpoint_url=endpoint_url, aws_unsigned=aws_unsigned,
+                       warmup=(ww, files[-nwarm:]) if wmore else None)
+        print('    - {}'.format(fname))
+
     print(gen_stats_report(xx))
 
+    if prof is not None:
+        from .profiler import gen_profile_report
+        print(gen_profile_report(xx.profile))
+
     return 0
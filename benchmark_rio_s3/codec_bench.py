@@ -0,0 +1,360 @@
+""" Codec/decode-cost matrix benchmark
+
+Same tiles are re-encoded with a number of different compression settings and
+then read back from different kinds of storage:
+
+- decode -- in-memory copy (`/vsimem/`), no I/O at all, so read time is decode time
+- warm   -- local files that are in the page cache
+- cold   -- local files evicted from the page cache before every pass
+- http   -- local files served over HTTP by a separate process, same `/vsicurl/`
+            path as S3 reads
+
+For every (codec, source, nthreads) combination we record wall and thread CPU
+time for open and read phases of every tile.
+"""
+import os
+import sys
+from collections import OrderedDict
+from pathlib import Path
+from timeit import default_timer as t_now
+from types import SimpleNamespace
+import numpy as np
+import rasterio
+
+from .pprio import ParallelReader
+from .s3tools import auto_find_region
+from .pprio_bench import PReadRIO_bench, t_cpu_now
+
+CODECS = OrderedDict([
+    ('none', dict(compress=None)),
+    ('deflate', dict(compress='deflate')),
+    ('deflate-p2', dict(compress='deflate', predictor=2)),
+    ('lzw', dict(compress='lzw')),
+    ('lzw-p2', dict(compress='lzw', predictor=2)),
+    ('zstd', dict(compress='zstd')),
+    ('zstd-p2', dict(compress='zstd', predictor=2)),
+])
+
+SOURCES = ('decode', 'warm', 'cold', 'http')
+
+
+def read_tiles(rdr, urls, dst, band=1):
+    """ Read first block of every url into dst[idx], recording wall and CPU time
+    """
+    stats = [None for _ in urls]
+
+    def extract_block(f, idx, t0=(0, 0)):
+        t0, c0 = t0
+        win = f.block_window(band, 0, 0)
+        t1, c1 = t_cpu_now()
+        f.read(band, window=win, out=dst[idx, :, :])
+        t2, c2 = t_cpu_now()
+
+        stats[idx] = SimpleNamespace(t0=t0,
+                                     t_open=t1-t0,
+                                     t_total=t2-t0,
+                                     cpu_open=c1-c0,
+                                     cpu_read=c2-c1,
+                                     chunk_size=f.block_size(band, 0, 0))
+
+    t0 = t_now()
+    rdr.process(enumerate(urls), extract_block, timer=t_cpu_now)
+    t_total = t_now() - t0
+
+    return SimpleNamespace(stats=stats, t0=t0, t_total=t_total)
+
+
+def make_codec_files(pix, out_dir, codecs):
+    """ Write every tile in `pix` (ntiles, ny, nx) as single block GeoTiff, one
+    folder per codec.
+
+    Returns codec_name -> [local file path], codecs that GDAL build doesn't
+    support are skipped with a warning.
+    """
+    _, ny, nx = pix.shape
+    profile = dict(driver='GTiff',
+                   width=nx, height=ny, count=1,
+                   dtype=pix.dtype.name,
+                   tiled=True,
+                   blockxsize=nx,
+                   blockysize=ny)
+
+    out = OrderedDict()
+    for name in codecs:
+        opts = {k: v for k, v in CODECS[name].items() if v is not None}
+        folder = Path(out_dir)/name
+        folder.mkdir(parents=True, exist_ok=True)
+        files = []
+        try:
+            for i, tile in enumerate(pix):
+                fname = str(folder/'{:04d}.tif'.format(i))
+                with rasterio.open(fname, 'w', **profile, **opts) as dst:
+                    dst.write(tile, 1)
+                files.append(fname)
+        except Exception as e:
+            print('Skipping codec {}: {}'.format(name, str(e)), file=sys.stderr)
+            continue
+        out[name] = files
+
+    return out
+
+
+def drop_page_cache(files):
+    """ Ask kernel to evict files from the page cache, no root needed
+    """
+    for fname in files:
+        fd = os.open(fname, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def load_page_cache(files):
+    for fname in files:
+        with open(fname, 'rb') as f:
+            while f.read(1 << 20):
+                pass
+
+
+def _summarise(rr, nthreads):
+    stats = [s for s in rr.stats if s is not None]
+    if not stats:
+        # every read failed
+        return SimpleNamespace(nthreads=nthreads,
+                               n_bad=len(rr.stats),
+                               t_open=np.nan,
+                               t_read=np.nan,
+                               cpu_open=np.nan,
+                               cpu_read=np.nan,
+                               chunk_size=0,
+                               throughput=0.0,
+                               duration=rr.t_total,
+                               _raw=rr)
+
+    ms = lambda k: np.r_[[getattr(s, k) for s in stats]]*1000
+    t_read = ms('t_total') - ms('t_open')
+    t_end = np.r_[[s.t0 + s.t_total for s in stats]] - min(s.t0 for s in stats)
+
+    return SimpleNamespace(nthreads=nthreads,
+                           n_bad=len(rr.stats) - len(stats),
+                           t_open=np.median(ms('t_open')),
+                           t_read=np.median(t_read),
+                           cpu_open=np.median(ms('cpu_open')),
+                           cpu_read=np.median(ms('cpu_read')),
+                           chunk_size=int(np.median([s.chunk_size for s in stats])),
+                           throughput=len(stats)/t_end.max(),
+                           duration=rr.t_total,
+                           _raw=rr)
+
+
+def run_codec_matrix(urls,
+                     block,
+                     out_dir,
+                     threads=(1, 2, 4, 8),
+                     codecs=None,
+                     sources=SOURCES,
+                     band=1,
+                     aws_unsigned=False):
+    """ Fetch `block` from every url, re-encode with every codec and time reads
+    from every source kind with every thread count.
+
+    Returns SimpleNamespace with
+      results: (codec, source, nthreads) -> summary
+      sizes:   codec -> median bytes per tile
+    """
+    from .httpserve import serve_dir_process
+    from rasterio.io import MemoryFile
+
+    codecs = list(CODECS) if codecs is None else codecs
+    unknown = [c for c in codecs if c not in CODECS]
+    if unknown:
+        raise ValueError('Unknown codecs: {}, only know: {}'.format(','.join(unknown), ','.join(CODECS)))
+
+    unknown = [s for s in sources if s not in SOURCES]
+    if unknown:
+        raise ValueError('Unknown sources: {}, only know: {}'.format(','.join(unknown), ','.join(SOURCES)))
+
+    threads = sorted(threads)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    region_name = auto_find_region()
+    rdr = PReadRIO_bench(threads[-1], region_name=region_name, aws_unsigned=aws_unsigned)
+    rdr.warmup()
+
+    with rasterio.Env(**rdr.gdal_opts):
+        with rasterio.open(urls[0], 'r') as src:
+            block_shape = src.block_shapes[band-1]
+            dtype = src.dtypes[band-1]
+
+    pix = np.zeros((len(urls), *block_shape), dtype=dtype)
+    _, xx = rdr.read_blocks(urls, block, dst=pix, band=band)
+    rdr.shutdown()
+    print('Fetched {} tiles in {:.3f} seconds'.format(len(urls), xx.t_total))
+
+    files = make_codec_files(pix, out_dir, codecs)
+    mem_files = {}
+    results = OrderedDict()
+    npass = 0
+
+    def open_mem_files(name):
+        mm = []
+        for fname in files[name]:
+            with open(fname, 'rb') as f:
+                mm.append(MemoryFile(f.read()))
+        mem_files[name] = mm
+        return [m.name for m in mm]
+
+    # server in its own process, so it does not compete with measured workers for the GIL
+    with serve_dir_process(out_dir) as base_url:
+        for nthreads in threads:
+            rdr = ParallelReader(nthreads, region_name=region_name, aws_unsigned=aws_unsigned)
+            rdr.warmup()
+            dst = np.zeros_like(pix)
+
+            for name, local in files.items():
+                for source in sources:
+                    npass += 1
+                    if source == 'decode':
+                        src_urls = open_mem_files(name)
+                    elif source == 'http':
+                        # unique query string per pass defeats /vsicurl/ cache
+                        src_urls = ['{}/{}/{}?pass={}'.format(base_url, name, Path(f).name, npass)
+                                    for f in local]
+                    else:
+                        src_urls = local
+                        if source == 'cold':
+                            drop_page_cache(local)
+                        else:
+                            load_page_cache(local)
+
+                    rr = read_tiles(rdr, src_urls, dst, band=1)
+                    results[(name, source, nthreads)] = ss = _summarise(rr, nthreads)
+                    print('{:10s} {:6s} x{:<3d} {:8.1f} tiles/sec'.format(name, source, nthreads, ss.throughput))
+
+                    for m in mem_files.pop(name, []):
+                        m.close()
+
+            rdr.shutdown()
+
+    sizes = OrderedDict((name, results[(name, sources[0], threads[0])].chunk_size)
+                        for name in files)
+
+    return SimpleNamespace(results=results,
+                           sizes=sizes,
+                           codecs=list(files),
+                           sources=list(sources),
+                           threads=list(threads),
+                           block=block,
+                           block_shape=block_shape,
+                           dtype=dtype,
+                           nfiles=len(urls))
+
+
+def scaling_efficiency(rr, codec, source):
+    """ Throughput per thread relative to the lowest thread count, in %
+
+    NaN when every read at the lowest thread count failed.
+    """
+    n0 = rr.threads[0]
+    base = rr.results[(codec, source, n0)].throughput/n0
+    if base == 0:
+        return [np.nan for _ in rr.threads]
+    return [100*rr.results[(codec, source, n)].throughput/(n*base) for n in rr.threads]
+
+
+def gen_codec_report(rr):
+    n_max = rr.threads[-1]
+    raw_size = int(np.prod(rr.block_shape))*np.dtype(rr.dtype).itemsize
+
+    lines = ['Tiles: {:d} x {:d}x{:d}@{}, block {:d},{:d}'.format(rr.nfiles, *rr.block_shape,
+                                                                 rr.dtype, *rr.block),
+             '',
+             '{:10s} {:>9s} {:>6s}'.format('codec', 'bytes', 'ratio')]
+    for name, sz in rr.sizes.items():
+        lines.append('{:10s} {:9,d} {:6.2f}'.format(name, sz, raw_size/max(sz, 1)))
+
+    hdr = ' '.join('{:>7s}'.format('x{}'.format(n)) for n in rr.threads)
+    lines += ['',
+              'Per tile medians in ms, throughput in tiles/sec, eff. is scaling efficiency at x{}'.format(n_max),
+              '{:10s} {:6s} {:>6s} {:>6s} {:>6s} {:>6s} {} {:>5s}'.format(
+                  'codec', 'source', 'open', 'read', 'cpu.o', 'cpu.r', hdr, 'eff.')]
+
+    for name in rr.codecs:
+        for source in rr.sources:
+            s1 = rr.results[(name, source, rr.threads[0])]
+            fps = ' '.join('{:7.1f}'.format(rr.results[(name, source, n)].throughput) for n in rr.threads)
+            eff = scaling_efficiency(rr, name, source)[-1]
+            lines.append('{:10s} {:6s} {:6.2f} {:6.2f} {:6.2f} {:6.2f} {} {:>5s}'.format(
+                name, source, s1.t_open, s1.t_read, s1.cpu_open, s1.cpu_read, fps,
+                '-' if np.isnan(eff) else '{:4.0f}%'.format(eff)))
+
+    lines += ['',
+              'Recommendation at x{}'.format(n_max),
+              '{:6s} {:10s} {:>7s} {:10s} {:>7s} {}'.format('source', 'fastest', 'fps', 'runner-up', 'fps', 'bound by')]
+
+    for source in rr.sources:
+        ranked = sorted(rr.codecs, key=lambda c: -rr.results[(c, source, n_max)].throughput)
+        best = rr.results[(ranked[0], source, n_max)]
+        second = ranked[1] if len(ranked) > 1 else ranked[0]
+        cpu_share = (best.cpu_open + best.cpu_read)/max(best.t_open + best.t_read, 1e-6)
+        if best.throughput == 0:
+            bound = 'every read failed'
+        elif cpu_share > 0.5:
+            bound = 'CPU ({:.0f}%)'.format(cpu_share*100)
+        else:
+            bound = 'I/O ({:.0f}% CPU)'.format(cpu_share*100)
+        lines.append('{:6s} {:10s} {:7.1f} {:10s} {:7.1f} {}'.format(
+            source,
+            ranked[0], best.throughput,
+            second, rr.results[(second, source, n_max)].throughput,
+            bound))
+
+    return '\n'.join(lines)
+
+
+def run_codec_bench(urls, block, out_dir, log=print, **kw):
+    """ `run_codec_matrix` followed by the report, results and report are
+    saved in `out_dir` as codecs.pickle and codecs.txt
+
+    Returns results of `run_codec_matrix`
+    """
+    import pickle
+
+    rr = run_codec_matrix(urls, block, out_dir, **kw)
+    report = gen_codec_report(rr)
+    fname = str(Path(out_dir)/'codecs.pickle')
+    with open(fname, 'wb') as f:
+        pickle.dump(rr, f)
+    with open(str(Path(out_dir)/'codecs.txt'), 'wt') as f:
+        f.write(report + '\n')
+
+    log(report)
+    log('Saved results to: {}'.format(fname))
+    return rr
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_codec_report_failed_reads():
+    failed = SimpleNamespace(stats=[None, None], t_total=0.1)
+    ok = SimpleNamespace(stats=[SimpleNamespace(t0=0, t_total=0.01, t_open=0.004,
+                                                cpu_open=0.001, cpu_read=0.002, chunk_size=100)]*2,
+                         t_total=0.1)
+    results = OrderedDict()
+    for n in (1, 2):
+        results[('none', 'http', n)] = _summarise(ok, n)
+        results[('zstd', 'http', n)] = _summarise(failed, n)
+
+    rr = SimpleNamespace(results=results, sizes=OrderedDict([('none', 100), ('zstd', 0)]),
+                         codecs=['none', 'zstd'], sources=['http'], threads=[1, 2],
+                         block=(0, 0), block_shape=(4, 4), dtype='uint8', nfiles=2)
+
+    assert scaling_efficiency(rr, 'none', 'http') == [100, 50]
+    assert all(np.isnan(scaling_efficiency(rr, 'zstd', 'http')))
+    report = gen_codec_report(rr)
+    assert 'zstd' in report
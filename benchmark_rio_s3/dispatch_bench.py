@@ -0,0 +1,307 @@
+""" Microbenchmarks for the parallel dispatch layer
+
+Every tile goes through `ParallelStreamProc`: source pump -> bounded queue ->
+worker threads. Here the workers do synthetic work instead of I/O, so what is
+measured is the dispatch layer itself:
+
+- noop  -- no work at all, upper bound on items per second
+- sleep -- fixed sleep, releases the GIL like network I/O does
+- cpu   -- pure python loop, holds the GIL
+- heavy -- sleep with heavy-tailed (Pareto) duration, like S3 latency
+
+For every workload and thread count we record items per second, dispatch
+latency (from the source producing an item to a worker picking it up, so
+including time spent in the queue) and `broadcast` round-trip time. Results
+are saved as JSON and can be compared against a baseline from an earlier run.
+"""
+import json
+import platform
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime
+from timeit import default_timer as t_now
+from types import SimpleNamespace
+import numpy as np
+
+from .parallel import ParallelStreamProc
+
+WORKLOADS = OrderedDict([
+    ('noop', 'no work, dispatch overhead only'),
+    ('sleep', '1ms sleep, GIL released'),
+    ('cpu', 'python loop, GIL held'),
+    ('heavy', 'Pareto distributed sleep, 1ms median'),
+])
+
+# items per worker thread, keeps run time roughly constant across thread counts
+ITEMS_PER_THREAD = dict(noop=2000, sleep=100, cpu=100, heavy=100)
+
+SLEEP = 1e-3
+CPU_LOOP = 2000
+
+
+def make_work(workload, nitems, seed=0):
+    """ Returns work(idx) -> None for a named workload
+    """
+    if workload == 'noop':
+        return lambda idx: None
+    if workload == 'sleep':
+        return lambda idx: time.sleep(SLEEP)
+    if workload == 'cpu':
+        def work(idx):
+            n = 0
+            for i in range(CPU_LOOP):
+                n += i
+        return work
+    if workload == 'heavy':
+        a = 1.5
+        scale = SLEEP/2**(1/a)  # median of Pareto(a) + 1 is 2**(1/a)
+        tt = np.minimum((np.random.RandomState(seed).pareto(a, nitems) + 1)*scale, 0.2)
+        return lambda idx: time.sleep(tt[idx])
+
+    raise ValueError('Unknown workload: {}, only know: {}'.format(workload, ','.join(WORKLOADS)))
+
+
+def run_dispatch(pstream, workload, nitems, qmaxsize=None):
+    """ Push `nitems` through `pstream` with synthetic work, recording when
+    every item was produced, picked up and finished
+    """
+    work = make_work(workload, nitems)
+    t_put = np.zeros(nitems)
+    t_get = np.zeros(nitems)
+    t_end = np.zeros(nitems)
+
+    def src():
+        for idx in range(nitems):
+            t_put[idx] = t_now()
+            yield idx
+
+    def proc(it):
+        for idx in it:
+            t_get[idx] = t_now()
+            work(idx)
+            t_end[idx] = t_now()
+
+    pstream.bind(proc, qmaxsize=qmaxsize)(src())
+
+    duration = t_end.max() - t_put.min()
+    t_dispatch = (t_get - t_put)*1e6
+    p50, p99 = np.percentile(t_dispatch, [50, 99])
+    return SimpleNamespace(nitems=nitems,
+                           duration=duration,
+                           throughput=nitems/duration,
+                           dispatch_p50=p50,
+                           dispatch_p99=p99)
+
+
+def time_broadcast(pstream, n=50):
+    """ Median round-trip of `broadcast` with a no-op in microseconds
+    """
+    tt = []
+    for _ in range(n):
+        t0 = t_now()
+        pstream.broadcast(lambda: None)
+        tt.append(t_now() - t0)
+    return float(np.median(tt))*1e6
+
+
+def run_dispatch_suite(threads=(1, 2, 4, 8, 16, 32, 64, 128),
+                       workloads=None,
+                       items_per_thread=None,
+                       qmaxsize=None,
+                       log=None):
+    """ Run every workload for every thread count
+
+    items_per_thread -- None| dict workload -> items per thread, defaults to `ITEMS_PER_THREAD`
+    log              -- None| str -> None, called with progress messages
+
+    Returns dict that can be saved as JSON
+    """
+    workloads = list(workloads or WORKLOADS)
+    for w in workloads:
+        if w not in WORKLOADS:
+            raise ValueError('Unknown workload: {}, only know: {}'.format(w, ','.join(WORKLOADS)))
+    items_per_thread = dict(ITEMS_PER_THREAD, **(items_per_thread or {}))
+
+    results = []
+    for nthreads in threads:
+        pstream = ParallelStreamProc(nthreads)
+        try:
+            t_broadcast = time_broadcast(pstream)
+            for w in workloads:
+                rr = run_dispatch(pstream, w, items_per_thread[w]*nthreads, qmaxsize=qmaxsize)
+                results.append(dict(workload=w,
+                                    nthreads=nthreads,
+                                    broadcast_us=t_broadcast,
+                                    **rr.__dict__))
+                if log is not None:
+                    log('{:6s} x{:<3d} {:10.1f} items/s'.format(w, nthreads, rr.throughput))
+        finally:
+            pstream.shutdown()
+
+    return dict(meta=dict(created=datetime.now().isoformat(),
+                          python=sys.version.split()[0],
+                          platform=platform.platform(),
+                          cpus=_cpu_count(),
+                          qmaxsize=qmaxsize),
+                threads=list(threads),
+                workloads=workloads,
+                results=results)
+
+
+def _cpu_count():
+    import os
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def save_results(rr, fname):
+    with open(fname, 'wt') as f:
+        json.dump(rr, f, indent=2)
+
+
+def load_results(fname):
+    with open(fname, 'rt') as f:
+        return json.load(f)
+
+
+def _index(rr):
+    return {(r['workload'], r['nthreads']): r for r in rr['results']}
+
+
+def scaling_efficiency(rr, workload):
+    """ Throughput per thread relative to the lowest thread count, in %
+    """
+    idx = _index(rr)
+    n0 = rr['threads'][0]
+    base = idx[(workload, n0)]['throughput']/n0
+    return [100*idx[(workload, n)]['throughput']/(n*base) for n in rr['threads']]
+
+
+def compare_results(base, rr, tolerance=0.1):
+    """ Compare throughput and dispatch latency against a baseline
+
+    Returns list of SimpleNamespace(workload, nthreads, throughput, base_throughput,
+    change, dispatch_p99, base_dispatch_p99, regression) for cases present in
+    both, change is relative change of throughput. Regression is throughput
+    lower by more than `tolerance` or p99 dispatch latency higher by more
+    than `tolerance`.
+    """
+    ref = _index(base)
+    out = []
+    for r in rr['results']:
+        b = ref.get((r['workload'], r['nthreads']))
+        if b is None:
+            continue
+        change = r['throughput']/b['throughput'] - 1
+        slower = r['dispatch_p99'] > b['dispatch_p99']*(1 + tolerance)
+        out.append(SimpleNamespace(workload=r['workload'],
+                                   nthreads=r['nthreads'],
+                                   throughput=r['throughput'],
+                                   base_throughput=b['throughput'],
+                                   change=change,
+                                   dispatch_p99=r['dispatch_p99'],
+                                   base_dispatch_p99=b['dispatch_p99'],
+                                   regression=change < -tolerance or slower))
+    return out
+
+
+def gen_dispatch_report(rr):
+    idx = _index(rr)
+    threads = rr['threads']
+    hdr = ' '.join('{:>9s}'.format('x{}'.format(n)) for n in threads)
+
+    lines = ['Items per second, eff. is scaling efficiency at x{}'.format(threads[-1]),
+             '{:6s} {} {:>5s}'.format('work', hdr, 'eff.')]
+    for w in rr['workloads']:
+        fps = ' '.join('{:9.0f}'.format(idx[(w, n)]['throughput']) for n in threads)
+        lines.append('{:6s} {} {:4.0f}%'.format(w, fps, scaling_efficiency(rr, w)[-1]))
+
+    lines += ['',
+              'Dispatch latency p50/p99 in microseconds',
+              '{:6s} {}'.format('work', ' '.join('{:>13s}'.format('x{}'.format(n)) for n in threads))]
+    for w in rr['workloads']:
+        lat = ' '.join('{:6.0f}/{:<6.0f}'.format(idx[(w, n)]['dispatch_p50'], idx[(w, n)]['dispatch_p99'])
+                       for n in threads)
+        lines.append('{:6s} {}'.format(w, lat))
+
+    lines += ['',
+              'broadcast  {}'.format(' '.join('{:9.0f}'.format(idx[(rr['workloads'][0], n)]['broadcast_us'])
+                                              for n in threads)) + ' us']
+    return '\n'.join(lines)
+
+
+def gen_compare_report(cmp, tolerance=0.1):
+    lines = ['{:6s} {:>7s} {:>10s} {:>10s} {:>7s} {:>9s} {:>9s}'.format(
+        'work', 'threads', 'base', 'now', 'change', 'p99 base', 'p99 now')]
+    for c in cmp:
+        lines.append('{:6s} {:7d} {:10.0f} {:10.0f} {:+6.1f}% {:9.0f} {:9.0f}{}'.format(
+            c.workload, c.nthreads, c.base_throughput, c.throughput, c.change*100,
+            c.base_dispatch_p99, c.dispatch_p99, '  REGRESSION' if c.regression else ''))
+
+    n_bad = sum(c.regression for c in cmp)
+    lines.append('{:d} of {:d} cases regressed by more than {:.0f}%'.format(n_bad, len(cmp), tolerance*100))
+    return '\n'.join(lines)
+
+
+def dispatch_bench(threads, workloads=None, qmaxsize=None, out=None, baseline=None, tolerance=0.1,
+                   log=print, progress=None):
+    """ Run dispatch suite, report and save results, compare with `baseline` file
+
+    Returns True if any case regressed by more than `tolerance` relative to the baseline
+    """
+    rr = run_dispatch_suite(threads=threads, workloads=workloads, qmaxsize=qmaxsize, log=progress)
+
+    log(gen_dispatch_report(rr))
+    if out is not None:
+        save_results(rr, out)
+        log('Saved results to: {}'.format(out))
+
+    if baseline is None:
+        return False
+
+    cmp = compare_results(load_results(baseline), rr, tolerance=tolerance)
+    log('')
+    log(gen_compare_report(cmp, tolerance=tolerance))
+    return any(c.regression for c in cmp)
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_dispatch_suite(tmpdir):
+    rr = run_dispatch_suite(threads=(1, 2),
+                            items_per_thread=dict(noop=50, sleep=5, cpu=5, heavy=5))
+    assert rr['workloads'] == list(WORKLOADS)
+    assert len(rr['results']) == 2*len(WORKLOADS)
+    assert all(r['throughput'] > 0 for r in rr['results'])
+    assert all(r['nitems'] == 10 for r in rr['results'] if r['nthreads'] == 2 and r['workload'] == 'sleep')
+    assert len(scaling_efficiency(rr, 'sleep')) == 2
+    assert 'broadcast' in gen_dispatch_report(rr)
+
+    fname = str(tmpdir/'dispatch.json')
+    save_results(rr, fname)
+    base = load_results(fname)
+
+    cmp = compare_results(base, rr)
+    assert len(cmp) == len(rr['results'])
+    assert not any(c.regression for c in cmp)
+
+    for r in rr['results']:
+        r['throughput'] *= 0.5
+    assert all(c.regression for c in compare_results(base, rr))
+    assert 'REGRESSION' in gen_compare_report(compare_results(base, rr))
+
+
+def test_make_work():
+    import pytest
+    work = make_work('heavy', 10)
+    t0 = t_now()
+    for i in range(10):
+        work(i)
+    assert t_now() - t0 >= 10*SLEEP/2**(1/1.5)
+
+    with pytest.raises(ValueError):
+        make_work('bogus', 1)
@@ -0,0 +1,452 @@
+""" Run one benchmark across many hosts
+
+Coordinator shards the url list across a fixed number of agents, hands out
+shards once all agents have registered, waits for every agent to finish its
+warmup and then hands out a common start time, and collects results. Agents
+estimate their clock offset relative to the coordinator so that per-tile
+timestamps from different hosts can be put on one timeline.
+
+Protocol is plain HTTP, results are transferred as pickles, so only use this
+on a network you trust.
+
+```
+GET  /time                 -> {"t": coordinator wall clock}
+POST /register {"name": ..} -> {"agent_id": int}
+GET  /job?agent=<id>       -> pickled job, blocks until all agents registered
+POST /ready?agent=<id>     -> {"t_start": ..}, blocks until all agents are ready
+POST /result?agent=<id>    <- pickled result
+```
+"""
+import json
+import pickle
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from timeit import default_timer as t_now
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs
+
+from .httpserve import run_server
+
+__all__ = ['Coordinator', 'coordinate', 'run_agent', 'merge_results']
+
+
+def estimate_clock_offset(get_remote_time, n=8):
+    """ NTP style offset estimate: remote_time - local_time
+
+    Uses the exchange with the smallest round trip time.
+
+    Returns (offset, rtt) in seconds
+    """
+    best = None
+    for _ in range(n):
+        t1 = time.time()
+        t_remote = get_remote_time()
+        t2 = time.time()
+        rtt = t2 - t1
+        if best is None or rtt < best[1]:
+            best = (t_remote - (t1 + t2)*0.5, rtt)
+    return best
+
+
+def _to_coordinator_time(t, clock):
+    return t + clock.perf_to_wall + clock.offset
+
+
+def merge_results(jobs, results):
+    """ Combine per-agent results into one result usable by `reports`
+
+    jobs    -- agent_id -> job as handed out by coordinator
+    results -- agent_id -> result returned by agent (with .clock attached)
+
+    Per tile timestamps are converted to coordinator wall clock, tiles are
+    placed in the same order as in the original url list. Every agent
+    records `late`: seconds it started after the agreed start time.
+    """
+    from copy import copy
+
+    n = sum(len(job.urls) for job in jobs.values())
+    stats = [None for _ in range(n)]
+    errors = [None for _ in range(n)]
+    agents = []
+    t_start, t_end = [], []
+
+    for agent_id in sorted(results):
+        job, xx = jobs[agent_id], results[agent_id]
+        clock = xx.clock
+
+        for idx, r, ee in zip(job.idx, xx.stats, getattr(xx, 'errors', None) or [None]*len(job.idx)):
+            if r is not None:
+                r = copy(r)
+                r.t0 = _to_coordinator_time(r.t0, clock)
+                if getattr(r, 't_sched', None) is not None:
+                    r.t_sched = _to_coordinator_time(r.t_sched, clock)
+            stats[idx] = r
+            errors[idx] = ee
+
+        t0 = _to_coordinator_time(xx.t0, clock)
+        t_start.append(t0)
+        t_end.append(t0 + xx.t_total)
+        agents.append(SimpleNamespace(agent_id=agent_id,
+                                      name=clock.name,
+                                      offset=clock.offset,
+                                      rtt=clock.rtt,
+                                      late=getattr(clock, 'late', 0),
+                                      nthreads=xx.params.nthreads,
+                                      nfiles=len(job.idx),
+                                      t_total=xx.t_total))
+
+    first = results[min(results)]
+    params = copy(first.params)
+    params.nthreads = sum(a.nthreads for a in agents)
+    params.agents = len(agents)
+    params.hosts = [a.name for a in agents]
+
+    return SimpleNamespace(stats=stats,
+                           errors=errors,
+                           params=params,
+                           agents=agents,
+                           t0=min(t_start),
+                           t_total=max(t_end) - min(t_start))
+
+
+class Coordinator(object):
+    """Hand out url shards to `nagents` agents and collect their results
+
+    ```
+    coord = Coordinator(urls, nagents=4, run_kwargs=dict(nthreads=8, ...))
+    with coord.serve(host='0.0.0.0', port=8765) as url:
+        xx = coord.wait()
+    ```
+    """
+    def __init__(self, urls, nagents, run_kwargs, start_delay=2.0):
+        self._urls = urls
+        self._nagents = nagents
+        self._run_kwargs = run_kwargs
+        self._start_delay = start_delay
+        self._cond = threading.Condition()
+        self._names = []
+        self._jobs = {}
+        self._ready = set()
+        self._t_start = None
+        self.results = {}
+
+    def _register(self, name):
+        with self._cond:
+            if len(self._names) >= self._nagents:
+                raise ValueError('Already have {} agents'.format(self._nagents))
+            agent_id = len(self._names)
+            self._names.append(name or 'agent-{}'.format(agent_id))
+
+            if len(self._names) == self._nagents:
+                n = self._nagents
+                for i in range(n):
+                    idx = list(range(i, len(self._urls), n))
+                    self._jobs[i] = SimpleNamespace(agent_id=i,
+                                                    name=self._names[i],
+                                                    nagents=n,
+                                                    idx=idx,
+                                                    urls=[self._urls[k] for k in idx],
+                                                    run_kwargs=self._run_kwargs)
+            self._cond.notify_all()
+            return agent_id
+
+    def _get_job(self, agent_id):
+        with self._cond:
+            self._cond.wait_for(lambda: agent_id in self._jobs)
+            return self._jobs[agent_id]
+
+    def _set_ready(self, agent_id):
+        """ Agent finished warmup, returns common start time once every agent did
+        """
+        with self._cond:
+            self._ready.add(agent_id)
+            if len(self._ready) == self._nagents:
+                self._t_start = time.time() + self._start_delay
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: self._t_start is not None)
+            return self._t_start
+
+    def _add_result(self, agent_id, xx):
+        with self._cond:
+            self.results[agent_id] = xx
+            self._cond.notify_all()
+
+    def _make_handler(self):
+        coord = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, body, code=200, ctype='application/json'):
+                self.send_response(code)
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _reply_json(self, doc, code=200):
+                self._reply(json.dumps(doc).encode('utf8'), code=code)
+
+            def _agent_id(self):
+                return int(parse_qs(urlparse(self.path).query)['agent'][0])
+
+            def _body(self):
+                return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                if path == '/time':
+                    self._reply_json(dict(t=time.time()))
+                elif path == '/job':
+                    job = coord._get_job(self._agent_id())
+                    self._reply(pickle.dumps(job), ctype='application/octet-stream')
+                else:
+                    self._reply_json(dict(error='Not found'), code=404)
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                if path == '/register':
+                    try:
+                        agent_id = coord._register(json.loads(self._body() or b'{}').get('name'))
+                    except ValueError as e:
+                        self._reply_json(dict(error=str(e)), code=409)
+                        return
+                    self._reply_json(dict(agent_id=agent_id))
+                elif path == '/ready':
+                    self._reply_json(dict(t_start=coord._set_ready(self._agent_id())))
+                elif path == '/result':
+                    coord._add_result(self._agent_id(), pickle.loads(self._body()))
+                    self._reply_json(dict(ok=True))
+                else:
+                    self._reply_json(dict(error='Not found'), code=404)
+
+        return Handler
+
+    def serve(self, host='0.0.0.0', port=8765):
+        return run_server(self._make_handler(), host=host, port=port)
+
+    def wait(self, timeout=None, on_progress=None):
+        """ Block until all agents reported back, return merged result
+
+        on_progress: None| (n_registered, n_ready, n_done) -> None, called on every change
+        """
+        with self._cond:
+            def done():
+                if on_progress is not None:
+                    on_progress(len(self._names), len(self._ready), len(self.results))
+                return len(self.results) == self._nagents
+
+            if not self._cond.wait_for(done, timeout=timeout):
+                raise TimeoutError('Only {} out of {} agents reported back'.format(len(self.results),
+                                                                                   self._nagents))
+
+        return merge_results(self._jobs, self.results)
+
+
+def coordinate(urls, nagents, run_kwargs, host='0.0.0.0', port=8765, start_delay=2.0, prefix='RIO', log=print):
+    """ Run coordinator until every agent reported back, save merged results
+    in the current directory and per-agent results in `agents/`
+
+    Returns (merged result, file name)
+    """
+    from pathlib import Path
+    from .bench import mk_fname
+    from .reports import gen_stats_report
+
+    coord = Coordinator(urls, nagents, run_kwargs, start_delay=start_delay)
+    progress = {}
+
+    def on_progress(n_registered, n_ready, n_done):
+        if progress.get('last') != (n_registered, n_ready, n_done):
+            progress['last'] = (n_registered, n_ready, n_done)
+            log('Agents: {}/{} registered, {} ready, {} done'.format(n_registered, nagents, n_ready, n_done))
+
+    with coord.serve(host=host, port=port) as url:
+        log('Waiting for {} agents on: {}'.format(nagents, url))
+        xx = coord.wait(on_progress=on_progress)
+
+    Path('agents').mkdir(exist_ok=True)
+    for agent_id, rr in coord.results.items():
+        with open('agents/agent-{:02d}-{}.pickle'.format(agent_id, rr.clock.name), 'wb') as f:
+            pickle.dump(rr, f)
+
+    fname = mk_fname(xx.params, prefix=prefix)
+    with open(fname, 'wb') as f:
+        pickle.dump(xx, f)
+
+    for a in xx.agents:
+        log('  {a.name:20s} {a.nfiles:6d} files {a.t_total:7.2f} sec, '
+            'clock offset {ms:+.1f}ms (rtt {rtt:.1f}ms)'.format(a=a, ms=a.offset*1000, rtt=a.rtt*1000))
+    for a in xx.agents:
+        if a.late > 0:
+            log('WARNING: {} started {:.3f} sec after the common start time, '
+                'increase --start-delay'.format(a.name, a.late))
+    log(gen_stats_report(xx, '{} agents'.format(len(xx.agents))))
+    log('Saved results to: {}'.format(fname))
+    return xx, fname
+
+
+def prepare_shard(urls,
+                  nthreads,
+                  block,
+                  block_shape,
+                  dtype,
+                  wmore=True,
+                  bytes_at_open=None,
+                  aws_unsigned=False,
+                  affinity=None):
+    """ Setup for the default agent job: start reader threads, do the same
+    warmup as `run-one` and allocate output buffer.
+
+    affinity -- None| placement policy of worker threads, see `affinity.POLICIES`
+
+    Returns (reader, pixel buffer)
+    """
+    import numpy as np
+    from .pprio_bench import PReadRIO_bench
+
+    rdr = PReadRIO_bench(nthreads,
+                         bytes_at_open=bytes_at_open,
+                         aws_unsigned=aws_unsigned,
+                         affinity=affinity)
+    rdr.warmup()
+
+    if wmore:
+        nwarm = min(len(urls), nthreads)
+        pix = np.ndarray((nwarm, *block_shape), dtype=dtype)
+        rdr.read_blocks(urls[-nwarm:], block, dst=pix)
+
+    return rdr, np.ndarray((len(urls), *block_shape), dtype=dtype)
+
+
+def _prepare_tile_reads(urls, cpus=None, **run_kwargs):
+    rdr, pix = prepare_shard(urls, **run_kwargs)
+
+    def run(urls, block=None, **kw):
+        xx = rdr.read_blocks(urls, block, dst=pix)[1]
+        xx.params.affinity = rdr.affinity.policy
+        xx.params.cpus = cpus
+        xx.placement = rdr.affinity.cpus
+        return xx
+
+    return run
+
+
+def run_agent(url, name=None, prepare=None, nping=8, cpus=None):
+    """ Register with coordinator at `url`, wait for the job, prepare it,
+    report ready, run it at the agreed time and send results back.
+
+    prepare: None| (urls, **run_kwargs) -> run, setup done before reporting
+             ready (reader threads, warmup), returns
+             run: (urls, **run_kwargs) -> result, default is a tile read benchmark
+    cpus: None| "0-3,8" restrict agent process to these CPUs before starting worker threads
+    """
+    import socket
+    import requests
+
+    if cpus is not None:
+        from .affinity import pin_process, format_cpulist
+        cpus = format_cpulist(pin_process(cpus))
+
+    url = url.rstrip('/')
+    name = name or socket.gethostname()
+    ses = requests.Session()
+
+    offset, rtt = estimate_clock_offset(lambda: ses.get(url + '/time').json()['t'], n=nping)
+
+    rr = ses.post(url + '/register', data=json.dumps(dict(name=name)))
+    if not rr.ok:
+        raise RuntimeError(rr.json().get('error', 'Failed to register'))
+    agent_id = rr.json()['agent_id']
+
+    job = pickle.loads(ses.get(url + '/job', params=dict(agent=agent_id)).content)
+
+    if prepare is None:
+        run = _prepare_tile_reads(job.urls, cpus=cpus, **job.run_kwargs)
+    else:
+        run = prepare(job.urls, **job.run_kwargs)
+
+    rr = ses.post(url + '/ready', params=dict(agent=agent_id))
+    rr.raise_for_status()
+    t_start = rr.json()['t_start']
+
+    dt = (t_start - offset) - time.time()
+    if dt > 0:
+        time.sleep(dt)
+
+    perf_to_wall = time.time() - t_now()
+    xx = run(job.urls, **job.run_kwargs)
+    xx.clock = SimpleNamespace(name=name,
+                               agent_id=agent_id,
+                               offset=offset,
+                               rtt=rtt,
+                               late=max(0, -dt),
+                               perf_to_wall=perf_to_wall)
+
+    ses.post(url + '/result', params=dict(agent=agent_id), data=pickle.dumps(xx)).raise_for_status()
+    return xx
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_estimate_clock_offset():
+    offset, rtt = estimate_clock_offset(lambda: time.time() + 100, n=3)
+    assert abs(offset - 100) < 0.1
+    assert rtt >= 0
+
+
+def _fake_run(urls, nthreads=1, **kw):
+    import os
+
+    t0 = t_now()
+    stats = [SimpleNamespace(t0=t0 + i*0.01, t_open=0.001, t_total=0.002, chunk_size=10)
+             for i, _ in enumerate(urls)]
+    return SimpleNamespace(stats=stats,
+                           params=SimpleNamespace(nthreads=nthreads, urls=list(urls), pid=os.getpid()),
+                           t0=t0,
+                           t_total=0.1)
+
+
+def _fake_prepare(urls, **kw):
+    # agents take different time to warm up, longer than start delay
+    time.sleep(0.5*int(urls[0][1:]))
+    return _fake_run
+
+
+def test_coordinator_local_agents():
+    import os
+    import multiprocessing
+
+    urls = ['u{}'.format(i) for i in range(10)]
+    ctx = multiprocessing.get_context('spawn')
+
+    coord = Coordinator(urls, 3, run_kwargs=dict(nthreads=2), start_delay=0.2)
+    with coord.serve(host='127.0.0.1', port=0) as url:
+        agents = [ctx.Process(target=run_agent, args=(url,),
+                              kwargs=dict(name='a{}'.format(i), prepare=_fake_prepare, nping=2))
+                  for i in range(3)]
+        for a in agents:
+            a.start()
+        xx = coord.wait(timeout=60)
+        for a in agents:
+            a.join(timeout=30)
+
+    assert all(a.exitcode == 0 for a in agents)
+    pids = set(r.params.pid for r in coord.results.values())
+    assert len(pids) == 3 and os.getpid() not in pids
+
+    assert xx.params.nthreads == 6
+    assert xx.params.agents == 3
+    assert len(xx.stats) == len(urls)
+    assert all(s is not None for s in xx.stats)
+    assert sorted(sum((r.params.urls for r in coord.results.values()), [])) == sorted(urls)
+    # all agents started together after the slowest warmup, after clock correction
+    t0 = [s.t0 for s in xx.stats]
+    assert max(t0) - min(t0) < 0.5
+    assert all(a.late < 0.2 for a in xx.agents)
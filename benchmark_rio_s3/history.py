@@ -0,0 +1,433 @@
+""" Results history across suites
+
+Every suite leaves its own directory of result pickles. This module keeps a
+summary of every run in one SQLite database, so runs from different months,
+machines and library versions can be compared without collecting
+directories by hand.
+
+Ingestion is incremental: a file is only unpickled when its path, size or
+modification time changed since it was last seen. Runs record the
+environment they ran in (`env_info`), results of older versions don't have
+it and have those columns empty.
+"""
+import glob
+import os
+import pickle
+import sqlite3
+import time
+from datetime import datetime
+from types import SimpleNamespace
+import numpy as np
+
+__all__ = ['env_info', 'ingest', 'query', 'gen_history_report', 'show_history']
+
+DEFAULT_DB = os.path.join(os.path.expanduser('~'), '.cache', 'bench-rio-s3', 'history.sqlite')
+
+SCHEMA_VERSION = 1
+
+COLUMNS = (
+    ('path', 'TEXT UNIQUE NOT NULL'),
+    ('mtime', 'REAL'),
+    ('size', 'INTEGER'),
+    ('t_run', 'REAL'),
+    ('run_id', 'TEXT'),
+    ('config', 'TEXT'),
+    ('gdal_opts', 'TEXT'),
+    ('mode', 'TEXT'),
+    ('block', 'TEXT'),
+    ('nthreads', 'INTEGER'),
+    ('nfiles', 'INTEGER'),
+    ('n_bad', 'INTEGER'),
+    ('duration', 'REAL'),
+    ('throughput', 'REAL'),
+    ('throughput_max', 'REAL'),
+    ('t_open_p50', 'REAL'),
+    ('t_open_p90', 'REAL'),
+    ('t_open_p99', 'REAL'),
+    ('t_total_p50', 'REAL'),
+    ('t_total_p90', 'REAL'),
+    ('t_total_p99', 'REAL'),
+    ('latency_p99', 'REAL'),
+    ('peak_rss', 'REAL'),
+    ('gdal', 'TEXT'),
+    ('rasterio', 'TEXT'),
+    ('libcurl', 'TEXT'),
+    ('python', 'TEXT'),
+    ('cpus', 'INTEGER'),
+    ('hostname', 'TEXT'),
+    ('instance_type', 'TEXT'),
+)
+
+# columns runs can be filtered or grouped by
+KEYS = ('nthreads', 'mode', 'block', 'config', 'gdal', 'rasterio', 'libcurl', 'hostname', 'instance_type', 'cpus')
+
+
+def _curl_version():
+    """ Version string of libcurl GDAL is using, e.g. "libcurl/8.4.0 OpenSSL/3.1.4", None if not found
+    """
+    import ctypes
+    import rasterio  # noqa: F401 make sure GDAL and its libcurl are loaded
+
+    try:
+        with open('/proc/self/maps', 'rt') as f:
+            paths = [line.split()[-1] for line in f if 'libcurl' in line]
+        if not paths:
+            return None
+        lib = ctypes.CDLL(paths[0])
+        lib.curl_version.restype = ctypes.c_char_p
+        return lib.curl_version().decode('ascii', 'replace')
+    except (OSError, AttributeError):
+        return None
+
+
+def env_info():
+    """ Software versions and host the benchmark runs on, stored with every result
+    """
+    import platform
+    import socket
+    import rasterio
+    from .s3tools import ec2_metadata
+
+    ec2 = ec2_metadata() or {}
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+    return dict(time=time.time(),
+                gdal=rasterio.__gdal_version__,
+                rasterio=rasterio.__version__,
+                libcurl=_curl_version(),
+                python=platform.python_version(),
+                cpus=cpus,
+                hostname=socket.gethostname(),
+                instance_type=ec2.get('instanceType'))
+
+
+def config_string(params):
+    """ Short description of run settings other than thread count and GDAL options
+    """
+    p = params.__dict__
+    parts = ['mode={}'.format(p.get('mode', 'rio'))]
+    if p.get('bands'):
+        parts.append('bands={}'.format(','.join(p['bands'])))
+    else:
+        parts.append('band={}'.format(p.get('band', 1)))
+    if p.get('bytes_at_open'):
+        parts.append('header={}'.format(p['bytes_at_open']))
+    if p.get('rate'):
+        parts.append('rate={:g}/{}'.format(p['rate'], p.get('arrival')))
+    if p.get('order', 'as-is') != 'as-is':
+        parts.append('order={}'.format(p['order']))
+    for k in ('vsi_cache_size', 'gdal_cachemax', 'overview_level'):
+        if p.get(k) is not None:
+            parts.append('{}={}'.format(k, p[k]))
+    if p.get('out_shape'):
+        parts.append('out={}x{}'.format(p['out_shape'][1], p['out_shape'][0]))
+    if p.get('replay'):
+        parts.append('replay={}'.format(p['replay'].get('timing')))
+    if p.get('tile_cache'):
+        parts.append('cache={}'.format(p.get('cache_pass') or 'as-is'))
+    if p.get('mem_cache_size'):
+        parts.append('mem_cache={}'.format(p['mem_cache_size']))
+    if p.get('affinity') not in (None, 'none'):
+        parts.append('affinity={}'.format(p['affinity']))
+    if p.get('cpus'):
+        parts.append('cpus={}'.format(p['cpus']))
+    return ' '.join(parts)
+
+
+def _gdal_opts_string(params):
+    opts = getattr(params, 'gdal_opts', None) or {}
+    return ';' + ''.join('{}={};'.format(k, v) for k, v in sorted(opts.items()))
+
+
+def _pct(x, pp=(50, 90, 99)):
+    if x is None or len(x) == 0:
+        return [None]*len(pp)
+    return [float(v) for v in np.percentile(x, pp)]
+
+
+def summarise(fname, st):
+    """ Row of the runs table for a result file, None if it can't be loaded
+    """
+    from .reports import unpack_stats
+
+    try:
+        with open(fname, 'rb') as f:
+            xx = pickle.load(f)
+        s = unpack_stats(xx, ms=True)
+    except Exception:
+        return None  # partially written or not a result file
+
+    env = getattr(xx, 'env', None) or {}
+    pp = xx.params
+    t_open = _pct(s.t_open)
+    t_total = _pct(s.t_total)
+
+    return dict(path=fname,
+                mtime=st.st_mtime,
+                size=st.st_size,
+                t_run=env.get('time', st.st_mtime),
+                run_id=getattr(pp, 'run_id', None),
+                config=config_string(pp),
+                gdal_opts=_gdal_opts_string(pp),
+                mode=getattr(pp, 'mode', 'rio'),
+                block='{},{}'.format(*pp.block),
+                nthreads=s.nthreads,
+                nfiles=len(xx.stats),
+                n_bad=s.n_bad,
+                duration=s.duration,
+                throughput=float(s.throughput),
+                throughput_max=float(s.throughput_max),
+                t_open_p50=t_open[0],
+                t_open_p90=t_open[1],
+                t_open_p99=t_open[2],
+                t_total_p50=t_total[0],
+                t_total_p90=t_total[1],
+                t_total_p99=t_total[2],
+                latency_p99=_pct(s.latency)[2],
+                peak_rss=None if s.peak_rss is None else float(s.peak_rss),
+                **{k: env.get(k) for k in ('gdal', 'rasterio', 'libcurl', 'python',
+                                           'cpus', 'hostname', 'instance_type')})
+
+
+def connect(db=DEFAULT_DB):
+    dirname = os.path.dirname(db)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+    conn = sqlite3.connect(db)
+    conn.row_factory = sqlite3.Row
+    if conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+        conn.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, {})'.format(
+            ', '.join('{} {}'.format(k, t) for k, t in COLUMNS)))
+        conn.execute('CREATE INDEX IF NOT EXISTS runs_t_run ON runs (t_run)')
+        conn.execute('PRAGMA user_version = {:d}'.format(SCHEMA_VERSION))
+        conn.commit()
+    return conn
+
+
+def find_results(dirs, filter='*__*.pickle'):
+    """ Result pickles in dirs and their sub-directories, warmup runs of older versions excluded
+    """
+    for d in dirs:
+        for fname in glob.iglob(os.path.join(d, '**', filter), recursive=True):
+            if not os.path.basename(fname).startswith('WRM'):
+                yield os.path.abspath(fname)
+
+
+def ingest(dirs, db=DEFAULT_DB):
+    """ Add runs from result directories to the history database
+
+    Files already ingested are skipped unless they changed on disk.
+
+    Returns SimpleNamespace(nfiles, nnew, nupdated, nskipped, nbad, t_total)
+    """
+    t0 = time.time()
+    conn = connect(db)
+    seen = {r['path']: (r['mtime'], r['size']) for r in conn.execute('SELECT path, mtime, size FROM runs')}
+
+    rows = []
+    nfiles = nbad = nupdated = 0
+    for fname in find_results(dirs):
+        nfiles += 1
+        st = os.stat(fname)
+        old = seen.get(fname)
+        if old == (st.st_mtime, st.st_size):
+            continue
+        row = summarise(fname, st)
+        if row is None:
+            nbad += 1
+            continue
+        nupdated += old is not None
+        rows.append(row)
+
+    if rows:
+        names = [k for k, _ in COLUMNS]
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO runs ({}) VALUES ({})'.format(
+                ', '.join(names), ', '.join('?'*len(names))),
+                [[r[k] for k in names] for r in rows])
+    conn.close()
+
+    return SimpleNamespace(nfiles=nfiles,
+                           nnew=len(rows) - nupdated,
+                           nupdated=nupdated,
+                           nskipped=nfiles - len(rows) - nbad,
+                           nbad=nbad,
+                           t_total=time.time() - t0)
+
+
+def query(db=DEFAULT_DB, gdal_opts=(), since=None, **filters):
+    """ Runs matching all filters, oldest first
+
+    gdal_opts -- [(key, value)], runs that had these GDAL options set
+    since     -- None| unix time, only runs after that
+    filters   -- column=value, column is one of `KEYS`
+
+    Returns list of SimpleNamespace with fields named after table columns
+    """
+    where, args = [], []
+    for k, v in filters.items():
+        if k not in KEYS:
+            raise ValueError('Can not filter by: {}, only know: {}'.format(k, ','.join(KEYS)))
+        if v is not None:
+            where.append('{} = ?'.format(k))
+            args.append(v)
+    for k, v in gdal_opts:
+        where.append("gdal_opts LIKE ? ESCAPE '\\'")
+        args.append('%;{}={};%'.format(k, v).replace('_', '\\_'))
+    if since is not None:
+        where.append('t_run >= ?')
+        args.append(since)
+
+    conn = connect(db)
+    sql = 'SELECT * FROM runs{} ORDER BY t_run'.format(' WHERE ' + ' AND '.join(where) if where else '')
+    rows = [SimpleNamespace(**dict(r)) for r in conn.execute(sql, args)]
+    conn.close()
+    return rows
+
+
+def group_runs(rows, by='nthreads'):
+    """ Split runs into series: value of column `by` -> [runs], oldest first
+    """
+    if by not in KEYS:
+        raise ValueError('Can not group by: {}, only know: {}'.format(by, ','.join(KEYS)))
+    groups = {}
+    for r in rows:
+        groups.setdefault(getattr(r, by), []).append(r)
+    return groups
+
+
+def _fmt_time(t):
+    return datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M')
+
+
+def _fmt(v, fmt='{:.1f}'):
+    return '-' if v is None else fmt.format(v)
+
+
+def gen_history_report(rows, by='nthreads'):
+    if len(rows) == 0:
+        return 'No matching runs'
+
+    lines = ['{:16s} {:>4s} {:>9s} {:>8s} {:>8s} {:>5s}  {:12s} {:8s} {}'.format(
+        'when', 'thr', 'files/s', 'p50 ms', 'p99 ms', 'bad', 'host', 'gdal', 'config')]
+    for r in rows:
+        lines.append('{:16s} {:4d} {:9.1f} {:>8s} {:>8s} {:5d}  {:12s} {:8s} {}'.format(
+            _fmt_time(r.t_run), r.nthreads, r.throughput, _fmt(r.t_total_p50), _fmt(r.t_total_p99), r.n_bad,
+            (r.instance_type or r.hostname or '-')[:12], r.gdal or '-', r.config))
+
+    lines += ['', '{:>16s} {:>5s} {:>9s} {:>9s} {:>9s}  {:16s}  {:16s}'.format(
+        by, 'runs', 'median', 'min', 'max', 'first', 'last').rstrip()]
+    for k, runs in sorted(group_runs(rows, by).items(), key=lambda kv: str(kv[0])):
+        fps = [r.throughput for r in runs]
+        lines.append('{:>16s} {:5d} {:9.1f} {:9.1f} {:9.1f}  {:16s}  {:16s}'.format(
+            str(k)[:16], len(runs), np.median(fps), min(fps), max(fps),
+            _fmt_time(runs[0].t_run), _fmt_time(runs[-1].t_run)).rstrip())
+
+    return '\n'.join(lines)
+
+
+def format_ingest(rr):
+    return ('Ingested {:,d} new and {:,d} changed runs, {:,d} unchanged, {:,d} unreadable,'
+            ' {:,d} files in {:.1f}s').format(rr.nnew, rr.nupdated, rr.nskipped, rr.nbad, rr.nfiles, rr.t_total)
+
+
+def show_history(db=DEFAULT_DB, dirs=(), gdal_opts=(), since=None, by='nthreads', plot=None, log=print, **filters):
+    """ Add result directories to the history, then report runs matching filters
+
+    since -- None| date as YYYY-MM-DD
+    plot  -- None| file name to save plot of throughput over time to
+
+    Returns matching rows, see `query`
+    """
+    from datetime import datetime
+
+    if dirs:
+        log(format_ingest(ingest(dirs, db=db)))
+
+    if since is not None:
+        try:
+            since = datetime.strptime(since, '%Y-%m-%d').timestamp()
+        except ValueError:
+            raise ValueError('Expect date as YYYY-MM-DD, got: {}'.format(since))
+
+    rows = query(db, gdal_opts=gdal_opts, since=since, **filters)
+    log(gen_history_report(rows, by=by))
+
+    if plot is not None and rows:
+        from matplotlib import pyplot as plt
+        from .plots import plot_history
+
+        fig = plt.figure(figsize=(12, 6))
+        plot_history(fig, group_runs(rows, by), by=by)
+        fig.savefig(plot)
+        log('Saved plot to: {}'.format(plot))
+
+    return rows
+
+#######################################
+# unit tests below
+#######################################
+
+
+def _fake_result(nthreads, fps, env=None, gdal_opts=None):
+    n = 20
+    stats = [SimpleNamespace(t0=i/fps, t_open=0.01, t_total=0.02, chunk_size=1000) for i in range(n)]
+    params = SimpleNamespace(nthreads=nthreads, block=(1, 2), band=1, mode='rio',
+                             gdal_opts=dict(gdal_opts or {}, VSI_CACHE=True))
+    xx = SimpleNamespace(stats=stats, params=params, t_total=n/fps)
+    if env is not None:
+        xx.env = env
+    return xx
+
+
+def test_history(tmpdir):
+    db = str(tmpdir/'history.sqlite')
+    rdir = tmpdir/'suite'/'2020'
+    rdir.ensure(dir=True)
+
+    env = dict(time=1000.0, gdal='3.0.4', rasterio='1.1.5', libcurl='libcurl/7.68.0', python='3.8.2',
+               cpus=8, hostname='h1', instance_type='m5.2xlarge')
+    for i, (nthreads, fps) in enumerate([(4, 40), (8, 80), (8, 90)]):
+        with open(str(rdir/'rio_1_2B1__{:02d}_{:03d}.pickle'.format(nthreads, i + 1)), 'wb') as f:
+            pickle.dump(_fake_result(nthreads, fps, dict(env, time=1000.0 + i),
+                                     gdal_opts=dict(GDAL_HTTP_MULTIPLEX='YES') if i == 2 else None), f)
+    with open(str(rdir/'rio_1_2B1__16_001.pickle'), 'wb') as f:
+        pickle.dump(_fake_result(16, 100), f)  # older result, no env
+    with open(str(rdir/'bad_1_2B1__01_001.pickle'), 'wb') as f:
+        f.write(b'not a pickle')
+
+    rr = ingest([str(tmpdir/'suite')], db=db)
+    assert (rr.nfiles, rr.nnew, rr.nupdated, rr.nskipped, rr.nbad) == (5, 4, 0, 0, 1)
+    assert 'Ingested 4 new' in format_ingest(rr)
+
+    rr = ingest([str(tmpdir/'suite')], db=db)
+    assert (rr.nnew, rr.nupdated, rr.nskipped) == (0, 0, 4)
+
+    fname = str(rdir/'rio_1_2B1__04_001.pickle')
+    with open(fname, 'wb') as f:
+        pickle.dump(_fake_result(4, 50, env), f)
+    rr = ingest([str(tmpdir/'suite')], db=db)
+    assert (rr.nnew, rr.nupdated, rr.nskipped) == (0, 1, 3)
+
+    rows = query(db)
+    assert len(rows) == 4
+    assert rows[-1].gdal is None and rows[-1].nthreads == 16
+
+    rows = query(db, nthreads=8, gdal='3.0.4')
+    assert len(rows) == 2 and rows[0].throughput < rows[1].throughput
+    assert rows[0].config == 'mode=rio band=1'
+
+    rows = query(db, gdal_opts=[('GDAL_HTTP_MULTIPLEX', 'YES')])
+    assert len(rows) == 1 and rows[0].path.endswith('__08_003.pickle')
+    assert query(db, gdal_opts=[('GDAL_HTTP_MULTIPLEX', 'NO')]) == []
+    assert len(query(db, since=1001.5)) == 2  # last one and result without env (file time)
+
+    report = gen_history_report(query(db, instance_type='m5.2xlarge'), by='gdal')
+    assert 'm5.2xlarge' in report and '3.0.4' in report
+    assert gen_history_report([]) == 'No matching runs'
+
+
+def test_env_info():
+    env = env_info()
+    assert env['gdal'] and env['rasterio'] and env['cpus'] >= 1
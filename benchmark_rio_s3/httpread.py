@@ -0,0 +1,464 @@
+""" Read GeoTIFF tiles with plain python HTTP range requests
+
+No GDAL or libcurl involved: the header is fetched with one range request and
+the first IFD is parsed in python, then every tile is one more range request
+decoded with zlib and numpy. Every worker thread keeps one keep-alive
+connection per host, so the connection pool is as large as the thread count.
+S3 requests are signed with `s3tools.s3_get_object_request_maker`, every
+request is signed with current credentials, temporary credentials are
+refreshed as they approach expiry.
+
+Comparing this with `rio` mode separates GDAL/libcurl overhead from S3
+service time.
+
+Only tiled images without compression or with deflate are supported,
+optionally with horizontal differencing predictor, that covers Landsat on
+AWS.
+"""
+import http.client
+import math
+import re
+import struct
+import threading
+import zlib
+from types import SimpleNamespace
+from urllib.parse import urlparse
+import numpy as np
+
+from .parallel import ParallelStreamProc
+from .ordering import reorder
+from .pprio import run_with_retry, apply_affinity
+
+__all__ = ['ParallelHTTPReader', 'parse_tiff_header', 'decode_tile']
+
+_thread_lcl = threading.local()
+
+_TAGS = {256: 'width',
+         257: 'height',
+         258: 'bits_per_sample',
+         259: 'compression',
+         277: 'samples_per_pixel',
+         284: 'planar',
+         317: 'predictor',
+         322: 'tile_width',
+         323: 'tile_height',
+         324: 'tile_offsets',
+         325: 'tile_byte_counts',
+         339: 'sample_format'}
+
+# TIFF field type -> numpy type code, only numeric types are needed
+_FIELD_TYPES = {1: 'u1', 3: 'u2', 4: 'u4', 6: 'i1', 8: 'i2', 9: 'i4',
+                11: 'f4', 12: 'f8', 16: 'u8', 17: 'i8', 18: 'u8'}
+
+DEFAULT_HEADER_SIZE = 16*1024
+
+
+def parse_tiff_header(data, fetch=None):
+    """ Parse first IFD of a tiled TIFF (classic or BigTIFF)
+
+    data  -- bytes from the start of the file
+    fetch -- None| (start, stop) -> bytes, used for parts of the header that
+             are not in `data`, i.e. tile offsets of large images
+
+    Returns SimpleNamespace with image and tile shapes, `dtype`, `nbands`,
+    `compression`, `predictor`, `planar`, `tile_offsets`, `tile_byte_counts`
+    """
+    bo = {b'II': '<', b'MM': '>'}.get(bytes(data[:2]))
+    if bo is None:
+        raise ValueError('File is not recognized as a supported file format (not a TIFF)')
+
+    def get(start, stop):
+        if stop <= len(data):
+            return data[start:stop]
+        if fetch is None:
+            raise ValueError('TIFF header is larger than {:d} bytes'.format(len(data)))
+        return fetch(start, stop)
+
+    magic, = struct.unpack(bo + 'H', data[2:4])
+    if magic == 42:
+        ifd_offset, = struct.unpack(bo + 'I', data[4:8])
+        count_fmt, entry_fmt, inline = 'H', 'HHII', 4
+    elif magic == 43:
+        ifd_offset, = struct.unpack(bo + 'Q', data[8:16])
+        count_fmt, entry_fmt, inline = 'Q', 'HHQQ', 8
+    else:
+        raise ValueError('File is not recognized as a supported file format (bad TIFF magic)')
+
+    count_size = struct.calcsize(count_fmt)
+    entry_size = struct.calcsize(bo + entry_fmt)
+    n, = struct.unpack(bo + count_fmt, get(ifd_offset, ifd_offset + count_size))
+    entries = get(ifd_offset + count_size, ifd_offset + count_size + n*entry_size)
+
+    tags = {}
+    for i in range(n):
+        tag, ftype, count, value = struct.unpack_from(bo + entry_fmt, entries, i*entry_size)
+        name = _TAGS.get(tag)
+        if name is None or ftype not in _FIELD_TYPES:
+            continue
+        dtype = np.dtype(bo + _FIELD_TYPES[ftype])
+        nbytes = dtype.itemsize*count
+        if nbytes <= inline:
+            start = i*entry_size + entry_size - inline
+            buf = entries[start:start + nbytes]
+        else:
+            buf = get(value, value + nbytes)
+        tags[name] = np.frombuffer(buf, dtype=dtype, count=count)
+
+    if 'tile_offsets' not in tags:
+        raise ValueError('Only tiled TIFF images are supported')
+
+    def scalar(name, default):
+        return int(tags[name][0]) if name in tags else default
+
+    bits = scalar('bits_per_sample', 1)
+    kind = {1: 'u', 2: 'i', 3: 'f'}.get(scalar('sample_format', 1))
+    if kind is None or bits % 8 != 0:
+        raise ValueError('Unsupported pixel type: {} bits, sample format {}'.format(
+            bits, scalar('sample_format', 1)))
+
+    return SimpleNamespace(width=scalar('width', 0),
+                           height=scalar('height', 0),
+                           tile_width=scalar('tile_width', 0),
+                           tile_height=scalar('tile_height', 0),
+                           nbands=scalar('samples_per_pixel', 1),
+                           planar=scalar('planar', 1),
+                           compression=scalar('compression', 1),
+                           predictor=scalar('predictor', 1),
+                           dtype=np.dtype(bo + kind + str(bits//8)),
+                           tile_offsets=tags['tile_offsets'].astype('uint64'),
+                           tile_byte_counts=tags['tile_byte_counts'].astype('uint64'))
+
+
+def decode_tile(raw, info):
+    """ Compressed tile bytes -> ndarray (tile_height, tile_width, samples)
+    """
+    if info.compression == 1:
+        data = raw
+    elif info.compression in (8, 32946):
+        data = zlib.decompress(raw)
+    else:
+        raise ValueError('Can not decode compression={}, only none and deflate are supported'.format(
+            info.compression))
+
+    spp = info.nbands if info.planar == 1 else 1
+    tile = np.frombuffer(data, dtype=info.dtype).reshape(info.tile_height, info.tile_width, spp)
+
+    if info.predictor == 2:
+        tile = np.cumsum(tile, axis=1, dtype=info.dtype)
+    elif info.predictor != 1:
+        raise ValueError('Can not decode predictor={}'.format(info.predictor))
+
+    return tile
+
+
+def _connection(scheme, netloc, timeout):
+    conns = getattr(_thread_lcl, 'conns', None)
+    if conns is None:
+        conns = _thread_lcl.conns = {}
+
+    conn = conns.get((scheme, netloc))
+    if conn is None:
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        conn = conns[(scheme, netloc)] = cls(netloc, timeout=timeout)
+    return conn
+
+
+def _drop_connection(scheme, netloc):
+    conn = _thread_lcl.conns.pop((scheme, netloc), None)
+    if conn is not None:
+        conn.close()
+
+
+def http_get(url, headers, timeout=30, with_size=False):
+    """ GET on a keep-alive connection owned by the calling thread
+
+    Stale connections (closed by the server while idle) are re-opened once.
+
+    Returns body, or (body, size of the whole object) when `with_size` is set
+    """
+    u = urlparse(url)
+    path = u.path + ('?' + u.query if u.query else '')
+
+    for attempt in (1, 2):
+        conn = _connection(u.scheme, u.netloc, timeout)
+        try:
+            conn.request('GET', path, headers=headers)
+            resp = conn.getresponse()
+            body = resp.read()
+        except (http.client.RemoteDisconnected,
+                http.client.CannotSendRequest,
+                ConnectionResetError,
+                BrokenPipeError):
+            _drop_connection(u.scheme, u.netloc)
+            if attempt == 2:
+                raise
+            continue
+        except Exception:
+            _drop_connection(u.scheme, u.netloc)
+            raise
+
+        if resp.status not in (200, 206):
+            raise IOError('HTTP response code: {} for {}'.format(resp.status, url))
+        if with_size:
+            total = (resp.getheader('Content-Range') or '').rpartition('/')[2]
+            return body, int(total) if total.isdigit() else len(body)
+        return body
+
+
+def url_fetcher(url, get_request_maker=None, timeout=30, with_size=False):
+    """ Returns function (start, stop) -> bytes for s3:// or http(s):// url
+
+    get_request_maker -- () -> S3 request builder, only needed for s3:// urls
+    """
+    if url.startswith('s3://'):
+        build_request = get_request_maker()
+
+        def fetch(start, stop):
+            req = build_request(url=url, Range=(start, stop))
+            return http_get(req.full_url, dict(req.header_items()), timeout=timeout, with_size=with_size)
+    elif url.startswith(('http://', 'https://')):
+        def fetch(start, stop):
+            return http_get(url, {'Range': 'bytes={}-{}'.format(start, stop - 1)},
+                            timeout=timeout, with_size=with_size)
+    else:
+        raise ValueError('Only s3:// and http(s):// urls are supported, not: {}'.format(url))
+    return fetch
+
+
+class TiffTiles(object):
+    """Just enough of `rasterio.DatasetReader` interface to read whole tiles:
+    `name`, `block_window`, `block_size` and `read`.
+    """
+    def __init__(self, url, info, fetch):
+        self.name = url
+        self._info = info
+        self._fetch = fetch
+        self._ntiles = (math.ceil(info.height/info.tile_height),
+                        math.ceil(info.width/info.tile_width))
+
+    def _tile_index(self, band, row, col):
+        ny, nx = self._ntiles
+        if not (0 <= row < ny and 0 <= col < nx):
+            raise ValueError('Block {},{} is outside of the image'.format(row, col))
+        idx = row*nx + col
+        if self._info.planar == 2:
+            idx += (band - 1)*ny*nx
+        return idx
+
+    def block_window(self, band, row, col):
+        """ ((row_start, row_stop), (col_start, col_stop))
+        """
+        info = self._info
+        r0, c0 = row*info.tile_height, col*info.tile_width
+        return ((r0, min(r0 + info.tile_height, info.height)),
+                (c0, min(c0 + info.tile_width, info.width)))
+
+    def block_size(self, band, row, col):
+        return int(self._info.tile_byte_counts[self._tile_index(band, row, col)])
+
+    def get_tag_item(self, name, ns=None, bidx=1):
+        """ Only BLOCK_OFFSET_<col>_<row> and BLOCK_SIZE_<col>_<row> from 'TIFF' namespace
+        """
+        m = re.match(r'^BLOCK_(OFFSET|SIZE)_(\d+)_(\d+)$', name)
+        if ns != 'TIFF' or m is None:
+            return None
+        idx = self._tile_index(bidx, int(m.group(3)), int(m.group(2)))
+        vv = self._info.tile_offsets if m.group(1) == 'OFFSET' else self._info.tile_byte_counts
+        return str(int(vv[idx]))
+
+    def read(self, band, window, out):
+        """ Read one whole tile, window has to be one returned by `block_window`
+
+        `out` is either window sized, or tile sized: for edge tiles that
+        cross the image boundary it then also gets the tile's padding past
+        the edge, as stored in the file.
+        """
+        info = self._info
+        (r0, r1), (c0, c1) = window
+        if r0 % info.tile_height or c0 % info.tile_width:
+            raise ValueError('Window has to be aligned to tiles')
+        if not 1 <= band <= info.nbands:
+            raise ValueError('No band {} in {}'.format(band, self.name))
+
+        idx = self._tile_index(band, r0//info.tile_height, c0//info.tile_width)
+        offset, size = int(info.tile_offsets[idx]), int(info.tile_byte_counts[idx])
+        tile = decode_tile(self._fetch(offset, offset + size), info)[..., band - 1 if info.planar == 1 else 0]
+
+        if out.shape == tile.shape:
+            out[...] = tile
+        elif out.shape == (r1 - r0, c1 - c0):
+            out[...] = tile[:r1 - r0, :c1 - c0]
+        else:
+            raise ValueError('Output of shape {} does not fit block of {}x{} pixels (tile {}x{})'.format(
+                out.shape, r1 - r0, c1 - c0, *tile.shape))
+        return out
+
+
+class ParallelHTTPReader(object):
+    """Drop-in replacement for `ParallelReader.process` that reads tiles with
+    python HTTP range requests instead of GDAL.
+
+    Urls can be `s3://bucket/key` (signed unless `aws_unsigned`, sent to
+    `endpoint_url` if supplied) or plain `http(s)://` urls.
+    """
+    @staticmethod
+    def _process_file_stream(src_stream,
+                             on_file_cbk,
+                             get_request_maker,
+                             header_size=DEFAULT_HEADER_SIZE,
+                             http_timeout=30,
+                             timer=None,
+                             retry=None,
+                             on_error=None,
+                             lookup=None):
+
+        def proc(url, userdata, t0):
+            fetch = url_fetcher(url, get_request_maker, timeout=http_timeout)
+            f = TiffTiles(url, parse_tiff_header(fetch(0, header_size), fetch), fetch)
+            if timer is not None:
+                on_file_cbk(f, userdata, t0=t0)
+            else:
+                on_file_cbk(f, userdata)
+
+        for userdata, url in src_stream:
+            if lookup is not None and lookup(userdata, url):
+                continue
+            run_with_retry(proc, url, userdata, timer=timer, retry=retry, on_error=on_error)
+
+    def __init__(self, nthreads,
+                 region_name=None,
+                 bytes_at_open=None,
+                 aws_unsigned=False,
+                 retry=None,
+                 endpoint_url=None,
+                 http_timeout=30,
+                 affinity=None):
+        self._nthreads = nthreads
+        self._pstream = ParallelStreamProc(nthreads)
+        self._affinity = apply_affinity(self._pstream, affinity, nthreads)
+        self._process_files = self._pstream.bind(ParallelHTTPReader._process_file_stream)
+        self._region_name = region_name
+        self._aws_unsigned = aws_unsigned
+        self._endpoint_url = endpoint_url
+        self._header_size = int(bytes_at_open) if bytes_at_open else DEFAULT_HEADER_SIZE
+        self._http_timeout = http_timeout
+        self._retry = retry
+        self._lock = threading.Lock()
+        self._build_request = None
+
+    def _request_maker(self):
+        """ S3 request signer, created on first use, so that plain http urls
+        work without AWS credentials or region
+        """
+        from .s3tools import s3_get_object_request_maker, auto_find_region
+
+        with self._lock:
+            if self._build_request is None:
+                region_name = self._region_name
+                if region_name is None:
+                    region_name = 'us-east-1' if self._endpoint_url else auto_find_region()
+                self._build_request = s3_get_object_request_maker(region_name,
+                                                                  endpoint_url=self._endpoint_url,
+                                                                  unsigned=self._aws_unsigned)
+            return self._build_request
+
+    @property
+    def gdal_opts(self):
+        """ No GDAL involved, always empty
+        """
+        return {}
+
+    @property
+    def tile_cache(self):
+        """ Decoded tiles are not cached in http mode, always None
+        """
+        return None
+
+    @property
+    def affinity(self):
+        return self._affinity
+
+    def warmup(self, action=None):
+        def _warmup():
+            if action:
+                action()
+
+        return self._pstream.broadcast(_warmup)
+
+    def thread_ids(self):
+        return self._pstream.thread_ids()
+
+    def shutdown(self):
+        self._pstream.shutdown()
+
+    def queue_depth(self):
+        return self._pstream.queue_depth()
+
+    def process(self, stream, cbk, timer=None, on_error=None, on_blocked=None, order=None, lookup=None):
+        """ Same as `ParallelReader.process`, except `cbk` receives `TiffTiles`
+        """
+        process_files = self._process_files
+        if on_blocked is not None:
+            process_files = self._pstream.bind(ParallelHTTPReader._process_file_stream, on_blocked=on_blocked)
+
+        process_files(reorder(stream, order), cbk,
+                      self._request_maker,
+                      header_size=self._header_size,
+                      http_timeout=self._http_timeout,
+                      timer=timer,
+                      retry=self._retry,
+                      on_error=on_error,
+                      lookup=lookup)
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_http_reader(tmpdir):
+    import pytest
+    import rasterio
+    from .httpserve import serve_dir
+
+    (tmpdir/'bucket').mkdir()
+    rng = np.random.RandomState(3)
+    images = {}
+    for name, opts in [('deflate.tif', dict(compress='deflate', predictor=2)),
+                       ('raw.tif', dict(BIGTIFF='YES')),
+                       ('planar.tif', dict(compress='deflate', interleave='band', count=2))]:
+        opts = dict(opts)
+        count = opts.pop('count', 1)
+        im = rng.randint(0, 4000, size=(count, 100, 80)).astype('uint16')
+        with rasterio.open(str(tmpdir/'bucket'/name), 'w', driver='GTiff', width=80, height=100,
+                           count=count, dtype='uint16', tiled=True, blockxsize=32, blockysize=32,
+                           **opts) as f:
+            f.write(im)
+        images[name] = im
+
+    with serve_dir(str(tmpdir)) as base_url:
+        rdr = ParallelHTTPReader(2, aws_unsigned=True, endpoint_url=base_url)
+        urls = ['s3://bucket/deflate.tif', base_url + '/bucket/raw.tif', base_url + '/bucket/planar.tif',
+                base_url + '/bucket/missing.tif']
+        out = np.zeros((len(urls), 32, 16), dtype='uint16')
+        errors = []
+
+        def on_file(f, idx):
+            band = 2 if idx == 2 else 1
+            win = f.block_window(band, 1, 2)
+            assert f.block_size(band, 1, 2) > 0
+            assert f.get_tag_item('BLOCK_SIZE_2_1', 'TIFF', bidx=band) == str(f.block_size(band, 1, 2))
+            f.read(band, window=win, out=out[idx])
+
+            # edge tile into a tile sized buffer, padding included
+            full = np.zeros((32, 32), dtype='uint16')
+            f.read(band, window=win, out=full)
+            assert (full[:, :16] == out[idx]).all()
+            with pytest.raises(ValueError):
+                f.read(band, window=win, out=full[:, :20])
+
+        rdr.process(enumerate(urls), on_file, on_error=lambda idx, url, err: errors.append(err.kind))
+
+    assert (out[0] == images['deflate.tif'][0, 32:64, 64:80]).all()
+    assert (out[1] == images['raw.tif'][0, 32:64, 64:80]).all()
+    assert (out[2] == images['planar.tif'][1, 32:64, 64:80]).all()
+    assert errors == ['not_found']
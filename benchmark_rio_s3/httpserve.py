@@ -0,0 +1,185 @@
+""" Minimal local HTTP server with support for Range requests
+
+GDAL's `/vsicurl/` driver relies on range requests, python's built-in
+`SimpleHTTPRequestHandler` ignores `Range:` header, so we need our own handler
+to serve local files to GDAL over HTTP.
+"""
+import re
+import os
+import threading
+from contextlib import contextmanager
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from functools import partial
+
+__all__ = ['serve_dir', 'serve_dir_process', 'parse_range']
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(s, size):
+    """ Parse `Range:` header value
+
+    Returns (start, stop) half open interval, or None if range is not
+    satisfiable. Only single range requests are supported.
+    """
+    if s is None:
+        return (0, size)
+
+    m = _RANGE_RE.match(s.strip())
+    if m is None:
+        return None
+
+    start, end = m.groups()
+    if start == '':
+        if end == '':
+            return None
+        start, stop = max(0, size - int(end)), size
+    else:
+        start = int(start)
+        stop = size if end == '' else min(int(end) + 1, size)
+
+    if start >= stop:
+        return None
+
+    return (start, stop)
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, without this small responses
+    # on keep-alive connections stall for the client's delayed ACK (~40ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_bytes(self, size, get_data, head_only=False):
+        """ Respond to GET/HEAD honouring `Range:` header
+
+        get_data: (start, stop) -> bytes
+        """
+        rng = self.headers.get('Range')
+        roi = parse_range(rng, size)
+
+        if roi is None:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(size))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start, stop = roi
+        self.send_response(200 if rng is None else 206)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(stop - start))
+        if rng is not None:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, stop - 1, size))
+        self.end_headers()
+
+        if not head_only:
+            self.wfile.write(get_data(start, stop))
+
+    def _serve_file(self, head_only):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, 'File not found')
+            return
+
+        def get_data(start, stop):
+            with open(path, 'rb') as f:
+                f.seek(start)
+                return f.read(stop - start)
+
+        self.send_bytes(os.path.getsize(path), get_data, head_only=head_only)
+
+    def do_GET(self):
+        self._serve_file(head_only=False)
+
+    def do_HEAD(self):
+        self._serve_file(head_only=True)
+
+
+@contextmanager
+def run_server(handler, host='127.0.0.1', port=0):
+    """ Run http server in a background thread, yields base url
+    """
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield 'http://{}:{}'.format(*httpd.server_address[:2])
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join()
+
+
+def serve_dir(directory, host='127.0.0.1', port=0):
+    """ Serve files from a local directory over HTTP with Range support
+
+    ```
+    with serve_dir('/tmp/data') as base_url:
+        rasterio.open(base_url + '/some.tif')
+    ```
+    """
+    handler = partial(RangeRequestHandler, directory=str(directory))
+    return run_server(handler, host=host, port=port)
+
+
+def _run_dir_server(directory, host, port, conn):
+    with serve_dir(directory, host=host, port=port) as base_url:
+        conn.send(base_url)
+        conn.recv()
+
+
+@contextmanager
+def serve_dir_process(directory, host='127.0.0.1', port=0):
+    """ Same as `serve_dir`, but server runs in a spawned process
+
+    Use when timing GDAL reads against the server: a server thread in the
+    measured process competes with GDAL workers for the GIL and CPU.
+    """
+    import multiprocessing as mp
+
+    ctx = mp.get_context('spawn')
+    conn, child_conn = ctx.Pipe()
+    proc = ctx.Process(target=_run_dir_server,
+                       args=(str(directory), host, port, child_conn),
+                       daemon=True)
+    proc.start()
+    try:
+        yield conn.recv()
+    finally:
+        conn.send(None)
+        proc.join(5)
+        if proc.is_alive():
+            proc.terminate()
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_parse_range():
+    assert parse_range(None, 10) == (0, 10)
+    assert parse_range('bytes=0-3', 10) == (0, 4)
+    assert parse_range('bytes=5-', 10) == (5, 10)
+    assert parse_range('bytes=-3', 10) == (7, 10)
+    assert parse_range('bytes=8-100', 10) == (8, 10)
+    assert parse_range('bytes=10-', 10) is None
+    assert parse_range('lines=1-2', 10) is None
+
+
+def test_serve_dir_process(tmpdir):
+    from urllib.request import Request, urlopen
+
+    with open(str(tmpdir/'a.bin'), 'wb') as f:
+        f.write(bytes(range(100)))
+
+    with serve_dir_process(tmpdir) as base_url:
+        with urlopen(Request(base_url + '/a.bin', headers={'Range': 'bytes=10-19'})) as r:
+            assert r.status == 206
+            assert r.read() == bytes(range(10, 20))
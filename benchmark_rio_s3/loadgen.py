@@ -0,0 +1,115 @@
+""" Open-loop load generation: issue reads at a fixed arrival rate
+
+In the default closed-loop mode every worker picks up the next url as soon as
+the previous one is done, so request rate adapts to latency and queueing delay
+is never observed. In open-loop mode urls are released into the work queue
+according to an arrival schedule, independent of how fast they are processed.
+"""
+import threading
+import time
+from timeit import default_timer as t_now
+import numpy as np
+
+__all__ = ['arrival_times', 'zipf_urls', 'PacedSource']
+
+ARRIVALS = ('constant', 'poisson')
+
+
+def arrival_times(n, rate, process='constant', seed=None):
+    """ Offsets in seconds from the start of the run for `n` arrivals
+
+    constant -- evenly spaced, 1/rate apart
+    poisson  -- exponentially distributed gaps with mean 1/rate
+    """
+    if rate <= 0:
+        raise ValueError('Rate has to be positive')
+
+    if process == 'constant':
+        return np.arange(n)/rate
+    elif process == 'poisson':
+        rng = np.random.RandomState(seed)
+        gaps = rng.exponential(1.0/rate, n)
+        gaps[0] = 0
+        return np.cumsum(gaps)
+
+    raise ValueError('Unknown arrival process: {}, only know: {}'.format(process, ','.join(ARRIVALS)))
+
+
+def zipf_urls(urls, n, s=1.1, seed=0):
+    """ Repeated-access url list: `n` draws from `urls` with Zipf distributed
+    popularity, probability of the k-th most popular url is proportional to
+    1/k**s. Popularity rank is a random permutation of the input, reproducible
+    for the same seed.
+    """
+    rng = np.random.RandomState(seed)
+    p = 1.0/np.arange(1, len(urls) + 1)**s
+    ranked = [urls[i] for i in rng.permutation(len(urls))]
+    return [ranked[i] for i in rng.choice(len(urls), size=n, p=p/p.sum())]
+
+
+class PacedSource(object):
+    """Release (idx, item) pairs at scheduled times with bounded in-flight count
+
+    Iterating blocks until the next scheduled time and until in-flight count
+    drops below `max_inflight`, consumer has to call `done()` once for every
+    item it finished with (successfully or not). Scheduled time of every item is
+    recorded in `t_sched` (`timeit.default_timer` units).
+    """
+    def __init__(self, items, offsets, max_inflight):
+        assert len(items) == len(offsets)
+        self._items = items
+        self._offsets = offsets
+        self._inflight = threading.BoundedSemaphore(max_inflight)
+        self.max_inflight = max_inflight
+        self.t_sched = [None for _ in items]
+
+    def done(self):
+        self._inflight.release()
+
+    def __iter__(self):
+        t_base = t_now()
+        for idx, (item, offset) in enumerate(zip(self._items, self._offsets)):
+            t_sched = t_base + offset
+            dt = t_sched - t_now()
+            if dt > 0:
+                time.sleep(dt)
+            self._inflight.acquire()
+            self.t_sched[idx] = t_sched
+            yield idx, item
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_arrival_times():
+    tt = arrival_times(5, 10)
+    assert np.allclose(tt, [0, 0.1, 0.2, 0.3, 0.4])
+
+    tt = arrival_times(1000, 100, 'poisson', seed=3)
+    assert tt[0] == 0
+    assert (np.diff(tt) >= 0).all()
+    assert abs(tt[-1] - 10) < 2
+
+
+def test_zipf_urls():
+    urls = ['u{}'.format(i) for i in range(100)]
+    zz = zipf_urls(urls, 2000, s=1.2, seed=3)
+    assert len(zz) == 2000
+    assert zz == zipf_urls(urls, 2000, s=1.2, seed=3)
+    assert set(zz) <= set(urls)
+
+    counts = sorted((zz.count(u) for u in set(zz)), reverse=True)
+    assert counts[0] > 10*counts[len(counts)//2]
+
+
+def test_paced_source():
+    src = PacedSource(list('abc'), arrival_times(3, 100), max_inflight=2)
+    out = []
+    for idx, item in src:
+        out.append(item)
+        src.done()
+
+    assert out == list('abc')
+    assert all(t is not None for t in src.t_sched)
+    assert abs((src.t_sched[2] - src.t_sched[0]) - 0.02) < 1e-6
@@ -0,0 +1,191 @@
+""" Background sampling of process-wide resource usage
+"""
+import os
+import threading
+import time
+from timeit import default_timer as t_now
+from types import SimpleNamespace
+import numpy as np
+
+__all__ = ['ProcessMonitor', 'rss_bytes', 'gdal_cache_used', 'gdal_cache_max', 'set_gdal_cache_max']
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+_GDAL = []
+
+
+def rss_bytes():
+    """ Current resident set size of this process, None if not available
+    """
+    try:
+        with open('/proc/self/statm', 'rt') as f:
+            return int(f.read().split()[1])*_PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _gdal_lib():
+    """ ctypes handle of the GDAL library rasterio is using, None if it can't be found
+
+    Rasterio wheels ship their own copy of GDAL, so look for the one already
+    mapped into this process rather than asking the linker.
+    """
+    if _GDAL:
+        return _GDAL[0]
+
+    import ctypes
+    import rasterio  # noqa: F401 make sure GDAL is loaded
+
+    lib = None
+    try:
+        with open('/proc/self/maps', 'rt') as f:
+            paths = [line.split()[-1] for line in f if 'libgdal' in line]
+        if paths:
+            lib = ctypes.CDLL(paths[0])
+            lib.GDALGetCacheUsed64.restype = ctypes.c_int64
+            lib.GDALGetCacheMax64.restype = ctypes.c_int64
+            lib.GDALSetCacheMax64.argtypes = [ctypes.c_int64]
+    except (OSError, AttributeError):
+        lib = None
+
+    _GDAL.append(lib)
+    return lib
+
+
+def gdal_cache_used():
+    """ Bytes currently held by GDAL block cache, None if not available
+    """
+    lib = _gdal_lib()
+    return None if lib is None else lib.GDALGetCacheUsed64()
+
+
+def gdal_cache_max():
+    """ Size limit of GDAL block cache in bytes, None if not available
+    """
+    lib = _gdal_lib()
+    return None if lib is None else lib.GDALGetCacheMax64()
+
+
+def set_gdal_cache_max(nbytes):
+    """ Set size limit of GDAL block cache, process wide
+
+    GDAL reads `GDAL_CACHEMAX` config option only once, the first time block
+    cache is used, so setting it in `rasterio.Env` later has no effect.
+
+    Returns False if GDAL library could not be found
+    """
+    lib = _gdal_lib()
+    if lib is None:
+        return False
+    lib.GDALSetCacheMax64(int(nbytes))
+    return True
+
+
+class ProcessMonitor(object):
+    """Sample process-wide counters from a background thread
+
+    ```
+    with ProcessMonitor(interval=0.1) as mon:
+        do_work()
+    tl = mon.timeline  # SimpleNamespace(t=..., cpu=..., rss=..., gdal_cache=...)
+    ```
+
+    `t` is in `timeit.default_timer` units, `cpu` is cumulative process CPU
+    time (all threads) in seconds, `rss` is resident set size and
+    `gdal_cache` is GDAL block cache usage, both in bytes, NaN where not
+    available.
+    """
+    def __init__(self, interval=0.1):
+        self._interval = interval
+        self._gdal = _gdal_lib() is not None
+        self._stop = threading.Event()
+        self._thread = None
+        self._samples = []
+        self.timeline = None
+
+    def _sample(self):
+        rss = rss_bytes()
+        gdal_cache = gdal_cache_used() if self._gdal else None
+        self._samples.append((t_now(), time.process_time(),
+                              np.nan if rss is None else rss,
+                              np.nan if gdal_cache is None else gdal_cache))
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self._sample()
+
+    def start(self):
+        self._samples = []
+        self._stop.clear()
+        self._sample()
+        self._thread = threading.Thread(target=self._run, name='process-monitor', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+        t, cpu, rss, gdal_cache = np.r_[self._samples].T
+        self.timeline = SimpleNamespace(t=t, cpu=cpu, rss=rss, gdal_cache=gdal_cache,
+                                        interval=self._interval)
+        return self.timeline
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def cpu_utilisation(tl):
+    """ Convert cumulative CPU time samples into utilisation
+
+    Returns (t_mid, cores) -- number of cores busy on average between samples
+    """
+    dt = np.diff(tl.t)
+    dcpu = np.diff(tl.cpu)
+    return (tl.t[1:] + tl.t[:-1])*0.5, dcpu/np.maximum(dt, 1e-9)
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_monitor():
+    with ProcessMonitor(interval=0.01) as mon:
+        t_end = t_now() + 0.1
+        while t_now() < t_end:
+            pass
+
+    tl = mon.timeline
+    assert tl.t.shape == tl.cpu.shape
+    assert tl.t.shape[0] > 2
+    t, cores = cpu_utilisation(tl)
+    assert t.shape[0] == tl.t.shape[0] - 1
+    assert (cores >= 0).all()
+
+    rss = rss_bytes()
+    assert rss is None or rss > 0
+    assert tl.rss.shape == tl.t.shape
+    assert tl.gdal_cache.shape == tl.t.shape
+
+
+def test_gdal_cache():
+    from rasterio.io import MemoryFile
+
+    cache_max = gdal_cache_max()
+    if cache_max is None:
+        return  # not available on this platform
+
+    assert set_gdal_cache_max(64 << 20)
+    assert gdal_cache_max() == 64 << 20
+
+    with MemoryFile() as mem:
+        with mem.open(driver='GTiff', width=256, height=256, count=1, dtype='uint8') as f:
+            f.write(np.ones((256, 256), dtype='uint8'), 1)
+        with mem.open() as f:
+            f.read(1)
+            assert gdal_cache_used() > 0
+
+    set_gdal_cache_max(cache_max)
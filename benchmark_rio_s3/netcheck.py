@@ -0,0 +1,268 @@
+""" Raw network ceilings: request rate and bandwidth without GDAL
+
+When tile throughput plateaus it can be the network (NIC or S3 bandwidth),
+per-request latency or client overhead. Two probes read the same objects as
+the tile benchmark with plain python range GETs (`httpread.http_get`, one
+keep-alive connection per worker thread), dispatched through the same
+`ParallelStreamProc` worker pool tile reads go through:
+
+small -- many small range GETs at random offsets, ceiling on requests per second
+large -- few large GETs walking objects sequentially, ceiling on MB/s
+
+Every probe is calibrated: a short pilot measures the rate, then the probe is
+sized to run for about `seconds`. Tile throughput as a fraction of the two
+ceilings is shown by `reports.gen_stats_report` for runs that recorded them.
+"""
+import json
+import random
+import threading
+from collections import Counter
+from datetime import datetime
+from timeit import default_timer as t_now
+from types import SimpleNamespace
+import numpy as np
+
+from .parallel import ParallelStreamProc
+
+__all__ = ['run_netcheck', 'save_netcheck', 'load_netcheck', 'gen_netcheck_report']
+
+NETCHECK_FILE = 'netcheck.json'
+SMALL_SIZE = 16*1024
+LARGE_SIZE = 16 << 20
+MAX_OBJECTS = 100
+MAX_REQUESTS = dict(small=100000, large=2000)
+
+
+def object_sizes(pstream, urls, get_request_maker):
+    """ url -> size in bytes, urls that fail are left out
+    """
+    from .httpread import url_fetcher
+
+    sizes = {}
+
+    def proc(stream):
+        for url in stream:
+            try:
+                _, sizes[url] = url_fetcher(url, get_request_maker, with_size=True)(0, 1)
+            except Exception:
+                pass
+
+    pstream.bind(proc)(iter(urls))
+    return sizes
+
+
+def small_requests(sizes, n, size=SMALL_SIZE, seed=0):
+    """ `n` (url, start, stop) ranges of `size` bytes at random offsets of random objects
+    """
+    rng = random.Random(seed)
+    urls = sorted(sizes)
+    out = []
+    for _ in range(n):
+        url = rng.choice(urls)
+        start = rng.randint(0, max(sizes[url] - size, 0))
+        out.append((url, start, min(start + size, sizes[url])))
+    return out
+
+
+def large_requests(sizes, n, size=LARGE_SIZE):
+    """ `n` (url, start, stop) ranges of up to `size` bytes, objects are read
+    front to back one after another, starting again from the first one if needed
+    """
+    out = []
+    while len(out) < n:
+        for url in sorted(sizes):
+            for start in range(0, sizes[url], size):
+                out.append((url, start, min(start + size, sizes[url])))
+    return out[:n]
+
+
+def run_probe(pstream, requests, get_request_maker):
+    """ Issue range GETs on the worker pool as fast as possible
+
+    Returns SimpleNamespace(nrequests, nbytes, duration, rps, mbps, p50, p99 (ms), errors)
+    """
+    from .httpread import url_fetcher
+    from .pprio import classify_error
+
+    n = len(requests)
+    t_start = np.zeros(n)
+    t_end = np.zeros(n)
+    nbytes = np.zeros(n, dtype='int64')
+    ok = np.zeros(n, dtype=bool)
+    errors = Counter()
+    lock = threading.Lock()
+
+    def proc(stream):
+        for idx, (url, start, stop) in stream:
+            fetch = url_fetcher(url, get_request_maker)
+            t_start[idx] = t_now()
+            try:
+                nbytes[idx] = len(fetch(start, stop))
+                ok[idx] = True
+            except Exception as e:
+                with lock:
+                    errors[classify_error(e)] += 1
+            t_end[idx] = t_now()
+
+    pstream.bind(proc)(enumerate(requests))
+
+    duration = max(t_end.max() - t_start.min(), 1e-9)
+    latency = (t_end - t_start)[ok]*1000
+    p50, p99 = np.percentile(latency, [50, 99]) if latency.shape[0] else (np.nan, np.nan)
+    return SimpleNamespace(nrequests=int(ok.sum()),
+                           nbytes=int(nbytes.sum()),
+                           duration=duration,
+                           rps=ok.sum()/duration,
+                           mbps=nbytes.sum()/duration/1e6,
+                           p50=float(p50),
+                           p99=float(p99),
+                           errors=dict(errors))
+
+
+def calibrated_probe(pstream, make_requests, get_request_maker, seconds, npilot, nmax):
+    """ Short pilot to measure the rate, then a probe sized to run for about `seconds`
+    """
+    pilot = run_probe(pstream, make_requests(npilot), get_request_maker)
+    n = int(np.clip(pilot.rps*seconds, npilot, nmax))
+    return run_probe(pstream, make_requests(n), get_request_maker)
+
+
+def run_netcheck(urls,
+                 nthreads=32,
+                 seconds=10,
+                 small_size=SMALL_SIZE,
+                 large_size=LARGE_SIZE,
+                 region_name=None,
+                 aws_unsigned=False,
+                 endpoint_url=None,
+                 log=None):
+    """ Measure requests per second and MB/s ceilings
+
+    urls    -- s3:// or http(s):// urls, up to `MAX_OBJECTS` of them are used
+    seconds -- approximate duration of each probe
+    log     -- None| str -> None, called with progress messages
+
+    Returns SimpleNamespace(rps, mbps, small, large, params), where small and
+    large are results of `run_probe`.
+    """
+    from .s3tools import s3_get_object_request_maker, auto_find_region
+
+    bad = [u for u in urls if not u.startswith(('s3://', 'http://', 'https://'))]
+    if bad:
+        raise ValueError('Network check needs s3:// or http(s):// urls, not: {}'.format(bad[0]))
+
+    lock = threading.Lock()
+    maker = []
+
+    def get_request_maker():
+        with lock:
+            if not maker:
+                region = region_name or ('us-east-1' if endpoint_url else auto_find_region())
+                maker.append(s3_get_object_request_maker(region,
+                                                         endpoint_url=endpoint_url,
+                                                         unsigned=aws_unsigned))
+            return maker[0]
+
+    urls = list(urls)
+    if len(urls) > MAX_OBJECTS:
+        urls = random.Random(0).sample(urls, MAX_OBJECTS)
+
+    pstream = ParallelStreamProc(nthreads)
+    try:
+        sizes = object_sizes(pstream, urls, get_request_maker)
+        if not sizes:
+            raise ValueError('Failed to read any of the {:d} objects'.format(len(urls)))
+        if log is not None:
+            log('{:d} objects, {:.1f} MB in total'.format(len(sizes), sum(sizes.values())/1e6))
+
+        small = calibrated_probe(pstream, lambda n: small_requests(sizes, n, small_size),
+                                 get_request_maker, seconds,
+                                 npilot=4*nthreads, nmax=MAX_REQUESTS['small'])
+        if log is not None:
+            log('small: {:.1f} requests per second'.format(small.rps))
+
+        large = calibrated_probe(pstream, lambda n: large_requests(sizes, n, large_size),
+                                 get_request_maker, seconds,
+                                 npilot=nthreads, nmax=MAX_REQUESTS['large'])
+        if log is not None:
+            log('large: {:.1f} MB/s'.format(large.mbps))
+    finally:
+        pstream.shutdown()
+
+    return SimpleNamespace(rps=small.rps,
+                           mbps=large.mbps,
+                           small=small,
+                           large=large,
+                           params=dict(created=datetime.now().isoformat(),
+                                       nthreads=nthreads,
+                                       nobjects=len(sizes),
+                                       small_size=small_size,
+                                       large_size=large_size,
+                                       endpoint_url=endpoint_url))
+
+
+def save_netcheck(nc, fname):
+    with open(fname, 'wt') as f:
+        json.dump(dict(rps=nc.rps,
+                       mbps=nc.mbps,
+                       small=nc.small.__dict__,
+                       large=nc.large.__dict__,
+                       params=nc.params), f, indent=2)
+
+
+def load_netcheck(fname):
+    with open(fname, 'rt') as f:
+        nc = json.load(f)
+    return SimpleNamespace(rps=nc['rps'],
+                           mbps=nc['mbps'],
+                           small=SimpleNamespace(**nc['small']),
+                           large=SimpleNamespace(**nc['large']),
+                           params=nc['params'])
+
+
+def gen_netcheck_report(nc):
+    lines = ['Probe    size  requests       MB    req/s     MB/s    p50     p99 (ms)  errors']
+    for name, p, size in (('small', nc.small, nc.params['small_size']),
+                          ('large', nc.large, nc.params['large_size'])):
+        lines.append('{:5s} {:>7s} {:9,d} {:8.1f} {:8.1f} {:8.1f} {:6.1f} {:7.1f}   {}'.format(
+            name, _fmt_size(size), p.nrequests, p.nbytes/1e6, p.rps, p.mbps, p.p50, p.p99,
+            ','.join('{}:{}'.format(k, v) for k, v in sorted(p.errors.items())) or '-'))
+    lines += ['',
+              'Ceilings with {:d} threads: {:.1f} requests per second, {:.1f} MB/s'.format(
+                  nc.params['nthreads'], nc.rps, nc.mbps)]
+    return '\n'.join(lines)
+
+
+def _fmt_size(n):
+    if n >= 1 << 20:
+        return '{:d}MiB'.format(n >> 20)
+    return '{:d}KiB'.format(n >> 10)
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_netcheck(tmpdir):
+    from .httpserve import serve_dir
+
+    (tmpdir/'bucket').mkdir()
+    rng = np.random.RandomState(0)
+    for i in range(3):
+        (tmpdir/'bucket'/'f{}.bin'.format(i)).write_binary(rng.bytes(200*1024 + i))
+
+    with serve_dir(str(tmpdir)) as base_url:
+        urls = [base_url + '/bucket/f{}.bin'.format(i) for i in range(3)] + [base_url + '/bucket/missing.bin']
+        nc = run_netcheck(urls, nthreads=2, seconds=0.2, small_size=4096, large_size=64*1024)
+
+    assert nc.params['nobjects'] == 3
+    assert nc.rps > 0 and nc.mbps > 0
+    assert nc.small.nbytes == nc.small.nrequests*4096
+    assert nc.large.nrequests >= 2 and not nc.large.errors
+
+    fname = str(tmpdir/'netcheck.json')
+    save_netcheck(nc, fname)
+    assert load_netcheck(fname).rps == nc.rps
+    assert 'Ceilings' in gen_netcheck_report(nc)
+
+    assert large_requests({'a': 10, 'b': 5}, 4, size=4) == [('a', 0, 4), ('a', 4, 8), ('a', 8, 10), ('b', 0, 4)]
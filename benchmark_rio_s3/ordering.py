@@ -0,0 +1,147 @@
+""" Order in which urls are handed to worker threads
+
+Url lists are usually sorted, Landsat lists for example go scene by scene, so
+consecutive reads all hit the same S3 key prefix. Strategies here reorder the
+work to see how much that matters:
+
+as-is      -- input order
+shuffle    -- random permutation, reproducible for the same seed
+interleave -- round-robin across key prefixes (directory of the url)
+size       -- largest objects first, sizes come from a manifest file
+
+Strategy is a function: list of urls -> list of positions in the input, see
+`ParallelReader.process(.., order=)`.
+"""
+import random
+from collections import OrderedDict
+
+__all__ = ['STRATEGIES', 'make_order', 'load_sizes', 'reorder']
+
+STRATEGIES = ('as-is', 'shuffle', 'interleave', 'size')
+
+
+def key_prefix(url, depth=None):
+    """ Directory part of the url, or only the first `depth` components of the key
+    """
+    prefix = url.rsplit('/', 1)[0]
+    if depth is None:
+        return prefix
+
+    scheme, sep, path = prefix.partition('://')
+    if not sep:
+        scheme, path = '', prefix
+    parts = path.split('/')
+    # bucket (host) + depth components of the key
+    return scheme + sep + '/'.join(parts[:depth + 1])
+
+
+def order_shuffle(urls, seed=0):
+    idx = list(range(len(urls)))
+    random.Random(seed).shuffle(idx)
+    return idx
+
+
+def order_interleave(urls, depth=None):
+    groups = OrderedDict()
+    for i, url in enumerate(urls):
+        groups.setdefault(key_prefix(url, depth), []).append(i)
+
+    idx = []
+    queues = [iter(g) for g in groups.values()]
+    while queues:
+        alive = []
+        for q in queues:
+            i = next(q, None)
+            if i is not None:
+                idx.append(i)
+                alive.append(q)
+        queues = alive
+    return idx
+
+
+def order_by_size(urls, sizes):
+    """ Largest first, so that big reads don't end up at the tail of the run
+    keeping one thread busy while others are idle. Urls with unknown size go last.
+    """
+    return sorted(range(len(urls)), key=lambda i: -sizes.get(urls[i], -1))
+
+
+def load_sizes(fname):
+    """ Load url -> size in bytes from a manifest file
+
+    One url per line with size in bytes before or after it, separated by
+    white space or a comma, lines that don't parse are ignored.
+    """
+    sizes = {}
+    with open(fname, 'rt') as f:
+        for line in f:
+            tokens = line.replace(',', ' ').split()
+            if len(tokens) != 2:
+                continue
+            a, b = tokens
+            if a.isdigit():
+                a, b = b, a
+            if b.isdigit():
+                sizes[a] = int(b)
+    return sizes
+
+
+def reorder(stream, order):
+    """ Apply ordering function to a stream of (userdata, url) pairs, None -- keep as is
+    """
+    if order is None:
+        return stream
+    items = list(stream)
+    return [items[i] for i in order([url for _, url in items])]
+
+
+def make_order(strategy, seed=0, sizes=None, depth=None):
+    """ Ordering function for a named strategy, None for 'as-is'
+
+    seed  -- shuffle only
+    sizes -- size only, url -> size in bytes, see `load_sizes`
+    depth -- interleave only, number of key components that make a prefix,
+             default is the full directory
+    """
+    if strategy in (None, 'as-is'):
+        return None
+    if strategy == 'shuffle':
+        return lambda urls: order_shuffle(urls, seed)
+    if strategy == 'interleave':
+        return lambda urls: order_interleave(urls, depth)
+    if strategy == 'size':
+        if sizes is None:
+            raise ValueError('Size ordering needs url sizes')
+        return lambda urls: order_by_size(urls, sizes)
+
+    raise ValueError('Unknown ordering: {}, only know: {}'.format(strategy, ','.join(STRATEGIES)))
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_ordering(tmpdir):
+    urls = ['s3://b/x/1/a.tif', 's3://b/x/1/b.tif', 's3://b/x/1/c.tif',
+            's3://b/x/2/a.tif', 's3://b/y/3/a.tif']
+
+    assert make_order('as-is') is None
+
+    idx = make_order('shuffle', seed=3)(urls)
+    assert sorted(idx) == list(range(len(urls)))
+    assert idx == make_order('shuffle', seed=3)(urls)
+
+    assert make_order('interleave')(urls) == [0, 3, 4, 1, 2]
+    assert make_order('interleave', depth=1)(urls) == [0, 4, 1, 2, 3]
+    assert key_prefix('s3://b/x/1/a.tif', depth=1) == 's3://b/x'
+
+    fname = str(tmpdir/'sizes.txt')
+    with open(fname, 'wt') as f:
+        f.write('s3://b/x/1/a.tif 10\n2000,s3://b/x/2/a.tif\nheader line here\ns3://b/x/1/b.tif 300\n')
+    sizes = load_sizes(fname)
+    assert sizes == {'s3://b/x/1/a.tif': 10, 's3://b/x/2/a.tif': 2000, 's3://b/x/1/b.tif': 300}
+    assert make_order('size', sizes=sizes)(urls) == [3, 1, 0, 2, 4]
+
+    stream = list(enumerate(urls))
+    assert reorder(stream, None) is stream
+    assert reorder(stream, make_order('size', sizes=sizes))[0] == (3, urls[3])
@@ -1,5 +1,7 @@
 import concurrent.futures as fut
+import os
 import queue
+import threading
 import itertools
 from types import SimpleNamespace
 
@@ -136,9 +138,87 @@ class ParallelStreamProc(object):
         return run
 
     def broadcast(self, proc, *args, **kwargs):
-        futures = [worker.submit(proc, *args, *kwargs) for worker in self._workers]
+        futures = [worker.submit(proc, *args, **kwargs) for worker in self._workers]
 
         rr = fut.wait(futures)
         assert len(rr.done) == len(futures)
 
         return [f.result() for f in rr.done]
+
+    def queue_depth(self):
+        """ Number of items waiting in the work queue, 0 when not running
+        """
+        state = self._state
+        return 0 if state is None else state._queue.qsize()
+
+    def thread_ids(self):
+        """ Thread identifiers of worker threads, in worker order
+        """
+        futures = [worker.submit(threading.get_ident) for worker in self._workers]
+        return [f.result() for f in futures]
+
+    def set_affinity(self, cpu_sets):
+        """ Pin worker threads to CPUs, one set of CPUs per worker in worker order
+
+        None in place of a set leaves that worker alone. Linux only
+        (`os.sched_setaffinity`). Returns CPUs every worker is allowed to run on
+        afterwards, see `affinity`.
+        """
+        if len(cpu_sets) != self._nthreads:
+            raise ValueError("Need {} CPU sets, got {}".format(self._nthreads, len(cpu_sets)))
+
+        def pin(cpus):
+            if cpus is not None:
+                os.sched_setaffinity(0, cpus)
+
+        futures = [worker.submit(pin, cpus) for worker, cpus in zip(self._workers, cpu_sets)]
+        for f in futures:
+            f.result()
+
+        return self.affinity()
+
+    def affinity(self):
+        """ Sorted list of CPUs every worker thread is allowed to run on, in worker order
+        """
+        futures = [worker.submit(os.sched_getaffinity, 0) for worker in self._workers]
+        return [sorted(f.result()) for f in futures]
+
+    def shutdown(self):
+        """ Stop worker threads, instance can not be used after this
+        """
+        for worker in self._workers:
+            worker.shutdown(wait=True)
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_parallel_stream_proc():
+    pstream = ParallelStreamProc(4)
+    seen = []
+    lock = threading.Lock()
+
+    def proc(it, scale, offset=0):
+        for v in it:
+            with lock:
+                seen.append((threading.get_ident(), v*scale + offset))
+
+    blocked = []
+    pstream.bind(proc, qmaxsize=2, on_blocked=blocked.append)(range(200), 2, offset=1)
+    assert sorted(v for _, v in seen) == [v*2 + 1 for v in range(200)]
+    assert set(t for t, _ in seen) <= set(pstream.thread_ids())
+    assert pstream.queue_depth() == 0
+
+    del seen[:]
+    pstream.bind(proc, max_workers=1)(range(10), 1)
+    assert len(set(t for t, _ in seen)) == 1
+
+    rr = pstream.broadcast(lambda a, b=0: a + b, 1, b=2)
+    assert rr == [3]*4
+
+    allowed = sorted(os.sched_getaffinity(0))
+    assert pstream.set_affinity([None, {allowed[0]}, None, allowed]) == [allowed, allowed[:1], allowed, allowed]
+    assert sorted(os.sched_getaffinity(0)) == allowed
+
+    pstream.shutdown()
@@ -1,6 +1,7 @@
 from matplotlib import pyplot as plt
 from matplotlib import __version__ as mp_version
 import numpy as np
+import itertools
 from .reports import unpack_stats
 
 
@@ -195,3 +196,106 @@ def plot_comparison(fig, stats, names=None, threshs=None, colors=None, alpha=0.3
                 30, threshs[2])
 
     fig.tight_layout()
+
+
+def plot_load_curve(fig, curve, cc=None):
+    """ Latency percentiles vs offered load, one line per thread count
+
+    curve: output of `reports.load_curve`
+    """
+    if cc is None:
+        if mp_version >= '2.0.0':
+            cc = ['C0', 'C1', 'C2', 'C3', 'C4', 'C5', 'C6']
+        else:
+            cc = ['b', 'g', 'r', 'm', 'c', 'y', 'k']
+
+    ax = fig.add_subplot(1, 1, 1)
+    threads = sorted(set(c.nthreads for c in curve))
+
+    for nth, c in zip(threads, itertools.cycle(cc)):
+        pts = [p for p in curve if p.nthreads == nth]
+        rate = np.r_[[p.rate for p in pts]]
+        ax.plot(rate, [p.p50 for p in pts], c+'o-', linewidth=2, alpha=0.7, label='p50 x{}'.format(nth))
+        ax.plot(rate, [p.p99 for p in pts], c+'s--', linewidth=1, alpha=0.7, label='p99 x{}'.format(nth))
+
+    ax.set_xlabel('Offered load (tiles/sec)')
+    ax.set_ylabel('Latency (ms)')
+    ax.legend()
+    fig.tight_layout()
+    return ax
+
+
+def plot_memory(fig, data, cc=None):
+    """ Peak memory vs thread count, one line per configuration, and RSS over
+    time for the first run of every thread count
+
+    data: output of `reports.load_dir`
+    """
+    from .reports import varying_gdal_opts, _gdal_opts
+
+    if cc is None:
+        if mp_version >= '2.0.0':
+            cc = ['C0', 'C1', 'C2', 'C3', 'C4', 'C5', 'C6']
+        else:
+            cc = ['b', 'g', 'r', 'm', 'c', 'y', 'k']
+
+    MiB = 1 << 20
+    keys = varying_gdal_opts(data)
+
+    groups = {}
+    for nthreads, runs in sorted(data.items()):
+        for s in runs:
+            if getattr(s, 'peak_rss', None) is None:
+                continue
+            cfg = ' '.join('{}={}'.format(k, _gdal_opts(s).get(k, '-')) for k in keys) or 'rss'
+            groups.setdefault(cfg, {}).setdefault(nthreads, []).append(s)
+
+    ax1 = fig.add_subplot(1, 2, 1)
+    for (cfg, runs), c in zip(sorted(groups.items()), itertools.cycle(cc)):
+        nth = sorted(runs)
+        ax1.plot(nth, [max(s.peak_rss for s in runs[n])/MiB for n in nth], c+'o-', alpha=0.7, label=cfg)
+        cache = [max(s.peak_gdal_cache or 0 for s in runs[n])/MiB for n in nth]
+        if max(cache) > 0:
+            ax1.plot(nth, cache, c+'s--', alpha=0.7, label=cfg + ' (block cache)')
+
+    ax1.set_xlabel('Number of threads')
+    ax1.set_ylabel('Peak memory (MiB)')
+    ax1.legend()
+
+    ax2 = fig.add_subplot(1, 2, 2)
+    for (nthreads, runs), c in zip(sorted(data.items()), itertools.cycle(cc)):
+        s = next((s for s in runs if getattr(s, 'rss', None) is not None), None)
+        if s is not None:
+            ax2.plot(s.mem_t, s.rss/MiB, c+'-', alpha=0.7, label='x{}'.format(nthreads))
+
+    ax2.set_xlabel('Time (ms)')
+    ax2.set_ylabel('RSS (MiB)')
+    ax2.legend()
+
+    fig.tight_layout()
+    return ax1, ax2
+
+
+def plot_history(fig, groups, by='nthreads', cc=None):
+    """ Throughput over time, one line per group
+
+    groups: output of `history.group_runs`
+    """
+    from datetime import datetime
+
+    if cc is None:
+        if mp_version >= '2.0.0':
+            cc = ['C0', 'C1', 'C2', 'C3', 'C4', 'C5', 'C6']
+        else:
+            cc = ['b', 'g', 'r', 'm', 'c', 'y', 'k']
+
+    ax = fig.add_subplot(1, 1, 1)
+    for (k, runs), c in zip(sorted(groups.items(), key=lambda kv: str(kv[0])), itertools.cycle(cc)):
+        tt = [datetime.fromtimestamp(r.t_run) for r in runs]
+        ax.plot(tt, [r.throughput for r in runs], c+'o-', alpha=0.7, label='{}={}'.format(by, k))
+
+    ax.set_ylabel('Files per second')
+    ax.legend()
+    fig.autofmt_xdate()
+    fig.tight_layout()
+    return ax
@@ -1,8 +1,19 @@
 import rasterio
 import threading
+import queue
+import random
+import time
 import sys
+import os
+import re
+import errno
+from timeit import default_timer as t_now
+from types import SimpleNamespace
+import numpy as np
 from .s3tools import auto_find_region, get_boto3_session
 from .parallel import ParallelStreamProc
+from .monitor import set_gdal_cache_max
+from .ordering import reorder
 
 try:
     from rasterio.session import AWSSession
@@ -11,15 +22,205 @@ except ImportError:
         return session
 
 
-__all__ = ["ParallelReader"]
+__all__ = ["ParallelReader", "RetryPolicy", "BufferPool", "classify_error", "run_with_retry", "apply_affinity"]
 
 _thread_lcl = threading.local()
 
+_EOS = object()
+
 
 def _session(region_name=None):
     return get_boto3_session(region_name, cache=_thread_lcl)
 
 
+ERROR_KINDS = ('throttled', 'timeout', 'not_found', 'decode', 'other')
+
+_HTTP_CODES = {'503': 'throttled', '429': 'throttled',
+               '408': 'timeout', '504': 'timeout',
+               '404': 'not_found'}
+
+# "HTTP response code: 503" (GDAL), "HTTP error code : 404", "HTTP status 429"
+_HTTP_CODE_RE = re.compile(r'HTTP (?:response |error |status )?(?:code)?\s*:?\s*(\d{3})\b', re.IGNORECASE)
+
+# urls and file paths, quoted or not, these can contain anything, e.g. dates like 20180503
+_PATH_RE = re.compile(r"'[^']*'|\"[^\"]*\"|\b[a-z][a-z0-9+]*://\S+|/vsi\w+/\S+|(?<![\w.])/[\w.\-/]+")
+
+_ERROR_PATTERNS = (
+    ('throttled', ('SlowDown', 'Slow Down', 'Too Many Requests', 'RequestLimitExceeded')),
+    ('timeout', ('Timeout', 'timed out', 'Timed out')),
+    ('not_found', ('NoSuchKey', 'No such file', 'does not exist')),
+    ('decode', ('TIFFRead', 'IReadBlock', 'Decoder', 'decode', 'Decompress', 'decompress', 'inflate',
+                'LZWDecode', 'ZSTD', 'not recognized as a supported file format')),
+)
+
+
+def parse_cachemax(v):
+    """ GDAL_CACHEMAX value in bytes: "512" and values below 100000 are MiB,
+    "10%" is a fraction of physical memory, larger numbers are bytes, None
+    for anything else
+    """
+    v = str(v).strip()
+    try:
+        if v.endswith('%'):
+            return int(float(v[:-1])/100*os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES'))
+        n = int(float(v))
+    except ValueError:
+        return None
+    return n*(1 << 20) if n < 100000 else n
+
+
+def classify_error(e):
+    """ Map exception raised while reading a file to one of `ERROR_KINDS`
+
+    Exception type and errno are checked first. GDAL reports HTTP failures as
+    text, so after that it's the error message, with urls and paths removed:
+    HTTP status codes only count as part of "HTTP response code: NNN".
+    """
+    if isinstance(e, TimeoutError) or getattr(e, 'errno', None) == errno.ETIMEDOUT:
+        return 'timeout'
+    if isinstance(e, FileNotFoundError) or getattr(e, 'errno', None) == errno.ENOENT:
+        return 'not_found'
+
+    msg = _PATH_RE.sub('<path>', str(e))
+    m = _HTTP_CODE_RE.search(msg)
+    if m is not None and m.group(1) in _HTTP_CODES:
+        return _HTTP_CODES[m.group(1)]
+
+    for kind, patterns in _ERROR_PATTERNS:
+        if any(p in msg for p in patterns):
+            return kind
+    return 'other'
+
+
+class RetryPolicy(object):
+    """Exponential backoff with "full jitter"
+
+    max_attempts -- total number of attempts per file, 1 means no retries
+    backoff      -- delay before the first retry, in seconds, doubles every retry
+    max_backoff  -- upper bound on the delay
+    retry_on     -- error kinds worth retrying, missing files and corrupt data are not
+    """
+    def __init__(self, max_attempts=1,
+                 backoff=0.1,
+                 max_backoff=5,
+                 jitter=True,
+                 retry_on=('throttled', 'timeout', 'other')):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_on = tuple(retry_on)
+
+    def delay(self, kind, attempt):
+        """ Seconds to wait before next attempt, None -- give up
+        """
+        if attempt >= self.max_attempts or kind not in self.retry_on:
+            return None
+        d = min(self.max_backoff, self.backoff*(2**(attempt - 1)))
+        return random.uniform(0, d) if self.jitter else d
+
+    def __repr__(self):
+        return 'RetryPolicy(max_attempts={}, backoff={}, max_backoff={})'.format(
+            self.max_attempts, self.backoff, self.max_backoff)
+
+
+class BufferPool(object):
+    """Arrays recycled between reads, allocated on demand
+
+    Nothing is ever freed, the number of arrays allocated is the largest
+    number that were taken out at the same time.
+    """
+    def __init__(self):
+        self._free = {}
+        self._lock = threading.Lock()
+        self.nallocated = 0
+
+    def get(self, shape, dtype):
+        key = (tuple(shape), np.dtype(dtype))
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                return free.pop()
+            self.nallocated += 1
+        return np.empty(*key)
+
+    def put(self, a):
+        with self._lock:
+            self._free.setdefault((a.shape, a.dtype), []).append(a)
+
+
+def _to_window(w):
+    from rasterio.windows import Window
+    return w if isinstance(w, Window) else Window.from_slices(*w)
+
+
+def run_with_retry(proc, url, userdata, timer=None, retry=None, on_error=None):
+    """ Call `proc(url, userdata, t0)` until it succeeds or `retry` gives up
+
+    Every failed attempt is reported to `on_error(userdata, url, err)`, where
+    err is SimpleNamespace(kind, message, attempt, t0, delay), delay is None
+    when there will be no more attempts. Default is to print to stderr.
+    """
+    if retry is None:
+        retry = RetryPolicy()
+    if on_error is None:
+        on_error = _report_error
+
+    attempt = 0
+    while True:
+        attempt += 1
+        t0 = timer() if timer is not None else None
+        try:
+            proc(url, userdata, t0)
+            return
+        except Exception as e:
+            kind = classify_error(e)
+            delay = retry.delay(kind, attempt)
+            on_error(userdata, url, SimpleNamespace(kind=kind,
+                                                    message=str(e),
+                                                    attempt=attempt,
+                                                    t0=t0,
+                                                    delay=delay))
+            if delay is None:
+                return
+            time.sleep(delay)
+
+
+def _report_error(userdata, url, err):
+    print('Error when reading: {}\n...({})'.format(url, err.message), file=sys.stderr)
+
+
+def window_nbytes(f, band, window):
+    """ Compressed bytes of all blocks of `band` that `window` touches, 0 when unknown
+    """
+    import math
+
+    by, bx = f.block_shapes[band - 1]
+    (r0, r1), (c0, c1) = window.toranges()
+    r0, c0 = max(int(math.floor(r0)), 0), max(int(math.floor(c0)), 0)
+    r1, c1 = min(int(math.ceil(r1)), f.height), min(int(math.ceil(c1)), f.width)
+
+    try:
+        return sum(f.block_size(band, i, j) or 0
+                   for i in range(r0//by, (r1 + by - 1)//by)
+                   for j in range(c0//bx, (c1 + bx - 1)//bx))
+    except rasterio.errors.RasterBlockError:
+        return 0
+
+
+def apply_affinity(pstream, policy, nthreads):
+    """ Pin worker threads of `pstream` according to placement `policy`
+
+    Returns SimpleNamespace(policy, cpus), cpus is None when threads are not pinned.
+    """
+    from .affinity import placement
+
+    cpu_sets = placement(policy, nthreads)
+    if cpu_sets is None:
+        return SimpleNamespace(policy='none', cpus=None)
+    return SimpleNamespace(policy=policy, cpus=pstream.set_affinity(cpu_sets))
+
+
 class ParallelReader(object):
     """This class will process a bunch of files in parallel. You provide a
     generator of (userdata, url) tuples and a callback that takes opened
@@ -49,31 +250,57 @@ class ParallelReader(object):
                              on_file_cbk,
                              gdal_opts=None,
                              region_name=None,
-                             timer=None):
+                             timer=None,
+                             retry=None,
+                             on_error=None,
+                             open_opts=None,
+                             lookup=None):
         from rasterio.path import parse_path
         session = AWSSession(session=_session(region_name))
+        open_opts = open_opts or {}
 
         if timer is not None:
-            def proc(url, userdata):
-                t0 = timer()
-                with rasterio.DatasetReader(parse_path(url), sharing=False) as f:
+            def proc(url, userdata, t0):
+                with rasterio.DatasetReader(parse_path(url), sharing=False, **open_opts) as f:
                     on_file_cbk(f, userdata, t0=t0)
         else:
-            def proc(url, userdata):
-                with rasterio.DatasetReader(parse_path(url), sharing=False) as f:
+            def proc(url, userdata, t0):
+                with rasterio.DatasetReader(parse_path(url), sharing=False, **open_opts) as f:
                     on_file_cbk(f, userdata)
 
         with rasterio.Env(session=session, **gdal_opts):
             for userdata, url in src_stream:
-                try:
-                    proc(url, userdata)
-                except Exception as e:
-                    print('Error when reading: {}\n...({})'.format(url, str(e)), file=sys.stderr)
+                if lookup is not None and lookup(userdata, url):
+                    continue
+                run_with_retry(proc, url, userdata, timer=timer, retry=retry, on_error=on_error)
 
     def __init__(self, nthreads,
                  region_name=None,
                  bytes_at_open=None,
-                 aws_unsigned=False):
+                 aws_unsigned=False,
+                 retry=None,
+                 gdal_opts=None,
+                 vsi_cache_size=None,
+                 gdal_cachemax=None,
+                 overview_level=None,
+                 tile_cache=None,
+                 affinity=None):
+        """
+        gdal_opts      -- extra GDAL/VSI config options, these override defaults
+        vsi_cache_size -- None| bytes of VSI cache per open file (VSI_CACHE_SIZE),
+                          every worker has one file open at a time, so this
+                          bounds VSI cache memory at nthreads*vsi_cache_size
+        gdal_cachemax  -- None| size of GDAL block cache in bytes, shared by
+                          all threads, set process wide on construction
+        overview_level -- None| open this overview instead of full resolution
+                          image, 0 is the largest overview, file handles
+                          passed to callbacks then see overview size and tiling
+        tile_cache     -- None| `tilecache.DiskTileCache` or `tilecache.MemoryTileCache`,
+                          used by `read_windows`, tiles found there are served
+                          without opening the file
+        affinity       -- None| placement policy of worker threads, one of
+                          `affinity.POLICIES`, see `affinity.placement`
+        """
         if region_name is None:
             region_name = auto_find_region()  # Will throw on error
 
@@ -81,6 +308,10 @@ class ParallelReader(object):
         self._pstream = ParallelStreamProc(nthreads)
         self._process_files = self._pstream.bind(ParallelReader._process_file_stream)
         self._region_name = region_name
+        self._retry = retry
+        self._open_opts = {} if overview_level is None else dict(overview_level=int(overview_level))
+        self._tile_cache = tile_cache
+        self._affinity = apply_affinity(self._pstream, affinity, nthreads)
 
         self._gdal_opts = dict(VSI_CACHE=True,
                                CPL_VSIL_CURL_ALLOWED_EXTENSIONS='tif',
@@ -90,6 +321,40 @@ class ParallelReader(object):
             self._gdal_opts['GDAL_INGESTED_BYTES_AT_OPEN'] = int(bytes_at_open)
         if aws_unsigned:
             self._gdal_opts['AWS_NO_SIGN_REQUEST'] = True
+        if vsi_cache_size is not None:
+            self._gdal_opts['VSI_CACHE_SIZE'] = int(vsi_cache_size)
+        if gdal_cachemax is not None:
+            self._gdal_opts['GDAL_CACHEMAX'] = int(gdal_cachemax)
+        if gdal_opts:
+            self._gdal_opts.update(gdal_opts)
+
+        cachemax = parse_cachemax(self._gdal_opts.get('GDAL_CACHEMAX', ''))
+        if cachemax is not None:
+            set_gdal_cache_max(cachemax)
+
+    @property
+    def tile_cache(self):
+        return self._tile_cache
+
+    @property
+    def affinity(self):
+        """ SimpleNamespace(policy, cpus) -- placement policy and CPUs of every worker thread
+        """
+        return self._affinity
+
+    def tile_key(self, url, band, block):
+        """ Tile cache key, includes overview level
+        """
+        level = self._open_opts.get('overview_level')
+        if level is not None:
+            block = tuple(block) + ('overview', level)
+        return self._tile_cache.key(url, band, block)
+
+    @property
+    def gdal_opts(self):
+        """ GDAL config options used by worker threads
+        """
+        return dict(self._gdal_opts)
 
     def warmup(self, action=None):
         """Mostly needed for benchmarking needs. Ensures that worker threads are
@@ -107,7 +372,22 @@ class ParallelReader(object):
 
         return self._pstream.broadcast(_warmup)
 
-    def process(self, stream, cbk, timer=None):
+    def thread_ids(self):
+        """ Thread identifiers of worker threads, useful for profiling
+        """
+        return self._pstream.thread_ids()
+
+    def shutdown(self):
+        """ Stop worker threads, instance can not be used after this
+        """
+        self._pstream.shutdown()
+
+    def queue_depth(self):
+        """ Number of files waiting to be picked up by a worker thread
+        """
+        return self._pstream.queue_depth()
+
+    def process(self, stream, cbk, timer=None, on_error=None, on_blocked=None, order=None, lookup=None):
         """
         stream: (userdata, url)...
         cbk:
@@ -116,6 +396,26 @@ class ParallelReader(object):
 
         timer: None| ()-> TimeValue
 
+        on_error: None| userdata, url, err -> None (ignored)
+           Called from worker thread for every failed attempt, err has fields
+           kind (see `classify_error`), message, attempt (1-based), t0 (timer
+           value at the start of the attempt) and delay (seconds until the
+           next attempt, None if giving up). Default is to print to stderr.
+
+        on_blocked: None| state -> None (ignored)
+           Called from the calling thread every time the work queue is full,
+           i.e. all workers are busy and the backlog is at its limit.
+
+        order: None| [url] -> [int]
+           Ordering strategy, returns positions in the stream in the order
+           they should be processed, see `ordering.make_order`. Stream is
+           read in full before processing starts.
+
+        lookup: None| userdata, url -> bool
+           Called from worker thread before opening a file, True means the
+           file was dealt with already (e.g. served from a cache) and is
+           skipped.
+
         Equivalent to this serial code, but with many concurrent threads and
         with appropriate `rasterio.Env` wrapper for S3 access
 
@@ -132,8 +432,451 @@ class ParallelReader(object):
             with rasterio.open(url, 'r') as f:
                cbk(f, userdata, t0=t0)
         ```
+
+        Failed files are retried according to the `retry` policy supplied
+        at construction, `t0` is taken at the start of every attempt.
         """
-        self._process_files(stream, cbk,
-                            self._gdal_opts,
-                            region_name=self._region_name,
-                            timer=timer)
+        process_files = self._process_files
+        if on_blocked is not None:
+            process_files = self._pstream.bind(ParallelReader._process_file_stream, on_blocked=on_blocked)
+
+        process_files(reorder(stream, order), cbk,
+                      self._gdal_opts,
+                      region_name=self._region_name,
+                      timer=timer,
+                      retry=self._retry,
+                      on_error=on_error,
+                      open_opts=self._open_opts,
+                      lookup=lookup)
+
+    def read_windows(self, urls, windows, out=None, band=1, resampling=None, order=None):
+        """Read a window of pixels from every file into a stacked array
+
+        urls       -- list of urls
+        windows    -- one window for all urls or a list with a window per url,
+                      `rasterio.windows.Window` or ((row_start, row_stop), (col_start, col_stop))
+        out        -- None| ndarray (len(urls), ny, nx), when out is not
+                      supplied all windows have to be of the same size and
+                      the array is allocated with pixel type of the first
+                      file read (None if none could be read)
+        band       -- band to read, 1-based
+        resampling -- None| `rasterio.enums.Resampling` or its name, used
+                      when window size is not the same as output size
+        order      -- None| ordering strategy, see `process`, output is
+                      always in the order of `urls`
+
+        Returns (out, status), status has an entry for every url with fields
+
+          ok       -- True if pixels were read
+          error    -- None| SimpleNamespace(kind, message) of the last failure
+          errors   -- every failed attempt, SimpleNamespace(kind, message,
+                      attempt, t0, t_failed, delay), see `process`
+          attempts -- number of attempts made
+          t0       -- start of the last attempt, `timeit.default_timer` units
+          t_open   -- seconds to open the file
+          t_read   -- seconds to read pixels
+          cpu_open -- CPU seconds of the worker thread to open the file
+          cpu_read -- CPU seconds of the worker thread to read pixels
+          nbytes   -- compressed bytes of the blocks the window touches
+          cached   -- True if pixels came from the tile cache, file was not
+                      opened then, t_open is 0 and attempts is 0
+
+        Pixels of failed reads in `out` are left unchanged.
+        """
+        from rasterio.windows import Window
+        from rasterio.enums import Resampling
+
+        if isinstance(windows, (Window, tuple)):
+            windows = [windows]*len(urls)
+        windows = [_to_window(w) for w in windows]
+        if len(windows) != len(urls):
+            raise ValueError('Need one window per url, got {} windows for {} urls'.format(len(windows), len(urls)))
+
+        if out is None:
+            shapes = set((int(round(w.height)), int(round(w.width))) for w in windows)
+            if len(shapes) > 1:
+                raise ValueError('Windows are not all the same size, need to supply `out` array')
+            out_shape = shapes.pop()
+        elif out.shape[0] != len(urls):
+            raise ValueError('Output array has space for {} images, but have {} urls'.format(out.shape[0], len(urls)))
+        else:
+            out_shape = out.shape[1:]
+
+        if isinstance(resampling, str):
+            resampling = Resampling[resampling]
+        read_args = {} if resampling is None else dict(resampling=resampling)
+
+        lock = threading.Lock()
+        dst = [out]
+        status = [SimpleNamespace(ok=False, error=None, errors=[], attempts=0, t0=None, t_open=None, t_read=None,
+                                  cpu_open=None, cpu_read=None, nbytes=0, cached=False)
+                  for _ in urls]
+
+        def timer():
+            return (t_now(), time.thread_time())
+
+        def get_out(dtype):
+            if dst[0] is None:
+                with lock:
+                    if dst[0] is None:
+                        dst[0] = np.zeros((len(urls), *out_shape), dtype=dtype)
+            return dst[0]
+
+        cache = self._tile_cache
+        lookup = None
+        if cache is not None:
+            def tile_key(idx):
+                w = windows[idx]
+                block = ('window', int(w.row_off), int(w.col_off), int(w.height), int(w.width), *out_shape)
+                return self.tile_key(urls[idx], band, block)
+
+            def lookup(idx, url):
+                t0, c0 = timer()
+                pix = cache.get(tile_key(idx))
+                if pix is None:
+                    return False
+                get_out(pix.dtype)[idx] = pix
+                t1, c1 = timer()
+
+                st = status[idx]
+                st.ok, st.cached = True, True
+                st.t0, st.t_open, st.t_read = t0, 0, t1 - t0
+                st.cpu_open, st.cpu_read = 0, c1 - c0
+                return True
+
+        def on_file(f, idx, t0):
+            t0, c0 = t0
+            t1, c1 = timer()
+            dst_slice = get_out(f.dtypes[band - 1])[idx]
+            f.read(band, window=windows[idx], out=dst_slice, **read_args)
+            t2, c2 = timer()
+            if cache is not None:
+                cache.put(tile_key(idx), dst_slice)
+
+            st = status[idx]
+            st.ok = True
+            st.attempts += 1
+            st.t0, st.t_open, st.t_read = t0, t1 - t0, t2 - t1
+            st.cpu_open, st.cpu_read = c1 - c0, c2 - c1
+            st.nbytes = window_nbytes(f, band, windows[idx])
+
+        def on_error(idx, url, err):
+            t0 = err.t0[0]
+            st = status[idx]
+            st.attempts += 1
+            st.t0 = t0
+            st.error = SimpleNamespace(kind=err.kind, message=err.message)
+            st.errors.append(SimpleNamespace(kind=err.kind,
+                                             message=err.message,
+                                             attempt=err.attempt,
+                                             t0=t0,
+                                             t_failed=t_now() - t0,
+                                             delay=err.delay))
+            if cache is not None and err.delay is None:
+                cache.discard(tile_key(idx))
+
+        self.process(enumerate(urls), on_file, timer=timer, on_error=on_error, order=order, lookup=lookup)
+
+        return dst[0], status
+
+    def imap_unordered(self, stream, window, band=1, out_shape=None, resampling=None, max_inflight=None):
+        """Read a window of pixels from every file, yielding results as they complete
+
+        stream       -- (userdata, url)..., consumed lazily, can be unbounded
+        window       -- `rasterio.windows.Window`, ((row_start, row_stop), (col_start, col_stop))
+                        or (file_handle, userdata) -> window, all windows
+                        have to be of the same size unless `out_shape` is set
+        out_shape    -- None| (ny, nx) of the output, default is window size
+        resampling   -- None| `rasterio.enums.Resampling` or its name
+        max_inflight -- bound on files being read plus results not yet
+                        consumed, default: 2*nthreads, workers wait for the
+                        consumer when it falls behind
+
+        Yields (userdata, pixels, timings) in completion order, timings has
+        fields ok, error, attempts, t0, t_open and t_read of status entries
+        of `read_windows`, pixels is None for files that failed after all
+        retries.
+
+        Pixel arrays come from a pool and are re-used once the next result
+        is requested, copy them to keep them around. Closing the generator
+        (or breaking out of a loop over it) aborts outstanding work and
+        waits for the worker threads to finish their current file.
+        """
+        return self._imap(stream, window, band, out_shape, resampling, max_inflight, ordered=False)
+
+    def imap(self, stream, window, band=1, out_shape=None, resampling=None, max_inflight=None):
+        """Same as `imap_unordered`, but results are yielded in the order of `stream`
+
+        One slow file holds back results behind it, those still count
+        towards `max_inflight`.
+        """
+        return self._imap(stream, window, band, out_shape, resampling, max_inflight, ordered=True)
+
+    def _imap(self, stream, window, band, out_shape, resampling, max_inflight, ordered):
+        from rasterio.enums import Resampling
+
+        if max_inflight is None:
+            max_inflight = 2*self._nthreads
+        if max_inflight < 1:
+            raise ValueError('max_inflight can not be less than 1')
+
+        if callable(window):
+            get_window = lambda f, userdata: _to_window(window(f, userdata))
+        else:
+            window = _to_window(window)
+            get_window = lambda f, userdata: window
+
+        if isinstance(resampling, str):
+            resampling = Resampling[resampling]
+        read_args = {} if resampling is None else dict(resampling=resampling)
+
+        pool = BufferPool()
+        slots = threading.Semaphore(max_inflight)
+        done = queue.Queue()
+        state = SimpleNamespace(cancelled=False, error=None)
+        failed = {}
+        lock = threading.Lock()
+
+        def src():
+            for seq, (userdata, url) in enumerate(stream):
+                while not slots.acquire(timeout=0.05):
+                    if state.cancelled:
+                        return
+                if state.cancelled:
+                    return
+                yield (seq, userdata), url
+
+        def on_file(f, key, t0):
+            seq, userdata = key
+            t1 = t_now()
+            win = get_window(f, userdata)
+            shape = out_shape or (int(round(win.height)), int(round(win.width)))
+            buf = pool.get(shape, f.dtypes[band - 1])
+            try:
+                f.read(band, window=win, out=buf, **read_args)
+            except Exception:
+                pool.put(buf)
+                raise
+            t2 = t_now()
+
+            with lock:
+                attempts = 1 + failed.pop(seq, 0)
+            done.put((seq, userdata, buf, SimpleNamespace(ok=True, error=None, attempts=attempts,
+                                                          t0=t0, t_open=t1 - t0, t_read=t2 - t1)))
+
+        def on_error(key, url, err):
+            seq, userdata = key
+            with lock:
+                attempts = failed[seq] = failed.get(seq, 0) + 1
+            if err.delay is None:
+                with lock:
+                    failed.pop(seq, None)
+                error = SimpleNamespace(kind=err.kind, message=err.message)
+                done.put((seq, userdata, None, SimpleNamespace(ok=False, error=error, attempts=attempts,
+                                                               t0=err.t0, t_open=None, t_read=None)))
+
+        def run():
+            try:
+                self.process(src(), on_file, timer=t_now, on_error=on_error)
+            except BaseException as e:
+                state.error = e
+            finally:
+                done.put(_EOS)
+
+        th = threading.Thread(target=run, name='imap-pump', daemon=True)
+        th.start()
+
+        pending = {}
+        next_seq = 0
+        try:
+            while True:
+                item = done.get()
+                if item is _EOS:
+                    break
+
+                if ordered:
+                    pending[item[0]] = item
+                    ready = []
+                    while next_seq in pending:
+                        ready.append(pending.pop(next_seq))
+                        next_seq += 1
+                else:
+                    ready = [item]
+
+                for _, userdata, buf, timings in ready:
+                    yield userdata, buf, timings
+                    if buf is not None:
+                        pool.put(buf)
+                    slots.release()
+
+            if state.error is not None:
+                raise state.error
+        finally:
+            state.cancelled = True
+            self._pstream.abort()
+            th.join()
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_retry_policy():
+    assert classify_error(IOError('HTTP response code: 503')) == 'throttled'
+    assert classify_error(IOError('HTTP response code: 404')) == 'not_found'
+    assert classify_error(IOError('Timeout was reached')) == 'timeout'
+    assert classify_error(IOError('TIFFReadEncodedTile() failed.')) == 'decode'
+    assert classify_error(ValueError('?')) == 'other'
+    assert classify_error(IOError('HTTP error code : 429')) == 'throttled'
+    assert classify_error(FileNotFoundError(2, 'gone')) == 'not_found'
+
+    # dates in Landsat urls look like HTTP status codes
+    url = ('/vsis3/landsat-pds/c1/L8/106/070/LC08_L1TP_106070_20180503_20180516_01_T1/'
+           'LC08_L1TP_106070_20180503_20180516_01_T1_B1.TIF')
+    assert classify_error(IOError("'{}' does not exist in the file system, "
+                                  "and is not recognized as a supported dataset name.".format(url))) == 'not_found'
+    assert classify_error(IOError('{}: TIFFReadEncodedTile() failed.'.format(url.replace('0503', '0429')))) == 'decode'
+    assert classify_error(IOError('HTTP response code: 503 for s3://landsat-pds/x_20180404_B1.TIF')) == 'throttled'
+    assert classify_error(IOError('Unexpected error for https://h/x_20180503.TIF')) == 'other'
+
+    retry = RetryPolicy(max_attempts=3, backoff=0.5, jitter=False)
+    assert retry.delay('throttled', 1) == 0.5
+    assert retry.delay('throttled', 2) == 1.0
+    assert retry.delay('throttled', 3) is None
+    assert retry.delay('not_found', 1) is None
+    assert RetryPolicy().delay('throttled', 1) is None
+
+
+def test_parse_cachemax():
+    assert parse_cachemax('512') == 512 << 20
+    assert parse_cachemax(200000000) == 200000000
+    assert 0 < parse_cachemax('5%') < parse_cachemax('10%')
+    assert parse_cachemax('') is None
+
+
+def test_read_windows(tmpdir):
+    from rasterio.windows import Window
+
+    urls = []
+    for i in range(4):
+        fname = str(tmpdir/'im{}.tif'.format(i))
+        with rasterio.open(fname, 'w', driver='GTiff', width=64, height=64, count=1, dtype='uint16',
+                           tiled=True, blockxsize=32, blockysize=32) as f:
+            f.write(np.full((64, 64), i, dtype='uint16'), 1)
+        urls.append(fname)
+    urls.append(str(tmpdir/'missing.tif'))
+
+    rdr = ParallelReader(2, region_name='us-west-2')
+    out, status = rdr.read_windows(urls, Window(32, 0, 32, 32))
+
+    assert out.shape == (5, 32, 32)
+    assert out.dtype == np.uint16
+    assert [st.ok for st in status] == [True]*4 + [False]
+    assert status[-1].error.kind == 'not_found'
+    assert (out[:4, 0, 0] == np.arange(4)).all()
+    assert all(st.t_read >= 0 and st.attempts == 1 for st in status[:4])
+    assert all(st.nbytes > 0 and st.cpu_read >= 0 and st.errors == [] for st in status[:4])
+    assert [e.kind for e in status[-1].errors] == ['not_found']
+    with rasterio.open(urls[0]) as f:
+        assert status[0].nbytes == f.block_size(1, 0, 1)
+        assert window_nbytes(f, 1, Window(16, 16, 32, 32)) == sum(f.block_size(1, i, j)
+                                                                 for i in (0, 1) for j in (0, 1))
+
+    out = np.zeros((4, 16, 16), dtype='float32')
+    out, status = rdr.read_windows(urls[:4], ((0, 64), (0, 64)), out=out, resampling='average')
+    assert all(st.ok for st in status)
+    assert (out[3] == 3).all()
+
+    # tile cache: second pass is served without opening files
+    from .tilecache import DiskTileCache
+    rdr = ParallelReader(2, region_name='us-west-2', tile_cache=DiskTileCache(str(tmpdir/'tiles')))
+    for cached in (False, True):
+        out, status = rdr.read_windows(urls, Window(32, 0, 32, 32))
+        assert [st.cached for st in status] == [cached]*4 + [False]
+        assert (out[:4, 0, 0] == np.arange(4)).all()
+    st = rdr.tile_cache.stats()
+    assert (st.hits, st.puts) == (4, 4)
+
+
+def test_imap(tmpdir):
+    urls = []
+    for i in range(8):
+        fname = str(tmpdir/'im{}.tif'.format(i))
+        with rasterio.open(fname, 'w', driver='GTiff', width=64, height=64, count=1, dtype='uint8',
+                           tiled=True, blockxsize=32, blockysize=32) as f:
+            f.write(np.full((64, 64), i, dtype='uint8'), 1)
+        urls.append(fname)
+    urls.insert(3, str(tmpdir/'missing.tif'))
+
+    rdr = ParallelReader(4, region_name='us-west-2')
+
+    seen = {}
+    it = rdr.imap_unordered(enumerate(urls), ((0, 32), (32, 64)), max_inflight=2)
+    for idx, pix, timings in it:
+        seen[idx] = None if pix is None else pix.copy()
+        assert timings.ok == (pix is not None)
+    assert sorted(seen) == list(range(len(urls)))
+    assert seen[3] is None
+    assert all((seen[i] == (i if i < 3 else i - 1)).all() for i in seen if i != 3)
+
+    rr = list((idx, pix is None) for idx, pix, _ in rdr.imap(enumerate(urls), lambda f, _: f.block_window(1, 1, 1),
+                                                             out_shape=(8, 8), resampling='nearest'))
+    assert rr == [(i, i == 3) for i in range(len(urls))]
+
+    # cancel: stream is unbounded, only a few files are ever opened
+    opened = []
+
+    def forever():
+        i = 0
+        while True:
+            opened.append(i)
+            yield i, urls[i % 3]
+            i += 1
+
+    it = rdr.imap(forever(), ((0, 8), (0, 8)), max_inflight=3)
+    for idx, pix, _ in it:
+        if idx == 5:
+            break
+    it.close()
+    assert len(opened) <= 5 + 3 + 1
+    assert rdr._pstream._state is None
+
+    _, status = rdr.read_windows(urls[:2], ((0, 8), (0, 8)))
+    assert all(st.ok for st in status)
+
+
+def test_buffer_pool():
+    pool = BufferPool()
+    a = pool.get((2, 3), 'uint8')
+    b = pool.get((2, 3), 'uint8')
+    pool.put(a)
+    assert pool.get((2, 3), 'uint8') is a
+    assert pool.get((2, 3), 'float32').dtype == np.float32
+    pool.put(b)
+    assert pool.nallocated == 3
+
+
+def test_overview_level(tmpdir):
+    from rasterio.enums import Resampling
+    from .bench import fetch_file_info, format_file_info
+
+    fname = str(tmpdir/'ovr.tif')
+    with rasterio.open(fname, 'w', driver='GTiff', width=256, height=256, count=1, dtype='uint8',
+                       tiled=True, blockxsize=64, blockysize=64) as f:
+        f.write(np.full((256, 256), 7, dtype='uint8'), 1)
+    with rasterio.open(fname, 'r+') as f:
+        f.build_overviews([2, 4], Resampling.nearest)
+
+    finfo = fetch_file_info(fname)
+    assert finfo['shape_in_blocks'] == (4, 4)
+    assert [(o['factor'], o['shape']) for o in finfo['overviews']] == [(2, (128, 128)), (4, (64, 64))]
+    assert finfo['header_size'] > 0
+    assert fetch_file_info(fname, overview_level=1)['shape_in_blocks'] == (1, 1)
+    assert format_file_info(finfo).count('\n') == 4
+
+    rdr = ParallelReader(2, region_name='us-west-2', overview_level=0)
+    shapes = []
+    out, status = rdr.read_windows([fname]*2, ((0, 64), (64, 128)))
+    rdr.process([(None, fname)], lambda f, _: shapes.append(f.shape))
+    assert all(st.ok for st in status) and (out == 7).all()
+    assert shapes == [(128, 128)]
@@ -1,8 +1,34 @@
 from timeit import default_timer as t_now
+from time import thread_time
+import threading
 from types import SimpleNamespace
+import numpy as np
 import rasterio
 import sys
+from contextlib import nullcontext
 from .pprio import ParallelReader
+from .monitor import ProcessMonitor
+from .loadgen import PacedSource
+
+
+def t_cpu_now():
+    """ Wall clock and CPU time of the calling thread
+    """
+    return (t_now(), thread_time())
+
+
+def cache_delta(cache, stats0):
+    """ Tile cache counters accumulated since `stats0`, None when there is no cache
+    """
+    if cache is None:
+        return None
+    st = cache.stats()
+    for k, v in stats0.__dict__.items():
+        setattr(st, k, getattr(st, k) - v)
+    st.path = cache.path  # None for in-memory cache
+    st.max_bytes = cache.max_bytes
+    st.nbytes = cache.nbytes
+    return st
 
 
 class PReadRIO_bench(object):
@@ -10,52 +36,367 @@ class PReadRIO_bench(object):
                  region_name=None,
                  use_ssl=True,
                  bytes_at_open=None,
-                 aws_unsigned=False):
+                 aws_unsigned=False,
+                 retry=None,
+                 gdal_opts=None,
+                 vsi_cache_size=None,
+                 gdal_cachemax=None,
+                 overview_level=None,
+                 tile_cache=None,
+                 affinity=None):
         self._nthreads = nthreads
         self._use_ssl = use_ssl  # At least for now we ignore this param
+        self._retry = retry
+        self._bytes_at_open = bytes_at_open
         self._proc = ParallelReader(nthreads,
                                     region_name=region_name,
                                     bytes_at_open=bytes_at_open,
-                                    aws_unsigned=aws_unsigned)
+                                    aws_unsigned=aws_unsigned,
+                                    retry=retry,
+                                    gdal_opts=gdal_opts,
+                                    vsi_cache_size=vsi_cache_size,
+                                    gdal_cachemax=gdal_cachemax,
+                                    overview_level=overview_level,
+                                    tile_cache=tile_cache,
+                                    affinity=affinity)
+
+    @property
+    def affinity(self):
+        return self._proc.affinity
+
+    @property
+    def gdal_opts(self):
+        return self._proc.gdal_opts
 
     def warmup(self):
         return self._proc.warmup()
 
+    def shutdown(self):
+        return self._proc.shutdown()
+
+    def thread_ids(self):
+        return self._proc.thread_ids()
+
+    def queue_depth(self):
+        return self._proc.queue_depth()
+
     def read_blocks(self,
                     urls,
                     block_idx,
                     dst,
-                    band=1):
+                    band=1,
+                    arrivals=None,
+                    max_inflight=None,
+                    telemetry=None,
+                    trace=False,
+                    order=None):
+        """
+        dst          -- output array (url, y, x), when smaller than a block the
+                        block is decimated (nearest neighbour) into it
+        arrivals     -- None (closed loop) or start offsets in seconds for every url (open loop)
+        max_inflight -- open loop only, bound on queued plus running reads, default: 2*nthreads
+        telemetry    -- None| `Telemetry` instance to report live progress to
+        trace        -- record worker thread and byte ranges of every read, with
+                        CPL_DEBUG=ON these are the requests GDAL made (see
+                        `replay.RangeLog`), otherwise header and tile ranges
+        order        -- None| ordering strategy, see `ordering.make_order`, in open
+                        loop mode it decides which url goes into which arrival slot
+
+        When reader has a tile cache, tiles found there are copied into `dst`
+        without opening the file, their stats have `cached=True` and
+        `chunk_size=0` as nothing was fetched.
+        """
         t0 = t_now()
         stats = [None for _ in urls]
+        errors = [None for _ in urls]
+
+        if arrivals is not None:
+            perm = list(range(len(urls))) if order is None else order(urls)
+            slot = {idx: i for i, idx in enumerate(perm)}
+            paced = PacedSource([urls[idx] for idx in perm], arrivals, max_inflight or 2*self._nthreads)
+            src = ((perm[i], url) for i, url in paced)
+            on_done = paced.done
+            order = None
+        else:
+            src = enumerate(urls)
+            on_done = None
+
+        header_size = self._bytes_at_open or 16*1024
+
+        tm = telemetry
+        timer = t_cpu_now
+        if tm is not None:
+            def timer():
+                tm.stage('open')
+                return t_cpu_now()
+
+        range_log = None
+        if trace:
+            from .replay import RangeLog
+            range_log = RangeLog()
+
+        cache = self._proc.tile_cache
+        lookup = None
+        cache_stats0 = None
+        if cache is not None:
+            cache_stats0 = cache.stats()
+
+            def tile_key(idx):
+                return self._proc.tile_key(urls[idx], band, tuple(block_idx) + dst.shape[1:])
+
+            def lookup(idx, url):
+                t0, c0 = t_cpu_now()
+                pix = cache.get(tile_key(idx))
+                if pix is None:
+                    return False
+                dst[idx, :, :] = pix
+                t1, c1 = t_cpu_now()
 
-        def extract_block(f, idx, t0=0):
+                stats[idx] = SimpleNamespace(t_open=0,
+                                             t_total=t1-t0,
+                                             t0=t0,
+                                             cpu_open=0,
+                                             cpu_read=c1-c0,
+                                             attempts=0,
+                                             t_retry=0,
+                                             chunk_size=0,
+                                             cached=True)
+                if trace:
+                    stats[idx].thread = threading.get_ident()
+                    stats[idx].ranges = []
+                if tm is not None:
+                    tm.tile_done(0)
+                if on_done is not None:
+                    stats[idx].t_sched = paced.t_sched[slot[idx]]
+                    on_done()
+                return True
+
+        def on_error(idx, url, err):
+            if tm is not None:
+                tm.error(err.kind, final=err.delay is None)
+                tm.stage(None if err.delay is None else 'backoff')
+
+            t_start = err.t0[0]
+            err = SimpleNamespace(kind=err.kind,
+                                  message=err.message,
+                                  attempt=err.attempt,
+                                  t0=t_start,
+                                  t_failed=t_now() - t_start,
+                                  delay=err.delay)
+            if errors[idx] is None:
+                errors[idx] = []
+            errors[idx].append(err)
+
+            if err.delay is None:
+                print('Error when reading: {}\n...({})'.format(url, err.message), file=sys.stderr)
+                if cache is not None:
+                    cache.discard(tile_key(idx))
+                if on_done is not None:
+                    on_done()
+
+        def extract_block(f, idx, t0=(0, 0)):
+            t0, c0 = t0
             dst_slice = dst[idx, :, :]
             win = f.block_window(band, *block_idx)
-            t1 = t_now()
+            t1, c1 = t_cpu_now()
+            if tm is not None:
+                tm.stage('read')
             f.read(band, window=win, out=dst_slice)
-            t2 = t_now()
+            t2, c2 = t_cpu_now()
             try:
                 chunk_size = f.block_size(band, *block_idx)
             except rasterio.errors.RasterBlockError:
                 print('Failed to read block size for {}'.format(f.name), file=sys.stderr)
                 chunk_size = 0  # probably GDAL specific 0 sized tile
+            if cache is not None:
+                cache.put(tile_key(idx), dst_slice, nbytes_remote=header_size + chunk_size)
+
+            failed = errors[idx] or []
 
             stats[idx] = SimpleNamespace(t_open=t1-t0,
                                          t_total=t2-t0,
                                          t0=t0,
+                                         cpu_open=c1-c0,
+                                         cpu_read=c2-c1,
+                                         attempts=1 + len(failed),
+                                         t_retry=(t0 - failed[0].t0) if failed else 0,
                                          chunk_size=chunk_size)
+            if trace:
+                offset = int(f.get_tag_item('BLOCK_OFFSET_{}_{}'.format(block_idx[1], block_idx[0]),
+                                            'TIFF', bidx=band) or 0)
+                stats[idx].thread = threading.get_ident()
+                logged = range_log.pop(t0)
+                stats[idx].ranges_logged = len(logged) > 0
+                if logged:
+                    stats[idx].ranges = [('open' if t < t1 else 'read', a, b) for t, a, b in logged]
+                else:
+                    stats[idx].ranges = [('open', 0, header_size), ('read', offset, offset + chunk_size)]
+            if tm is not None:
+                tm.tile_done(chunk_size)
+                tm.stage(None)
+            if on_done is not None:
+                stats[idx].t_sched = paced.t_sched[slot[idx]]
+                on_done()
+
+        with ProcessMonitor() as mon, (range_log or nullcontext()):
+            self._proc.process(src, extract_block,
+                               timer=timer,
+                               on_error=on_error,
+                               on_blocked=tm.on_blocked if tm is not None else None,
+                               order=order,
+                               lookup=lookup)
+
+        t_total = t_now() - t0
+        params = SimpleNamespace(nthreads=self._nthreads,
+                                 band=band,
+                                 block_shape=dst.shape[1:],
+                                 dtype=dst.dtype.name,
+                                 retry=self._retry,
+                                 gdal_opts=self._proc.gdal_opts,
+                                 block=block_idx)
+        if on_done is not None:
+            params.max_inflight = paced.max_inflight
+
+        return dst, SimpleNamespace(stats=stats,
+                                    errors=errors,
+                                    params=params,
+                                    cpu=mon.timeline,
+                                    tile_cache=cache_delta(cache, cache_stats0),
+                                    t0=t0,
+                                    t_total=t_total)
+
+    def read_scenes(self,
+                    scenes,
+                    block_idx,
+                    dst,
+                    band=1,
+                    arrivals=None,
+                    order=None,
+                    **kwargs):
+        """
+        scenes   -- [(scene_id, [url for every band])...], see `scenes.group_by_scene`
+        dst      -- output array (scene, band, y, x), has to be contiguous
+        arrivals -- open loop only, start offset in seconds for every scene,
+                    all bands of a scene are released together
+        order    -- None| ordering strategy, applied to scenes (using url of
+                    the first band), bands of a scene stay together
+
+        Band files are queued scene by scene, so bands of the same scene are
+        picked up by different worker threads at about the same time.
+        """
+        nbands = dst.shape[1]
+        assert all(len(uu) == nbands for _, uu in scenes)
+
+        flat = dst.reshape(-1, *dst.shape[2:])
+        if not np.shares_memory(flat, dst):
+            raise ValueError('Output array has to be contiguous')
+
+        urls = [u for _, uu in scenes for u in uu]
+        if arrivals is not None:
+            arrivals = np.repeat(arrivals, nbands)
+
+        flat_order = None
+        if order is not None:
+            perm = order([uu[0] for _, uu in scenes])
 
-        self._proc.process(enumerate(urls), extract_block, timer=t_now)
+            def flat_order(_):
+                return [i*nbands + b for i in perm for b in range(nbands)]
+
+        _, xx = self.read_blocks(urls, block_idx, flat, band=band, arrivals=arrivals, order=flat_order, **kwargs)
+        xx.params.nbands = nbands
+        xx.scenes = [scene for scene, _ in scenes]
+
+        return dst, xx
+
+
+class PReadWindows_bench(PReadRIO_bench):
+    """Same benchmark as `PReadRIO_bench` but going through the
+    `ParallelReader.read_windows` library API
+    """
+    def read_blocks(self,
+                    urls,
+                    block_idx,
+                    dst,
+                    band=1,
+                    arrivals=None,
+                    max_inflight=None,
+                    telemetry=None,
+                    trace=False,
+                    order=None):
+        from rasterio.windows import Window
 
+        if arrivals is not None or telemetry is not None or trace:
+            raise ValueError('Open loop mode, live telemetry and tracing are not supported by windows mode')
+
+        (row, col), (ny, nx) = block_idx, dst.shape[1:]
+        win = Window(col*nx, row*ny, nx, ny)
+
+        cache = self._proc.tile_cache
+        cache_stats0 = None if cache is None else cache.stats()
+
+        t0 = t_now()
+        with ProcessMonitor() as mon:
+            _, status = self._proc.read_windows(urls, win, out=dst, band=band, order=order)
         t_total = t_now() - t0
+
+        stats = [SimpleNamespace(t_open=st.t_open,
+                                 t_total=st.t_open + st.t_read,
+                                 t0=st.t0,
+                                 cpu_open=st.cpu_open,
+                                 cpu_read=st.cpu_read,
+                                 attempts=st.attempts,
+                                 t_retry=(st.t0 - st.errors[0].t0) if st.errors else 0,
+                                 chunk_size=st.nbytes,
+                                 cached=st.cached) if st.ok else None
+                 for st in status]
+        errors = [st.errors or None for st in status]
+        for url, st in zip(urls, status):
+            if not st.ok and st.error is not None:
+                print('Error when reading: {}\n...({})'.format(url, st.error.message), file=sys.stderr)
+
         params = SimpleNamespace(nthreads=self._nthreads,
                                  band=band,
                                  block_shape=dst.shape[1:],
                                  dtype=dst.dtype.name,
+                                 retry=self._retry,
+                                 gdal_opts=self._proc.gdal_opts,
                                  block=block_idx)
 
         return dst, SimpleNamespace(stats=stats,
+                                    errors=errors,
                                     params=params,
+                                    cpu=mon.timeline,
+                                    tile_cache=cache_delta(cache, cache_stats0),
                                     t0=t0,
                                     t_total=t_total)
+
+
+class PReadHTTP_bench(PReadRIO_bench):
+    """Same benchmark as `PReadRIO_bench` but reading tiles with python HTTP
+    range requests (`httpread.ParallelHTTPReader`) instead of GDAL
+    """
+    def __init__(self, nthreads,
+                 region_name=None,
+                 use_ssl=True,
+                 bytes_at_open=None,
+                 aws_unsigned=False,
+                 retry=None,
+                 gdal_opts=None,
+                 endpoint_url=None,
+                 affinity=None):
+        from .httpread import ParallelHTTPReader
+
+        if gdal_opts:
+            raise ValueError('GDAL options have no effect in http mode')
+
+        self._nthreads = nthreads
+        self._use_ssl = use_ssl  # At least for now we ignore this param
+        self._retry = retry
+        self._bytes_at_open = bytes_at_open
+        self._proc = ParallelHTTPReader(nthreads,
+                                        region_name=region_name,
+                                        bytes_at_open=bytes_at_open,
+                                        aws_unsigned=aws_unsigned,
+                                        retry=retry,
+                                        endpoint_url=endpoint_url,
+                                        affinity=affinity)
@@ -0,0 +1,310 @@
+""" Predict throughput for unmeasured thread and process counts
+
+A closed queueing model of the reader is fitted to measured per-tile timings.
+Every worker thread loops over:
+
+1. wait on the network -- pure delay, no queueing, but it gets slower as more
+   requests are in flight: time is scaled by `1 + beta*(n - 1)` for `n`
+   concurrent reads across all processes
+2. decode holding a per-process lock (the GIL) -- fraction `gil` of CPU time
+3. rest of CPU time on any of `cores` cores
+
+Network and CPU time of a tile come from the runs with the fewest threads,
+where contention is lowest, `cores` is the CPU count recorded with the results,
+`beta` and `gil` are fitted to measured throughput of all thread counts.
+Throughput is computed with mean value analysis (MVA), multi-server stations
+use Seidmann's approximation. Latency percentiles come from a discrete-event
+simulation of the same model that resamples measured tiles.
+
+Prediction error is estimated by leaving one thread count out of the fit and
+predicting it from the rest.
+"""
+import heapq
+import os
+from types import SimpleNamespace
+import numpy as np
+
+__all__ = ['fit_model', 'mva_throughput', 'simulate', 'predict', 'gen_predict_report']
+
+BETA_GRID = np.r_[0, np.logspace(-4, 0, 41)]
+GIL_GRID = np.linspace(0, 1, 21)
+
+
+def _closed_loop(data):
+    """ Drop open loop runs, their throughput is set by the arrival rate
+    """
+    out = {}
+    for nthreads, runs in data.items():
+        runs = [s for s in runs if getattr(s.params, 'rate', None) is None]
+        if runs:
+            out[nthreads] = runs
+    return out
+
+
+def tile_demands(runs):
+    """ Network and CPU time per tile (ms), pooled across runs, tiles served from a tile cache are skipped
+    """
+    net, cpu = [], []
+    for s in runs:
+        total = s.t_total
+        c = np.zeros_like(total) if s.cpu_open is None else np.minimum(s.cpu_open + s.cpu_read, total)
+        keep = ~s.cached if getattr(s, 'cached', None) is not None else slice(None)
+        net.append((total - c)[keep])
+        cpu.append(c[keep])
+    return np.concatenate(net), np.concatenate(cpu)
+
+
+def measured_points(data):
+    """ nthreads -> SimpleNamespace(throughput (tiles per second), p50, p99 (ms), nruns)
+    """
+    out = {}
+    for nthreads, runs in sorted(data.items()):
+        t_total = np.concatenate([s.t_total for s in runs])
+        p50, p99 = np.percentile(t_total, [50, 99])
+        out[nthreads] = SimpleNamespace(throughput=sum(s.t_total.shape[0] for s in runs)/sum(s.duration for s in runs),
+                                        p50=p50,
+                                        p99=p99,
+                                        nruns=len(runs))
+    return out
+
+
+def _recorded_cpus(data):
+    for runs in data.values():
+        for s in runs:
+            cpus = (getattr(s._raw, 'env', None) or {}).get('cpus')
+            if cpus:
+                return cpus
+    return os.cpu_count()
+
+
+def mva_throughput(net, cpu, n_max, nprocs=1, cores=1, beta=0, gil=0):
+    """ Throughput in tiles per ms for 1..n_max concurrent reads across all processes
+
+    net, cpu -- mean network and CPU time per tile in ms
+    """
+    # (demand, servers) of queueing stations, multi-server split into queue and delay parts
+    stations = [(gil*cpu, nprocs), ((1 - gil)*cpu, cores)]
+    queue = [d/c for d, c in stations]
+    delay = sum(d*(c - 1)/c for d, c in stations)
+
+    q = [0.0 for _ in stations]
+    X = np.zeros(n_max)
+    for n in range(1, n_max + 1):
+        r = [d*(1 + qk) for d, qk in zip(queue, q)]
+        x = n/(net*(1 + beta*(n - 1)) + delay + sum(r))
+        q = [x*rk for rk in r]
+        X[n - 1] = x
+    return X
+
+
+def fit_model(data, cores=None, exclude=()):
+    """ Fit `beta` and `gil` to measured throughput
+
+    data    -- output of `reports.load_dir`
+    cores   -- CPU count, default is the one recorded with the results
+    exclude -- thread counts left out of the fit, still used for tile demands
+               if they have the fewest threads
+    """
+    data = _closed_loop(data)
+    if not data:
+        raise ValueError('No closed loop results to fit to')
+
+    ref = min(data)
+    net, cpu = tile_demands(data[ref])
+    points = {n: p for n, p in measured_points(data).items() if n not in exclude}
+    cores = cores or _recorded_cpus(data)
+
+    n_max = max(points) if points else ref
+    nn = np.r_[sorted(points)]
+    fps = np.r_[[points[n].throughput for n in nn]]
+
+    best = None
+    for beta in BETA_GRID:
+        for gil in GIL_GRID:
+            X = mva_throughput(net.mean(), cpu.mean(), n_max, cores=cores, beta=beta, gil=gil)*1000
+            err = np.sum(np.log(X[nn - 1]/fps)**2) if len(nn) else 0
+            if best is None or err < best[0] - 1e-12:
+                best = (err, beta, gil)
+
+    _, beta, gil = best
+    return SimpleNamespace(beta=beta, gil=gil, cores=cores, ref_threads=ref, net=net, cpu=cpu)
+
+
+def simulate(model, nthreads, nprocs=1, ntiles=2000, seed=0):
+    """ Discrete-event simulation of the fitted model
+
+    Returns SimpleNamespace(throughput (tiles per second), latency (ms per tile))
+    """
+    rng = np.random.RandomState(seed)
+    n = nthreads*nprocs
+    slow = 1 + model.beta*(n - 1)
+    samples = rng.randint(0, model.net.shape[0], size=ntiles + n)
+
+    events = []  # (time, seq, kind, thread)
+    seq = [0]
+    gil_busy = [False]*nprocs
+    gil_queue = [[] for _ in range(nprocs)]
+    cores_free = [model.cores]
+    cpu_queue = []
+    started = {}
+    latency = []
+    next_sample = [0]
+
+    def push(t, kind, th):
+        seq[0] += 1
+        heapq.heappush(events, (t, seq[0], kind, th))
+
+    def start_tile(t, th):
+        i = samples[next_sample[0]]
+        next_sample[0] += 1
+        started[th] = (t, i)
+        push(t + model.net[i]*slow, 'net', th)
+
+    def run_cpu(t, th):
+        if cores_free[0] > 0:
+            cores_free[0] -= 1
+            push(t + (1 - model.gil)*model.cpu[started[th][1]], 'cpu', th)
+        else:
+            cpu_queue.append(th)
+
+    for th in range(n):
+        start_tile(0.0, th)
+
+    t = 0.0
+    while len(latency) < ntiles:
+        t, _, kind, th = heapq.heappop(events)
+        p = th % nprocs
+        if kind == 'net':
+            if gil_busy[p]:
+                gil_queue[p].append(th)
+            else:
+                gil_busy[p] = True
+                push(t + model.gil*model.cpu[started[th][1]], 'gil', th)
+        elif kind == 'gil':
+            if gil_queue[p]:
+                nxt = gil_queue[p].pop(0)
+                push(t + model.gil*model.cpu[started[nxt][1]], 'gil', nxt)
+            else:
+                gil_busy[p] = False
+            run_cpu(t, th)
+        else:
+            cores_free[0] += 1
+            if cpu_queue:
+                run_cpu(t, cpu_queue.pop(0))
+            latency.append(t - started[th][0])
+            if next_sample[0] < samples.shape[0]:
+                start_tile(t, th)
+
+    return SimpleNamespace(throughput=len(latency)/t*1000,
+                           latency=np.r_[latency])
+
+
+def predict(data, threads=None, processes=(1,), cores=None):
+    """ Predicted throughput and latency percentiles, with prediction error for measured points
+
+    threads   -- thread counts to predict, default: measured ones plus powers of 2 up to 128
+    processes -- process counts to predict, every process runs `threads` threads
+
+    Returns SimpleNamespace(model, rows) where rows are
+    SimpleNamespace(nthreads, nprocs, throughput, p50, p99, measured, loo, error)
+    sorted by process then thread count. `measured` is None for unmeasured
+    points, `loo` is throughput predicted with that thread count left out of
+    the fit and `error` its relative error, None when there are fewer than
+    three measured thread counts.
+    """
+    data = _closed_loop(data)
+    model = fit_model(data, cores=cores)
+    points = measured_points(data)
+
+    if threads is None:
+        threads = sorted(set(points) | {2**i for i in range(8)})
+
+    loo = {}
+    if len(points) >= 3:
+        for n in points:
+            m = fit_model(data, cores=model.cores, exclude=(n,))
+            loo[n] = mva_throughput(m.net.mean(), m.cpu.mean(), n, cores=m.cores, beta=m.beta, gil=m.gil)[-1]*1000
+
+    rows = []
+    for nprocs in processes:
+        X = mva_throughput(model.net.mean(), model.cpu.mean(), max(threads)*nprocs,
+                           nprocs=nprocs, cores=model.cores, beta=model.beta, gil=model.gil)*1000
+        for n in threads:
+            sim = simulate(model, n, nprocs=nprocs)
+            p50, p99 = np.percentile(sim.latency, [50, 99])
+            measured = points.get(n) if nprocs == 1 else None
+            rr = SimpleNamespace(nthreads=n,
+                                 nprocs=nprocs,
+                                 throughput=X[n*nprocs - 1],
+                                 p50=p50,
+                                 p99=p99,
+                                 measured=measured,
+                                 loo=None,
+                                 error=None)
+            if measured is not None and n in loo:
+                rr.loo = loo[n]
+                rr.error = loo[n]/measured.throughput - 1
+            rows.append(rr)
+
+    return SimpleNamespace(model=model, rows=rows)
+
+
+def gen_predict_report(pr):
+    m = pr.model
+    lines = ['Model: {} cores, network slowdown {:.4f} per extra read, {:.0f}% of CPU time holds the GIL'.format(
+        m.cores, m.beta, m.gil*100),
+             '       per tile {:.2f} ms network, {:.2f} ms CPU (from {:d} thread runs)'.format(
+                 m.net.mean(), m.cpu.mean(), m.ref_threads),
+             '',
+             'procs threads   fps pred   p50    p99 (ms) | fps meas   p50    p99 (ms) | fps loo  error']
+    for r in pr.rows:
+        line = '{:5d} {:7d} {:10.1f} {:6.1f} {:6.1f}'.format(r.nprocs, r.nthreads, r.throughput, r.p50, r.p99)
+        if r.measured is not None:
+            line += '      | {:8.1f} {:6.1f} {:6.1f}'.format(r.measured.throughput, r.measured.p50, r.measured.p99)
+            if r.error is not None:
+                line += '      | {:7.1f} {:+5.1f}%'.format(r.loo, r.error*100)
+        lines.append(line)
+
+    errors = [abs(r.error) for r in pr.rows if r.error is not None]
+    if errors:
+        lines += ['', 'Leave-one-out throughput error: {:.1f}% mean, {:.1f}% max over {:d} thread counts'.format(
+            100*np.mean(errors), 100*max(errors), len(errors))]
+    else:
+        lines += ['', 'Need at least 3 measured thread counts to estimate prediction error']
+    return '\n'.join(lines)
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_predict():
+    rng = np.random.RandomState(1)
+    net = rng.lognormal(np.log(20), 0.5, 500)
+    cpu = rng.uniform(1, 3, 500)
+    truth = SimpleNamespace(beta=0.01, gil=0.5, cores=4, ref_threads=1, net=net, cpu=cpu)
+
+    # fake results of a thread sweep, generated by the model itself
+    data = {}
+    for n in (1, 2, 4, 8, 16, 32):
+        sim = simulate(truth, n, ntiles=1000, seed=n)
+        tt = sim.latency
+        data[n] = [SimpleNamespace(params=SimpleNamespace(nthreads=n),
+                                   _raw=SimpleNamespace(env=dict(cpus=4)),
+                                   t_total=tt,
+                                   cpu_open=np.full_like(tt, cpu.mean()),
+                                   cpu_read=np.zeros_like(tt),
+                                   cached=None,
+                                   duration=tt.shape[0]/sim.throughput)]
+
+    pr = predict(data, threads=[1, 4, 32, 64], processes=(1, 2))
+    assert pr.model.cores == 4
+    assert abs(pr.model.gil - 0.5) <= 0.25
+
+    rows = {(r.nprocs, r.nthreads): r for r in pr.rows}
+    assert rows[(1, 64)].measured is None and rows[(2, 4)].measured is None
+    assert all(abs(rows[(1, n)].error) < 0.2 for n in (1, 4, 32))
+    assert rows[(2, 32)].throughput > rows[(1, 32)].throughput
+    assert rows[(1, 64)].p99 >= rows[(1, 64)].p50
+
+    assert 'Leave-one-out' in gen_predict_report(pr)
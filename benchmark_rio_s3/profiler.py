@@ -0,0 +1,194 @@
+""" Sampling profiler for worker threads
+
+Periodically captures python stacks of a given set of threads using
+`sys._current_frames()`. Every sample is classified as one of
+
+- python -- thread was executing python bytecode (holding the GIL)
+- native -- thread was inside a call into C code, for worker threads this is
+            mostly rasterio/GDAL (open, read), GIL is usually released
+- idle   -- thread was blocked in `threading`/`queue` waiting for work
+
+Classification is based on the instruction the leaf frame is at: a frame that
+is a leaf while sitting on a CALL instruction has called into C code.
+"""
+import dis
+import os
+import sys
+import threading
+from collections import Counter
+from timeit import default_timer as t_now
+from types import SimpleNamespace
+
+__all__ = ['StackSampler']
+
+_CALL_OPS = {'CALL', 'CALL_KW', 'CALL_FUNCTION', 'CALL_FUNCTION_KW', 'CALL_FUNCTION_EX',
+             'CALL_METHOD', 'PRECALL', 'BEFORE_WITH', 'SETUP_WITH', 'WITH_EXCEPT_START'}
+_IDLE_FILES = ('threading.py', 'queue.py', os.path.join('concurrent', 'futures', 'thread.py'))
+
+
+class StackSampler(object):
+    """Sample stacks of threads with given ids at `rate` Hz
+
+    ```
+    with StackSampler(thread_ids, rate=100) as prof:
+        do_work()
+    prof.write_folded('out.folded')
+    print(gen_profile_report(prof.summary()))
+    ```
+    """
+    def __init__(self, thread_ids, rate=100, max_depth=64):
+        self._names = {tid: 'worker-{:02d}'.format(i) for i, tid in enumerate(thread_ids)}
+        self._interval = 1.0/rate
+        self._max_depth = max_depth
+        self._stop = threading.Event()
+        self._thread = None
+        self._ops = {}
+        self.rate = rate
+        self.stacks = Counter()
+        self.nsamples = 0
+        self.t_sampling = 0
+        self.duration = 0
+
+    def _opname(self, frame):
+        code = frame.f_code
+        ops = self._ops.get(code)
+        if ops is None:
+            ops = {i.offset: i.opname for i in dis.get_instructions(code)}
+            self._ops[code] = ops
+        return ops.get(frame.f_lasti)
+
+    def _classify(self, frame):
+        if self._opname(frame) not in _CALL_OPS:
+            return 'python'
+        if frame.f_code.co_filename.endswith(_IDLE_FILES):
+            return 'idle'
+        return 'native'
+
+    @staticmethod
+    def _label(frame):
+        code = frame.f_code
+        return '{} ({}:{:d})'.format(code.co_name,
+                                     os.path.basename(code.co_filename),
+                                     frame.f_lineno or 0)
+
+    def sample(self):
+        frames = sys._current_frames()
+        for tid, name in self._names.items():
+            frame = frames.get(tid)
+            if frame is None:
+                continue
+
+            category = self._classify(frame)
+            stack = []
+            while frame is not None and len(stack) < self._max_depth:
+                stack.append(self._label(frame))
+                frame = frame.f_back
+
+            self.stacks[(name, category, tuple(reversed(stack)))] += 1
+        self.nsamples += 1
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            t0 = t_now()
+            self.sample()
+            self.t_sampling += t_now() - t0
+
+    def start(self):
+        self._stop.clear()
+        self._t0 = t_now()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = t_now() - self._t0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def write_folded(self, fname):
+        """ Write stacks in "folded" format understood by flamegraph.pl/speedscope
+        """
+        with open(fname, 'wt') as f:
+            for (name, category, stack), n in sorted(self.stacks.items()):
+                f.write('{};{};[{}] {:d}\n'.format(name, ';'.join(stack), category, n))
+
+    def summary(self, top=10):
+        categories = Counter()
+        leaves = {}
+        for (_, category, stack), n in self.stacks.items():
+            categories[category] += n
+            leaves.setdefault(category, Counter())[stack[-1] if stack else '?'] += n
+
+        return SimpleNamespace(rate=self.rate,
+                               nsamples=self.nsamples,
+                               nthreads=len(self._names),
+                               duration=self.duration,
+                               overhead=self.t_sampling/max(self.duration, 1e-9),
+                               categories=dict(categories),
+                               top={k: v.most_common(top) for k, v in leaves.items()})
+
+
+def gen_profile_report(ss):
+    total = max(sum(ss.categories.values()), 1)
+    lines = ['Profile: {:d} samples of {:d} threads at {:d} Hz, sampler overhead {:.2f}%'.format(
+        ss.nsamples, ss.nthreads, int(ss.rate), ss.overhead*100)]
+
+    for category in ('python', 'native', 'idle'):
+        n = ss.categories.get(category, 0)
+        lines.append('  {:7s} {:5.1f}%'.format(category, 100*n/total))
+
+    for category in ('python', 'native'):
+        top = ss.top.get(category, [])
+        if not top:
+            continue
+        lines.append('Top frames ({}):'.format(category))
+        for label, n in top:
+            lines.append('  {:5.1f}% {}'.format(100*n/total, label))
+
+    return '\n'.join(lines)
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_stack_sampler(tmpdir):
+    done = threading.Event()
+
+    def busy():
+        x = 0
+        while not done.is_set():
+            x += 1
+
+    def sleepy():
+        done.wait()
+
+    tt = [threading.Thread(target=f) for f in (busy, sleepy)]
+    for t in tt:
+        t.start()
+
+    with StackSampler([t.ident for t in tt], rate=200) as prof:
+        t_end = t_now() + 0.2
+        while t_now() < t_end:
+            done.wait(0.01)
+
+    done.set()
+    for t in tt:
+        t.join()
+
+    ss = prof.summary()
+    assert ss.nsamples > 0
+    assert ss.categories.get('python', 0) > 0
+    assert ss.categories.get('idle', 0) > 0
+
+    fname = str(tmpdir/'out.folded')
+    prof.write_folded(fname)
+    lines = open(fname).read().splitlines()
+    assert lines[0].startswith('worker-0')
+    assert 'python' in gen_profile_report(ss)
@@ -0,0 +1,474 @@
+""" Record and replay access traces
+
+A trace is what one benchmark run did: for every tile the url, block, start
+time relative to the start of the run, worker thread, open and read times and
+byte ranges fetched while opening the file and while reading the tile. For
+remote files these are the ranges GDAL actually downloaded, taken from its
+debug log (`RangeLog`), local reads are not logged, so whole local files are
+captured. Bytes of those ranges are captured after the run, so a trace can be
+replayed without access to the original bucket.
+
+`serve_trace` runs a local HTTP endpoint that serves the recorded bytes and
+delays every response by the recorded time of the matching request, the same
+schedule is then re-issued either at the original start times or as fast as
+possible. Requests for bytes that were not recorded fail with HTTP 500.
+With the server side fixed, differences between replays of the same trace
+come from the client: GDAL version or config, thread count, python overhead.
+
+Recorded times include client side overhead of the recorded run, so replay
+latency is an upper bound of what S3 did, but it is the same for every
+replay.
+"""
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from .httpserve import RangeRequestHandler, run_server, parse_range
+from timeit import default_timer as t_now
+
+__all__ = ['make_trace', 'capture_bytes', 'save_trace', 'load_trace', 'serve_trace', 'replay_schedule',
+           'replay_trace']
+
+TIMINGS = ('original', 'fast')
+
+# "VSICURL: Downloading 0-16383 (https://...)...", "S3: Downloading 100-200,300-400 (...)..."
+_DOWNLOAD_RE = re.compile(r'Downloading ([\d,\-]+) \(')
+
+
+class RangeLog(logging.Handler):
+    """ Byte ranges GDAL downloads, per worker thread, from its debug log
+
+    GDAL reports every HTTP range request of `/vsicurl/` and `/vsis3/` with
+    CPL_DEBUG=ON, rasterio forwards those messages to python logging in the
+    thread that made the request.
+
+    ```
+    with RangeLog() as log:
+        # open and read, with CPL_DEBUG=ON in rasterio.Env
+        ranges = log.pop(t_start)  # [(t, start, stop)] of this thread since t_start
+    ```
+    """
+    LOGGER = 'rasterio'
+
+    def __init__(self):
+        super().__init__(level=logging.DEBUG)
+        self._ranges = defaultdict(list)
+        self._level = None
+
+    def emit(self, record):
+        m = _DOWNLOAD_RE.search(record.getMessage())
+        if m is None:
+            return
+        t = t_now()
+        rr = self._ranges[threading.get_ident()]
+        for part in m.group(1).split(','):
+            start, _, end = part.partition('-')
+            if start and end:
+                rr.append((t, int(start), int(end) + 1))
+
+    def pop(self, t_start):
+        """ Ranges downloaded by the calling thread since `t_start`, clears this thread's log
+        """
+        rr = self._ranges.pop(threading.get_ident(), [])
+        return [r for r in rr if r[0] >= t_start]
+
+    def __enter__(self):
+        log = logging.getLogger(self.LOGGER)
+        self._level = log.level
+        log.setLevel(logging.DEBUG)
+        log.addHandler(self)
+        return self
+
+    def __exit__(self, *args):
+        log = logging.getLogger(self.LOGGER)
+        log.removeHandler(self)
+        log.setLevel(self._level)
+
+
+def merge_ranges(ranges):
+    """ Sorted, non-overlapping (start, stop) ranges covering the same bytes
+    """
+    out = []
+    for start, stop in sorted(ranges):
+        if out and start <= out[-1][1]:
+            out[-1] = (out[-1][0], max(out[-1][1], stop))
+        else:
+            out.append((start, stop))
+    return out
+
+
+def _phased(ranges):
+    """ Ranges as (phase, start, stop), older traces have (start, stop): header then tile
+    """
+    if ranges and len(ranges[0]) == 2:
+        return [('open' if i == 0 else 'read', a, b) for i, (a, b) in enumerate(ranges)]
+    return list(ranges)
+
+
+def _trace_reads(xx, urls, workers, t0):
+    reads = []
+    for url, s in zip(urls, xx.stats):
+        if s is None:
+            reads.append(SimpleNamespace(url=url, ok=False))
+            continue
+        reads.append(SimpleNamespace(url=url,
+                                     ok=True,
+                                     t_start=s.t0 - t0,
+                                     thread=workers.get(s.thread),
+                                     t_open=s.t_open,
+                                     t_read=s.t_total - s.t_open,
+                                     ranges=_phased(s.ranges),
+                                     ranges_logged=getattr(s, 'ranges_logged', False)))
+    return reads
+
+
+def make_trace(xx, urls, thread_ids, header_size, warmup=None):
+    """ Build trace from results of `read_blocks(.., trace=True)`
+
+    thread_ids -- worker thread identifiers in worker order, as returned by `.thread_ids()`
+    warmup     -- None| (result, urls) of a warmup `read_blocks(.., trace=True)`
+                  done before, GDAL caches what it downloaded then, so later
+                  reads of the same urls may not make any requests
+
+    Every read has `ranges`: [(phase, start, stop)], phase is 'open' or
+    'read', and `ranges_logged`: False when ranges are header and tile
+    guessed from the tile offset, rather than requests GDAL made. Warmup
+    reads are kept in `warmup`, their bytes are captured and their requests
+    served, but they are not part of the replay schedule.
+    """
+    workers = {tid: i for i, tid in enumerate(thread_ids)}
+    reads = _trace_reads(xx, urls, workers, xx.t0)
+    warmup_reads = [] if warmup is None else _trace_reads(warmup[0], warmup[1], workers, xx.t0)
+
+    return SimpleNamespace(params=xx.params,
+                           t_total=xx.t_total,
+                           header_size=header_size,
+                           reads=reads,
+                           warmup=warmup_reads,
+                           sizes={},
+                           data={})
+
+
+def _all_reads(trace):
+    """ Successful warmup and measured reads in the order they were started
+    """
+    reads = list(getattr(trace, 'warmup', None) or []) + trace.reads
+    return sorted((r for r in reads if r.ok), key=lambda r: r.t_start)
+
+
+def _read_local(path, ranges):
+    with open(path, 'rb') as f:
+        out = []
+        for start, stop in ranges:
+            f.seek(start)
+            out.append(f.read(stop - start))
+    return os.path.getsize(path), out
+
+
+def _read_remote(url, ranges, get_request_maker):
+    from .httpread import url_fetcher
+
+    fetch = url_fetcher(url, get_request_maker, with_size=True)
+    rr = [fetch(start, stop) for start, stop in ranges]
+    return rr[0][1], [data for data, _ in rr]
+
+
+def capture_bytes(trace, nthreads=16, get_request_maker=None):
+    """ Fetch recorded byte ranges of every successful read into the trace
+
+    Ranges of all reads of the same url are merged and fetched once. Reads of
+    local files are not logged by GDAL, so whole local files are captured.
+
+    get_request_maker -- () -> S3 request builder, needed for s3:// urls
+    """
+    ranges = defaultdict(list)
+    for r in _all_reads(trace):
+        ranges[r.url].extend((a, b) for _, a, b in _phased(r.ranges))
+
+    def capture(url):
+        rr = merge_ranges(ranges[url])
+        if url.startswith(('s3://', 'http://', 'https://')):
+            size, data = _read_remote(url, rr, get_request_maker)
+        else:
+            rr = [(0, os.path.getsize(url))]
+            size, data = _read_local(url, rr)
+        return url, size, [(start, d) for (start, _), d in zip(rr, data)]
+
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        for url, size, segments in pool.map(capture, list(ranges)):
+            trace.sizes[url] = size
+            trace.data[url] = segments
+
+    return trace
+
+
+def save_trace(trace, fname):
+    with open(fname, 'wb') as f:
+        pickle.dump(trace, f)
+
+
+def load_trace(fname):
+    with open(fname, 'rb') as f:
+        return pickle.load(f)
+
+
+def missing_range(segments, start, stop):
+    """ First part of [start, stop) not covered by recorded (offset, bytes) segments, None if all covered
+    """
+    pos = start
+    for a, b in merge_ranges((offset, offset + len(data)) for offset, data in segments):
+        if b <= pos:
+            continue
+        if a > pos:
+            return (pos, min(a, stop))
+        pos = b
+        if pos >= stop:
+            return None
+    return (pos, stop)
+
+
+def assemble(segments, start, stop):
+    """ Bytes [start, stop) from recorded (offset, bytes) segments, zeros where nothing was recorded
+    """
+    out = bytearray(stop - start)
+    for offset, data in segments:
+        a, b = max(start, offset), min(stop, offset + len(data))
+        if a < b:
+            out[a - start:b - start] = data[a - offset:b - offset]
+    return bytes(out)
+
+
+def replay_schedule(trace, timing='original'):
+    """ Urls in the order they were started, and start offsets in seconds,
+    offsets are None when timing is 'fast'. Failed reads are not replayed.
+    """
+    if timing not in TIMINGS:
+        raise ValueError('Unknown timing: {}, only know: {}'.format(timing, ','.join(TIMINGS)))
+
+    reads = sorted((r for r in trace.reads if r.ok), key=lambda r: r.t_start)
+    urls = [r.url for r in reads]
+    if timing == 'fast' or len(reads) == 0:
+        return urls, None
+
+    t0 = reads[0].t_start
+    return urls, [r.t_start - t0 for r in reads]
+
+
+def request_delays(trace):
+    """ url -> [(start, stop, delay)] for every recorded request, in the order reads were started
+
+    Open and read time of a read are split evenly between the requests made in
+    that phase.
+    """
+    out = defaultdict(list)
+    for r in _all_reads(trace):
+        ranges = _phased(r.ranges)
+        for phase, t in (('open', r.t_open), ('read', r.t_read)):
+            rr = [(a, b) for p, a, b in ranges if p == phase]
+            out[r.url].extend((a, b, t/len(rr)) for a, b in rr)
+    return out
+
+
+@contextmanager
+def _trace_server(trace, latency_scale=1.0, host='127.0.0.1', port=0):
+    names = {}
+    files = {}
+    for i, url in enumerate(trace.sizes):
+        name = '/{:d}/{}'.format(i, re.sub(r'[^\w.\-]', '_', url.rsplit('/', 1)[-1]))
+        names[url] = name
+        files[name] = url
+
+    pending = request_delays(trace)
+    last = {}
+    lock = threading.Lock()
+
+    def next_delay(url, start, stop):
+        with lock:
+            rr = pending[url]
+            for i, (a, b, delay) in enumerate(rr):
+                if a < stop and b > start:
+                    last[url] = delay
+                    return rr.pop(i)[2]
+            return last.get(url, 0)
+
+    class Handler(RangeRequestHandler):
+        def _serve(self, head_only):
+            url = files.get(self.path.split('?')[0])
+            if url is None:
+                self.send_error(404, 'File not found')
+                return
+            size = trace.sizes[url]
+            roi = parse_range(self.headers.get('Range'), size)
+
+            if not head_only and roi is not None:
+                missing = missing_range(trace.data[url], *roi)
+                if missing is not None:
+                    self.send_error(500, 'Bytes {}-{} of {} were not recorded'.format(missing[0], missing[1] - 1, url))
+                    return
+                if latency_scale > 0:
+                    time.sleep(next_delay(url, *roi)*latency_scale)
+
+            self.send_bytes(size, lambda start, stop: assemble(trace.data[url], start, stop), head_only=head_only)
+
+        def do_GET(self):
+            self._serve(head_only=False)
+
+        def do_HEAD(self):
+            self._serve(head_only=True)
+
+    with run_server(Handler, host=host, port=port) as base_url:
+        yield {url: base_url + name for url, name in names.items()}
+
+
+def _run_trace_server(trace, latency_scale, host, port, conn):
+    with _trace_server(trace, latency_scale=latency_scale, host=host, port=port) as url_map:
+        conn.send(url_map)
+        conn.recv()
+
+
+@contextmanager
+def serve_trace(trace, latency_scale=1.0, host='127.0.0.1', port=0):
+    """ Serve recorded bytes over HTTP with recorded latencies
+
+    Every request is matched to the first not yet served recorded request of
+    the same url that overlaps it, and delayed by its time, times
+    `latency_scale`. Requests for bytes that were not captured get HTTP 500,
+    rather than a file with holes in it.
+
+    Server runs in a separate process: GDAL holds the GIL while opening a
+    file, a server thread in the same process would stall.
+
+    Yields dictionary: original url -> replay url
+    """
+    import multiprocessing as mp
+
+    ctx = mp.get_context('spawn')
+    conn, child_conn = ctx.Pipe()
+    proc = ctx.Process(target=_run_trace_server,
+                       args=(trace, latency_scale, host, port, child_conn),
+                       daemon=True)
+    proc.start()
+    try:
+        yield conn.recv()
+    finally:
+        conn.send(None)
+        proc.join(5)
+        if proc.is_alive():
+            proc.terminate()
+
+
+def replay_trace(trace_file, timing='original', nthreads=None, mode='rio', latency_scale=1.0, header_size=None,
+                 wmore=True, gdal_opts=None, prefix='RPL'):
+    """ Serve bytes of a recorded trace and re-issue its reads with `bench.run_main`
+
+    nthreads    -- None| default is the thread count of the recorded run
+    header_size -- None| header size in KiB, 0 -- don't set, default is the same as recorded run
+    """
+    from .bench import run_main
+
+    tr = load_trace(trace_file)
+    pp = tr.params
+    urls, arrivals = replay_schedule(tr, timing)
+    if len(urls) == 0:
+        raise ValueError('No successful reads in {}'.format(trace_file))
+
+    if header_size is not None:
+        bytes_at_open = header_size*1024 if header_size > 0 else None
+    else:
+        bytes_at_open = pp.bytes_at_open
+
+    with serve_trace(tr, latency_scale=latency_scale) as url_map:
+        run_main([url_map[u] for u in urls], nthreads or pp.nthreads,
+                 prefix=prefix,
+                 mode=mode,
+                 wmore=wmore,
+                 block=pp.block,
+                 block_shape=pp.block_shape,
+                 dtype=pp.dtype,
+                 bytes_at_open=bytes_at_open,
+                 gdal_opts=gdal_opts,
+                 arrivals=arrivals,
+                 overview_level=getattr(pp, 'overview_level', None),
+                 out_shape=getattr(pp, 'out_shape', None),
+                 replay=dict(trace=os.path.abspath(trace_file),
+                             timing=timing,
+                             latency_scale=latency_scale,
+                             nthreads=pp.nthreads))
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_assemble():
+    segments = [(0, b'abcd'), (10, b'xyz')]
+    assert assemble(segments, 0, 4) == b'abcd'
+    assert assemble(segments, 2, 12) == b'cd\0\0\0\0\0\0xy'
+    assert assemble(segments, 20, 22) == b'\0\0'
+
+    assert missing_range(segments, 1, 4) is None
+    assert missing_range(segments + [(4, b'efghij')], 0, 13) is None
+    assert missing_range(segments, 2, 12) == (4, 10)
+    assert missing_range(segments, 11, 20) == (13, 20)
+    assert merge_ranges([(5, 7), (0, 2), (1, 3), (7, 8)]) == [(0, 3), (5, 8)]
+
+    trace = SimpleNamespace(reads=[SimpleNamespace(url='a', ok=True, t_start=1, t_open=0.2, t_read=0.1,
+                                                   ranges=[('open', 0, 10), ('open', 90, 100), ('read', 50, 60)]),
+                                   SimpleNamespace(url='a', ok=True, t_start=0, t_open=0.4, t_read=0.3,
+                                                   ranges=[(0, 10), (50, 60)])])
+    assert request_delays(trace)['a'] == [(0, 10, 0.4), (50, 60, 0.3),
+                                          (0, 10, 0.1), (90, 100, 0.1), (50, 60, 0.1)]
+
+
+def test_record_replay(tmpdir):
+    import numpy as np
+    import rasterio
+    from .pprio_bench import PReadRIO_bench
+
+    urls = []
+    for i in range(3):
+        fname = str(tmpdir/'im{}.tif'.format(i))
+        with rasterio.open(fname, 'w', driver='GTiff', width=64, height=64, count=1, dtype='uint16',
+                           tiled=True, blockxsize=32, blockysize=32, compress='deflate') as f:
+            f.write(np.arange(64*64, dtype='uint16').reshape(64, 64) + i, 1)
+        urls.append(fname)
+
+    rdr = PReadRIO_bench(2, region_name='us-west-2')
+    pix = np.zeros((3, 32, 32), dtype='uint16')
+    _, xx = rdr.read_blocks(urls, (1, 0), dst=pix, trace=True)
+
+    trace = capture_bytes(make_trace(xx, urls, rdr.thread_ids(), header_size=16*1024))
+    fname = str(tmpdir/'run.trace')
+    save_trace(trace, fname)
+    trace = load_trace(fname)
+
+    assert all(r.thread in (0, 1) for r in trace.reads)
+    order, offsets = replay_schedule(trace)
+    assert sorted(order) == sorted(urls)
+    assert offsets[0] == 0
+    assert replay_schedule(trace, 'fast')[1] is None
+
+    with serve_trace(trace, latency_scale=0) as url_map:
+        for i, url in enumerate(urls):
+            with rasterio.open(url_map[url]) as f:
+                im = f.read(1, window=f.block_window(1, 1, 0))
+            assert (im == pix[i]).all()
+
+    # bytes that were not captured fail loudly instead of reading as zeros
+    import pytest
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+
+    trace.data[urls[0]] = [(0, trace.data[urls[0]][0][1][:100])]
+    with serve_trace(trace, latency_scale=0) as url_map:
+        assert len(urlopen(Request(url_map[urls[0]], headers={'Range': 'bytes=0-99'})).read()) == 100
+        with pytest.raises(HTTPError) as e:
+            urlopen(Request(url_map[urls[0]], headers={'Range': 'bytes=0-200'}))
+        assert e.value.code == 500
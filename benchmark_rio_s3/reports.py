@@ -1,8 +1,12 @@
 import glob
+import os
 import pickle
 import numpy as np
 import itertools
 from types import SimpleNamespace
+from collections import Counter
+from .monitor import cpu_utilisation
+from .scenes import scene_latency
 
 
 def files_per_second(t_end):
@@ -27,10 +31,59 @@ def unpack_stats(xx, ms=False):
     t_read = t_total - t_open
 
     t0 = np.r_[[r.t0 for r in stats]]*t_scaler
-    t0 -= t0.min()
+    t_start = t0.min()
+    t0 -= t_start
     t_end = t0 + t_total
     fps_t, fps = files_per_second(t_end/t_scaler)
 
+    if len(stats) > 0 and hasattr(stats[0], 'cpu_open'):
+        cpu_open = np.r_[[r.cpu_open for r in stats]]*t_scaler
+        cpu_read = np.r_[[r.cpu_read for r in stats]]*t_scaler
+    else:
+        cpu_open, cpu_read = None, None
+
+    # tiles served from the local tile cache, file was not opened for those
+    cached = np.r_[[getattr(r, 'cached', False) for r in stats]].astype(bool)
+    attempts = np.r_[[getattr(r, 'attempts', 1) for r in stats]]
+    t_retry = np.r_[[getattr(r, 't_retry', 0) for r in stats]]*t_scaler
+
+    # every failed attempt, including ones that were later retried successfully
+    failed = [e for ee in getattr(xx, 'errors', None) or [] if ee for e in ee]
+    retries_by_kind = Counter(e.kind for e in failed)
+    t_failed = sum(e.t_failed + (e.delay or 0) for e in failed)*t_scaler
+
+    # final outcome for tiles that never succeeded
+    errors_by_kind = Counter()
+    for r, ee in zip(xx.stats, getattr(xx, 'errors', None) or [None]*len(xx.stats)):
+        if r is None:
+            errors_by_kind[ee[-1].kind if ee else 'other'] += 1
+
+    # open loop runs: scheduled start, time spent queued, latency as seen by a client
+    t_sched, t_queue, latency = None, None, None
+    if len(stats) > 0 and getattr(stats[0], 't_sched', None) is not None:
+        t_sched = np.r_[[r.t_sched for r in stats]]*t_scaler - t_start
+        t_queue = t0 - t_sched
+        latency = t_end - t_sched
+
+    # multi-band runs: latency of a whole scene, i.e. of the slowest band
+    t_scene, n_bad_scenes = None, 0
+    nbands = getattr(xx.params, 'nbands', None)
+    if nbands:
+        t_scene, n_bad_scenes = scene_latency(xx.stats, nbands)
+        t_scene = t_scene*t_scaler
+
+    cpu_util_t, cpu_util = None, None
+    cpu_tl = getattr(xx, 'cpu', None)
+    if cpu_tl is not None:
+        cpu_util_t, cpu_util = cpu_utilisation(cpu_tl)
+        cpu_util_t = cpu_util_t*t_scaler - t_start
+
+    # memory timeline in bytes, older results don't have it
+    mem_t, rss, gdal_cache = None, None, None
+    if getattr(cpu_tl, 'rss', None) is not None:
+        mem_t = cpu_tl.t*t_scaler - t_start
+        rss, gdal_cache = cpu_tl.rss, cpu_tl.gdal_cache
+
     return SimpleNamespace(chunk_size=chunk_size,
                            nthreads=xx.params.nthreads,
                            params=xx.params,
@@ -39,7 +92,29 @@ def unpack_stats(xx, ms=False):
                            t_end=t_end,
                            t_open=t_open,
                            t_read=t_read,
+                           cpu_open=cpu_open,
+                           cpu_read=cpu_read,
+                           t_sched=t_sched,
+                           t_queue=t_queue,
+                           latency=latency,
+                           t_scene=t_scene,
+                           n_bad_scenes=n_bad_scenes,
+                           cpu_util_t=cpu_util_t,
+                           cpu_util=cpu_util,
+                           mem_t=mem_t,
+                           rss=rss,
+                           gdal_cache=gdal_cache,
+                           peak_rss=_nanmax(rss),
+                           peak_gdal_cache=_nanmax(gdal_cache),
                            n_bad=n_bad,
+                           errors_by_kind=errors_by_kind,
+                           retries_by_kind=retries_by_kind,
+                           attempts=attempts,
+                           cached=cached,
+                           tile_cache=getattr(xx, 'tile_cache', None),
+                           netcheck=getattr(xx, 'netcheck', None),
+                           t_retry=t_retry,
+                           t_failed=t_failed,
                            duration=xx.t_total,
                            throughput=np.median(fps),
                            throughput_max=fps.max(),
@@ -48,6 +123,12 @@ def unpack_stats(xx, ms=False):
                            t_total=t_total)
 
 
+def _nanmax(x):
+    if x is None or np.isnan(x).all():
+        return None
+    return np.nanmax(x)
+
+
 def join_reports(s1, s2):
     s1 = s1.split('\n')
     s2 = s2.split('\n')
@@ -66,6 +147,37 @@ def join_reports(s1, s2):
     return '\n'.join(ll)
 
 
+def format_order(params):
+    """ Url ordering strategy used for a run, 'as-is' for runs that don't record it
+    """
+    order = getattr(params, 'order', None) or 'as-is'
+    if order == 'shuffle':
+        order += ' (seed {})'.format(getattr(params, 'order_seed', 0))
+    return order
+
+
+def format_level(params):
+    """ Pyramid level and output size of reads, 'full' for full resolution blocks
+    """
+    level = getattr(params, 'overview_level', None)
+    out = 'full' if level is None else 'overview {}'.format(level)
+    out_shape = getattr(params, 'out_shape', None)
+    if out_shape is not None:
+        out += ', decimated to {}x{}'.format(out_shape[1], out_shape[0])
+    return out
+
+
+def format_affinity(params):
+    """ Worker placement policy of a run, plus process CPU restriction if any,
+    'none' for runs that don't record it
+    """
+    out = getattr(params, 'affinity', None) or 'none'
+    cpus = getattr(params, 'cpus', None)
+    if cpus:
+        out += ' (cpus {})'.format(cpus)
+    return out
+
+
 def gen_stats_report(xx, extra_msg=None):
 
     if not isinstance(xx, StatsResult):
@@ -82,8 +194,14 @@ def gen_stats_report(xx, extra_msg=None):
 Tile: {pp.block[0]:d}_{pp.block[1]:d}#{pp.band:d}
    - blocks  : {pp.block_shape[0]:d}x{pp.block_shape[1]:d}@{pp.dtype}
    - nthreads: {pp.nthreads:d}
+   - order   : {order}
+   - level   : {level}
+   - affinity: {affinity}
 {extra_msg}
 '''.format(pp=xx.params,
+           order=format_order(xx.params),
+           level=format_level(xx.params),
+           affinity=format_affinity(xx.params),
            extra_msg='' if extra_msg is None else '   - ' + extra_msg).strip()
 
     if hash is not None:
@@ -96,6 +214,15 @@ Tile: {pp.block[0]:d}_{pp.block[1]:d}#{pp.band:d}
     else:
         failures = ''
 
+    errors = gen_errors_report(xx)
+    open_loop = gen_open_loop_report(xx)
+    scenes = gen_scenes_report(xx)
+
+    cpu = gen_cpu_report(xx)
+    memory = gen_memory_report(xx)
+    cache = gen_cache_report(xx)
+    ceilings = gen_ceiling_report(xx)
+
     return '''
 -------------------------------------------------------------
 {}
@@ -117,7 +244,7 @@ total_wait: {:7.2f} sec (across all threads)
 walltime  : {:7.2f} sec
 throughput: {:6.1f} tiles per second
             {:6.1f} tiles per second per thread
--------------------------------------------------------------
+{}{}{}{}{}{}{}-------------------------------------------------------------
 '''.format(hdr,
            hash,
            failures,
@@ -130,7 +257,197 @@ throughput: {:6.1f} tiles per second
            (t_total.sum()*1e-3).round(),
            xx.duration,
            xx.throughput,
-           xx.throughput/xx.nthreads).strip()
+           xx.throughput/xx.nthreads,
+           scenes,
+           open_loop,
+           errors,
+           cpu,
+           memory,
+           cache,
+           ceilings).strip()
+
+
+def _percentiles(x, pp=(50, 90, 99)):
+    return np.percentile(x, pp) if x.shape[0] > 0 else np.zeros(len(pp))
+
+
+def gen_open_loop_report(xx):
+    """ Open-loop part of the stats report, empty string for closed loop runs
+    """
+    if getattr(xx, 't_sched', None) is None:
+        return ''
+
+    pp = xx.params
+    # in scene mode rate is in scenes per second
+    rate = pp.rate*(getattr(pp, 'nbands', None) or 1)
+    return '''
+open loop : {:6.1f} tiles per second offered ({}), {:6.1f} achieved
+            {:d} max in-flight
+ Time        p50     p90     p99      Max
+  - queued  {:7.1f} {:7.1f} {:7.1f} {:8.1f} ms
+  - latency {:7.1f} {:7.1f} {:7.1f} {:8.1f} ms
+'''.format(rate, pp.arrival, xx.chunk_size.shape[0]/xx.duration,
+           getattr(pp, 'max_inflight', 0),
+           *_percentiles(xx.t_queue), xx.t_queue.max(),
+           *_percentiles(xx.latency), xx.latency.max())
+
+
+def gen_scenes_report(xx):
+    """ Per-scene part of the stats report, empty string for single band runs
+    """
+    if getattr(xx, 't_scene', None) is None:
+        return ''
+
+    t_scene = xx.t_scene
+    n_scenes = t_scene.shape[0]
+    return '''
+scenes    : {:,d} x {:d} bands{}
+            {:6.1f} scenes per second
+ Time        p50     p90     p99      Max
+  - scene   {:7.1f} {:7.1f} {:7.1f} {:8.1f} ms
+'''.format(n_scenes + xx.n_bad_scenes, xx.params.nbands,
+           ', {:,d} incomplete'.format(xx.n_bad_scenes) if xx.n_bad_scenes else '',
+           n_scenes/xx.duration,
+           *_percentiles(t_scene), t_scene.max() if n_scenes > 0 else 0)
+
+
+def _fmt_kinds(counts):
+    return ', '.join('{}: {:d}'.format(k, n) for k, n in counts.most_common())
+
+
+def gen_errors_report(xx):
+    """ Failures and retries part of the stats report, empty if there were none
+
+    Effective throughput counts only successful tiles over the whole walltime,
+    so time lost on failed and retried reads is not hidden.
+    """
+    n_retries = sum(xx.retries_by_kind.values())
+    if xx.n_bad == 0 and n_retries == 0:
+        return ''
+
+    n_good = xx.chunk_size.shape[0]
+    out = '''
+Failed tiles           : {:,d} ({})
+Failed attempts        : {:,d} ({})
+Attempts per tile      : {:.3f} average, {:d} max
+Time lost to failures  : {:7.2f} sec (failed attempts and backoff)
+effective : {:6.1f} tiles per second
+'''.format(xx.n_bad, _fmt_kinds(xx.errors_by_kind) or '-',
+           n_retries, _fmt_kinds(xx.retries_by_kind) or '-',
+           xx.attempts.mean() if n_good > 0 else 0,
+           int(xx.attempts.max()) if n_good > 0 else 0,
+           xx.t_failed*1e-3,
+           n_good/xx.duration)
+    return out
+
+
+def gen_cpu_report(xx):
+    """ CPU part of the stats report, empty string for results without CPU data
+
+    Low CPU share means threads were mostly waiting on the network, high CPU
+    share points at decode or GIL contention.
+    """
+    if getattr(xx, 'cpu_open', None) is None:
+        return ''
+
+    t_open, t_read = xx.t_open, xx.t_read
+    cpu_open, cpu_read = xx.cpu_open, xx.cpu_read
+
+    out = '''
+ CPU         Median Min          Max      CPU/Wall
+ per tile  --------------------------
+  - open    {:7.3f} [{:.<6.1f}..{:.>7.1f}] ms {:4.1f}%
+  - read    {:7.3f} [{:.<6.1f}..{:.>7.1f}] ms {:4.1f}%
+'''.format(np.median(cpu_open), cpu_open.min(), cpu_open.max(), 100*cpu_open.sum()/max(t_open.sum(), 1e-9),
+           np.median(cpu_read), cpu_read.min(), cpu_read.max(), 100*cpu_read.sum()/max(t_read.sum(), 1e-9))
+
+    if getattr(xx, 'cpu_util', None) is not None and xx.cpu_util.shape[0] > 0:
+        out += '''
+process CPU: {:5.2f} cores average, {:5.2f} peak
+'''.format(xx.cpu_util.mean(), xx.cpu_util.max())
+
+    return out
+
+
+def gen_memory_report(xx):
+    """ Memory part of the stats report, empty string for results without memory data
+    """
+    if getattr(xx, 'peak_rss', None) is None:
+        return ''
+
+    out = '''
+memory    : {:7.1f} MiB peak RSS ({:.1f} MiB at start)
+'''.format(xx.peak_rss/(1 << 20), xx.rss[0]/(1 << 20))
+
+    if xx.peak_gdal_cache is not None:
+        cachemax = (getattr(xx.params, 'gdal_opts', None) or {}).get('GDAL_CACHEMAX')
+        out += '''            {:7.1f} MiB peak GDAL block cache{}
+'''.format(xx.peak_gdal_cache/(1 << 20), '' if cachemax is None else ' (GDAL_CACHEMAX={})'.format(cachemax))
+
+    return out
+
+
+def format_cache(params):
+    """ Tile cache of a run: cold, warm, as-is (on-disk cache used without
+    clearing or priming), memory, '-' for runs without a tile cache
+    """
+    if getattr(params, 'mem_cache_size', None):
+        return 'memory'
+    if not getattr(params, 'tile_cache', None):
+        return '-'
+    return getattr(params, 'cache_pass', None) or 'as-is'
+
+
+def gen_cache_report(xx):
+    """ Tile cache part of the stats report, empty string for runs without a tile cache
+    """
+    tc = getattr(xx, 'tile_cache', None)
+    if tc is None:
+        return ''
+
+    nlookup = tc.hits + tc.misses
+    kind = format_cache(xx.params)
+    out = '''
+tile cache: {}, {:,d} hits {:,d} misses ({:.1f}% hit rate), {:,d} evictions
+            {:.1f} MiB remote reads saved, {:.1f} MiB written
+            {:.1f} MiB in cache of {:.1f} MiB budget
+'''.format('in memory' if kind == 'memory' else kind + ' pass',
+           tc.hits, tc.misses, 100*tc.hits/max(nlookup, 1), tc.evictions,
+           tc.bytes_saved/(1 << 20), tc.bytes_written/(1 << 20),
+           tc.nbytes/(1 << 20), tc.max_bytes/(1 << 20))
+
+    if getattr(tc, 'waits', None) is not None:
+        out += '''            {:,d} hits waited for a concurrent read of the same tile
+'''.format(tc.waits)
+
+    return out
+
+
+def gen_ceiling_report(xx):
+    """ Tile throughput as a fraction of network ceilings measured by `netcheck`,
+    empty string for runs without them
+
+    Every tile not served from a tile cache needs at least one request, and
+    header plus tile bytes, so these are lower bounds on what the run asked of
+    the network.
+    """
+    nc = getattr(xx, 'netcheck', None)
+    if nc is None:
+        return ''
+
+    cached = getattr(xx, 'cached', None)
+    remote = xx.chunk_size if cached is None else xx.chunk_size[~cached]
+    header_size = getattr(xx.params, 'bytes_at_open', None) or 16*1024
+    rps = remote.shape[0]/xx.duration
+    mbps = (remote.sum() + header_size*remote.shape[0])/xx.duration/1e6
+
+    return '''
+ceilings  : {:.1f} requests per second, {:.1f} MB/s with {:d} threads (netcheck)
+            {:.1f}% of request rate: {:.1f} tiles per second
+            {:.1f}% of bandwidth   : {:.1f} MB/s including headers
+'''.format(nc.rps, nc.mbps, nc.params['nthreads'],
+           100*rps/nc.rps, rps,
+           100*mbps/nc.mbps, mbps)
 
 
 class StatsResult(object):
@@ -158,7 +475,8 @@ def load_dir(dirname='.', filter='*__*.pickle', ms=True):
             x.file = fname
             return StatsResult(**x.__dict__)
 
-    files = [f for f in glob.glob(dirname + '/' + filter) if not f.startswith('WRM')]
+    # skip warmup runs in results of older versions
+    files = [f for f in glob.glob(dirname + '/' + filter) if not os.path.basename(f).startswith('WRM')]
 
     data_all = sorted([load(f) for f in files], key=lambda s: s.nthreads)
     data_all = dict((k, list(v)) for k, v in itertools.groupby(data_all,
@@ -166,6 +484,195 @@ def load_dir(dirname='.', filter='*__*.pickle', ms=True):
     return data_all
 
 
+def load_curve(data):
+    """ Latency vs offered load table for open loop runs
+
+    data: output of `load_dir`
+
+    Returns list of SimpleNamespace(nthreads, rate, achieved, p50, p90, p99),
+    latencies in the units of `data`, sorted by thread count then rate.
+    Repeated runs with the same settings are pooled.
+    """
+    groups = {}
+    for runs in data.values():
+        for s in runs:
+            rate = getattr(s.params, 'rate', None)
+            if rate is None or s.latency is None:
+                continue
+            groups.setdefault((s.nthreads, rate), []).append(s)
+
+    curve = []
+    for (nthreads, rate), runs in sorted(groups.items()):
+        latency = np.concatenate([s.latency for s in runs])
+        p50, p90, p99 = _percentiles(latency)
+        achieved = sum(s.chunk_size.shape[0] for s in runs)/sum(s.duration for s in runs)
+        curve.append(SimpleNamespace(nthreads=nthreads, rate=rate, achieved=achieved,
+                                     p50=p50, p90=p90, p99=p99))
+    return curve
+
+
+def gen_load_curve_report(curve):
+    lines = ['threads   offered  achieved      p50      p90      p99 (ms)']
+    for c in curve:
+        lines.append('{:7d} {:9.1f} {:9.1f} {:8.1f} {:8.1f} {:8.1f}'.format(
+            c.nthreads, c.rate, c.achieved, c.p50, c.p90, c.p99))
+    return '\n'.join(lines)
+
+
+def _gdal_opts(s):
+    return getattr(s.params, 'gdal_opts', None) or {}
+
+
+def varying_gdal_opts(data):
+    """ GDAL config keys that take more than one value across all results
+    """
+    runs = [s for rr in data.values() for s in rr]
+    keys = set(k for s in runs for k in _gdal_opts(s))
+    return sorted(k for k in keys
+                  if len(set(str(_gdal_opts(s).get(k, '-')) for s in runs)) > 1)
+
+
+def best_config_per_thread(data, keys=None):
+    """ Highest average throughput configuration for every thread count
+
+    data: output of `load_dir`
+    keys: GDAL config keys that define a configuration, default is keys
+          that vary across results
+
+    Returns number_of_threads -> SimpleNamespace(config, throughput, nruns, nconfigs)
+    """
+    if keys is None:
+        keys = varying_gdal_opts(data)
+
+    out = {}
+    for nthreads, runs in sorted(data.items()):
+        groups = {}
+        for s in runs:
+            cfg = tuple((k, str(_gdal_opts(s).get(k, '-'))) for k in keys)
+            groups.setdefault(cfg, []).append(s.throughput)
+
+        cfg, fps = max(groups.items(), key=lambda kv: np.mean(kv[1]))
+        out[nthreads] = SimpleNamespace(config=dict(cfg),
+                                        throughput=np.mean(fps),
+                                        nruns=len(fps),
+                                        nconfigs=len(groups))
+    return out
+
+
+def gen_best_config_report(best):
+    keys = sorted(set(k for b in best.values() for k in b.config))
+    lines = ['threads     fps  configs  best configuration']
+    for nthreads, b in sorted(best.items()):
+        cfg = ' '.join('{}={}'.format(k, b.config[k]) for k in keys) or '(defaults)'
+        lines.append('{:7d} {:7.1f} {:8d}  {}'.format(nthreads, b.throughput, b.nconfigs, cfg))
+    return '\n'.join(lines)
+
+
+def order_comparison(data):
+    """ Throughput and tail latency for every thread count and url order
+
+    data: output of `load_dir`
+
+    Returns list of SimpleNamespace(nthreads, order, nruns, throughput, p50, p99),
+    latencies in the units of `data`, sorted by thread count then order.
+    """
+    rows = []
+    for nthreads, runs in sorted(data.items()):
+        groups = {}
+        for s in runs:
+            groups.setdefault(format_order(s.params), []).append(s)
+
+        for order, rr in sorted(groups.items()):
+            p50, p99 = _percentiles(np.concatenate([s.t_total for s in rr]), (50, 99))
+            rows.append(SimpleNamespace(nthreads=nthreads,
+                                        order=order,
+                                        nruns=len(rr),
+                                        throughput=np.mean([s.throughput for s in rr]),
+                                        p50=p50,
+                                        p99=p99))
+    return rows
+
+
+def cache_comparison(data):
+    """ Throughput and tail latency for every thread count and tile cache pass
+
+    data: output of `load_dir`
+
+    Returns list of SimpleNamespace(nthreads, cache, nruns, throughput, hit_rate, p50, p99),
+    latencies in the units of `data`, sorted by thread count then cache pass.
+    """
+    rows = []
+    for nthreads, runs in sorted(data.items()):
+        groups = {}
+        for s in runs:
+            groups.setdefault(format_cache(s.params), []).append(s)
+
+        for cache, rr in sorted(groups.items()):
+            p50, p99 = _percentiles(np.concatenate([s.t_total for s in rr]), (50, 99))
+            ntiles = sum(s.cached.shape[0] for s in rr)
+            rows.append(SimpleNamespace(nthreads=nthreads,
+                                        cache=cache,
+                                        nruns=len(rr),
+                                        throughput=np.mean([s.throughput for s in rr]),
+                                        hit_rate=sum(s.cached.sum() for s in rr)/max(ntiles, 1),
+                                        p50=p50,
+                                        p99=p99))
+    return rows
+
+
+def gen_cache_comparison_report(rows):
+    lines = ['threads     fps   hit%      p50      p99 (ms)  runs  cache']
+    for r in rows:
+        lines.append('{:7d} {:7.1f} {:6.1f} {:8.1f} {:8.1f} {:9d}  {}'.format(
+            r.nthreads, r.throughput, 100*r.hit_rate, r.p50, r.p99, r.nruns, r.cache))
+    return '\n'.join(lines)
+
+
+def affinity_comparison(data):
+    """ Throughput, its spread across runs and tail latency for every thread
+    count and worker placement policy
+
+    data: output of `load_dir`
+
+    Returns list of SimpleNamespace(nthreads, affinity, nruns, throughput, throughput_std, p50, p99),
+    latencies in the units of `data`, sorted by thread count then policy.
+    """
+    rows = []
+    for nthreads, runs in sorted(data.items()):
+        groups = {}
+        for s in runs:
+            groups.setdefault(format_affinity(s.params), []).append(s)
+
+        for affinity, rr in sorted(groups.items()):
+            fps = [s.throughput for s in rr]
+            p50, p99 = _percentiles(np.concatenate([s.t_total for s in rr]), (50, 99))
+            rows.append(SimpleNamespace(nthreads=nthreads,
+                                        affinity=affinity,
+                                        nruns=len(rr),
+                                        throughput=np.mean(fps),
+                                        throughput_std=np.std(fps),
+                                        p50=p50,
+                                        p99=p99))
+    return rows
+
+
+def gen_affinity_report(rows):
+    lines = ['threads     fps   std  cv%      p50      p99 (ms)  runs  affinity']
+    for r in rows:
+        lines.append('{:7d} {:7.1f} {:5.1f} {:4.1f} {:8.1f} {:8.1f} {:5d}  {}'.format(
+            r.nthreads, r.throughput, r.throughput_std, 100*r.throughput_std/max(r.throughput, 1e-9),
+            r.p50, r.p99, r.nruns, r.affinity))
+    return '\n'.join(lines)
+
+
+def gen_order_report(rows):
+    lines = ['threads     fps      p50      p99 (ms)  runs  order']
+    for r in rows:
+        lines.append('{:7d} {:7.1f} {:8.1f} {:8.1f} {:9d}  {}'.format(
+            r.nthreads, r.throughput, r.p50, r.p99, r.nruns, r.order))
+    return '\n'.join(lines)
+
+
 def pick_best(d, mode='time'):
     """ Returns a dictionary
 
@@ -141,7 +141,18 @@ def get_boto3_session(region_name=None, cache=None):
     return session
 
 
-def s3_get_object_request_maker(region_name=None, credentials=None, ssl=True):
+def s3_get_object_request_maker(region_name=None, credentials=None, ssl=True,
+                                endpoint_url=None,
+                                unsigned=False):
+    """ Returns function that builds signed GET `Request` for an S3 object
+
+    endpoint_url -- use this instead of AWS, e.g. "http://localhost:9000",
+                    path style addressing is used: <endpoint_url>/<bucket>/<key>
+    unsigned     -- do not sign requests (public buckets, local endpoints)
+
+    Requests are signed with current credentials, temporary credentials (role,
+    instance profile) are refreshed by botocore as they approach expiry.
+    """
     from botocore.session import get_session
     from botocore.auth import S3SigV4Auth
     from botocore.awsrequest import AWSRequest
@@ -152,11 +163,18 @@ def s3_get_object_request_maker(region_name=None, credentials=None, ssl=True):
     if region_name is None:
         region_name = auto_find_region()
 
-    if credentials is None:
-        credentials = session.get_credentials().get_frozen_credentials()
+    if credentials is None and not unsigned:
+        credentials = session.get_credentials()
 
     protocol = 'https' if ssl else 'http'
-    auth = S3SigV4Auth(credentials, 's3', region_name)
+    if endpoint_url is None:
+        endpoint_url = '{}://s3.{}.amazonaws.com'.format(protocol, region_name)
+    endpoint_url = endpoint_url.rstrip('/')
+
+    def current_credentials():
+        if hasattr(credentials, 'get_frozen_credentials'):
+            return credentials.get_frozen_credentials()  # refreshes when needed
+        return credentials
 
     def build_request(bucket=None,
                       key=None,
@@ -179,10 +197,11 @@ def s3_get_object_request_maker(region_name=None, credentials=None, ssl=True):
             headers['Range'] = Range
 
         req = AWSRequest(method='GET',
-                         url='{}://s3.{}.amazonaws.com/{}/{}'.format(protocol, region_name, bucket, key),
+                         url='{}/{}/{}'.format(endpoint_url, bucket, key),
                          headers=headers)
 
-        auth.add_auth(req)
+        if not unsigned:
+            S3SigV4Auth(current_credentials(), 's3', region_name).add_auth(req)
 
         return Request(req.url,
                        headers=dict(**req.headers),
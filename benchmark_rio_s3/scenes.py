@@ -0,0 +1,114 @@
+""" Multi-band scenes: one file per band, many bands read together
+
+Landsat on AWS stores every band of a scene in a separate file
+(`..._B1.TIF` .. `..._B11.TIF`). A service answering "give me this block of
+that scene" needs all the bands, so the latency that matters is that of the
+slowest band.
+"""
+import re
+from collections import Counter
+import numpy as np
+
+__all__ = ['group_by_scene', 'scene_latency']
+
+_BAND_RE = re.compile(r'^(?P<scene>.+)_B(?P<band>\d+[A-Za-z]?)\.tiff?$', re.IGNORECASE)
+
+
+def _band_key(band):
+    m = re.match(r'(\d+)(.*)', band)
+    return (int(m.group(1)), m.group(2)) if m else (0, band)
+
+
+def group_by_scene(urls, bands=None):
+    """ Group per-band urls into scenes
+
+    bands -- None| list of band names to use ('1', '8', '10', ...), default is
+             the most common set of bands, scenes with fewer bands are skipped
+
+    Returns (scenes, bands, skipped)
+
+    scenes  -- [(scene_id, [url for every band])...], in the order scenes
+               first appear in the input
+    bands   -- band names, in the same order as urls within a scene
+    skipped -- urls not used: not matching `<scene>_B<band>.TIF` or from scenes
+               missing some of the bands
+    """
+    groups = {}
+    skipped = []
+    for url in urls:
+        m = _BAND_RE.match(url)
+        if m is None:
+            skipped.append(url)
+            continue
+        band = m.group('band').upper().lstrip('0') or '0'
+        groups.setdefault(m.group('scene'), {})[band] = url
+
+    if bands is None:
+        common = Counter(frozenset(bb) for bb in groups.values()).most_common(1)
+        bands = sorted(common[0][0] if common else [], key=_band_key)
+    else:
+        bands = [str(b).upper().lstrip('0') or '0' for b in bands]
+
+    scenes = []
+    for scene, bb in groups.items():
+        if all(b in bb for b in bands):
+            scenes.append((scene, [bb[b] for b in bands]))
+            skipped.extend(u for b, u in bb.items() if b not in bands)
+        else:
+            skipped.extend(bb.values())
+
+    return scenes, bands, skipped
+
+
+def scene_latency(stats, nbands):
+    """ Per-scene latency from per-tile stats stored scene by scene
+
+    Scene starts when the first of its bands was scheduled (open loop) or
+    started and completes when the last band is done.
+
+    Returns (latency, n_failed) -- latency in seconds for scenes where all
+    bands were read, number of scenes with at least one failed band
+    """
+    latency = []
+    n_failed = 0
+    for i in range(0, len(stats), nbands):
+        ss = stats[i:i + nbands]
+        if any(s is None for s in ss):
+            n_failed += 1
+            continue
+        t_start = min(s.t_sched if getattr(s, 't_sched', None) is not None else s.t0 for s in ss)
+        t_end = max(s.t0 + s.t_total for s in ss)
+        latency.append(t_end - t_start)
+
+    return np.r_[latency], n_failed
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_group_by_scene():
+    urls = ['s3://b/LC08_A/LC08_A_B{}.TIF'.format(b) for b in (1, 2, 10)]
+    urls += ['s3://b/LC08_B/LC08_B_B{}.TIF'.format(b) for b in (10, 2, 1, 11)]
+    urls += ['s3://b/LC08_C/LC08_C_B1.TIF', 's3://b/LC08_C/LC08_C_BQA.TIF']
+
+    scenes, bands, skipped = group_by_scene(urls)
+    assert bands == ['1', '2', '10']
+    assert [s for s, _ in scenes] == ['s3://b/LC08_A/LC08_A', 's3://b/LC08_B/LC08_B']
+    assert scenes[1][1] == ['s3://b/LC08_B/LC08_B_B{}.TIF'.format(b) for b in (1, 2, 10)]
+    assert sorted(skipped) == sorted(['s3://b/LC08_B/LC08_B_B11.TIF',
+                                      's3://b/LC08_C/LC08_C_B1.TIF',
+                                      's3://b/LC08_C/LC08_C_BQA.TIF'])
+
+    scenes, bands, _ = group_by_scene(urls, bands=[1, 11])
+    assert bands == ['1', '11']
+    assert len(scenes) == 1
+
+
+def test_scene_latency():
+    from types import SimpleNamespace as S
+    stats = [S(t0=0, t_total=1), S(t0=0.5, t_total=1),
+             S(t0=2, t_total=1), None]
+    latency, n_failed = scene_latency(stats, 2)
+    assert latency.tolist() == [1.5]
+    assert n_failed == 1
@@ -0,0 +1,437 @@
+""" Planning, book-keeping and running of benchmark suites
+
+Suite state lives in `manifest.json` inside the output directory: every
+planned `run-one` invocation with its arguments and status. This allows an
+interrupted suite to be resumed, skipping runs that have completed.
+
+Every run is launched as a new `run-one` process, see `bench-rio-s3 run`.
+"""
+import glob
+import itertools
+import json
+import os
+import pickle
+import sys
+from datetime import datetime
+from pathlib import Path
+
+MANIFEST = 'manifest.json'
+DEFAULT_THREADS = (1, 2, 4, 8, 16, 20, 24, 28, 32, 38)
+
+
+def spread_order(values):
+    """ Reorder values so that any prefix covers the whole range
+
+    [1, 2, 4, 8, 16, 32] -> [1, 32, 4, 2, 8, 16]
+
+    First and last go first, then mid-points of the gaps, recursively.
+    """
+    values = list(values)
+    n = len(values)
+    if n <= 2:
+        return values
+
+    order = [0, n - 1]
+    gaps = [(0, n - 1)]
+    while gaps:
+        lo, hi = gaps.pop(0)
+        mid = (lo + hi)//2
+        if mid in (lo, hi):
+            continue
+        order.append(mid)
+        gaps += [(lo, mid), (mid, hi)]
+
+    return [values[i] for i in order]
+
+
+def plan_runs(configs, threads, rates=None, times=1):
+    """ Order in which to launch runs
+
+    Repetitions are the outer loop and thread counts are spread across the
+    range, so a suite that stops part way still covers all thread counts.
+
+    Returns a list of dicts with keys: id, rep, config, nthreads, rate
+    """
+    runs = []
+    for rep in range(times):
+        for config in configs:
+            for nthreads in spread_order(threads):
+                for rate in (rates or [None]):
+                    runs.append(dict(id='r{:04d}'.format(len(runs)),
+                                     rep=rep,
+                                     config=[list(kv) for kv in config],
+                                     nthreads=nthreads,
+                                     rate=rate))
+    return runs
+
+
+def save_manifest(manifest, dirname='.'):
+    """ Write manifest atomically, so a kill at any point leaves a valid file
+    """
+    fname = os.path.join(dirname, MANIFEST)
+    tmp = fname + '.tmp'
+    with open(tmp, 'wt') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, fname)
+
+
+def load_manifest(dirname='.'):
+    with open(os.path.join(dirname, MANIFEST), 'rt') as f:
+        return json.load(f)
+
+
+def new_manifest(url_file, finfo, block, warmup, runs, **extra):
+    """ warmup -- None| dict of bucket warmup settings
+    """
+    return dict(created=datetime.now().isoformat(),
+                url_file=url_file,
+                finfo={k: list(v) if isinstance(v, tuple) else v for k, v in finfo.items()},
+                block=list(block),
+                warmup=None if warmup is None else dict(warmup, status='planned'),
+                runs=[dict(status='planned', result=None, **r) for r in runs],
+                **extra)
+
+
+def find_completed(dirname='.'):
+    """ run_id -> result file, for result pickles that have run_id recorded
+    """
+    done = {}
+    for fname in glob.glob(os.path.join(dirname, '*.pickle')):
+        try:
+            with open(fname, 'rb') as f:
+                xx = pickle.load(f)
+        except Exception:
+            continue  # partially written file
+        run_id = getattr(getattr(xx, 'params', None), 'run_id', None)
+        if run_id is not None:
+            done[run_id] = os.path.basename(fname)
+    return done
+
+
+def reconcile(manifest, dirname='.'):
+    """ Mark runs as done if their results are on disk, anything else that
+    is not done is reset to planned.
+
+    Returns number of runs left to do
+    """
+    done = find_completed(dirname)
+    left = 0
+    for r in manifest['runs']:
+        if r['id'] in done:
+            r['status'] = 'done'
+            r['result'] = done[r['id']]
+        elif r['status'] != 'done':
+            r['status'] = 'planned'
+            left += 1
+    return left
+
+
+def setup_output_dir(urls):
+    """ Create output directory named after current time, change into it and
+    save `urls.txt` there
+    """
+    def find_first_available_dir(base):
+        if not Path(base).exists():
+            return Path(base)
+        for i in range(1, 100):
+            p = Path(base + '-{:02d}'.format(i))
+            if not p.exists():
+                return p
+        return None
+
+    out_dir = find_first_available_dir(''.join(datetime.now().isoformat().split(':')[:2]))
+
+    if out_dir is None or out_dir.exists():
+        raise ValueError('Output directory: {} already exists'.format(out_dir))
+
+    out_dir.mkdir()
+    out_dir = out_dir.resolve()
+
+    os.chdir(str(out_dir))
+
+    with open('urls.txt', 'wt') as f:
+        f.write('\n'.join(urls) + '\n')
+
+    return out_dir
+
+
+def run_one_args(finfo, block, nthreads, opts, prefix=None, rate=None, config=(), run_id=None):
+    """ Command line of `run-one` for one run of the suite
+
+    opts   -- suite settings, fields are named after options of `run`
+    config -- [(key, value)...], GDAL options and settings varied by the suite
+    """
+    from .netcheck import NETCHECK_FILE
+
+    args = ['--dtype={}'.format(finfo['dtype']),
+            '--block-shape={}x{}'.format(*finfo['block_shape']),
+            '--block={},{}'.format(*block),
+            '--{}warmup-more'.format('' if opts.warmup_more else 'no-'),
+            '--threads={}'.format(nthreads),
+            'urls.txt']
+    if prefix is not None:
+        args.insert(-1, '--prefix={}'.format(prefix))
+    for k, v in config:
+        if k == 'header_size':
+            args.insert(-1, '--header-size={}'.format(v))
+        elif k == 'cache_pass':
+            args.insert(-1, '--tile-cache={}'.format(os.path.abspath(opts.tile_cache)))
+            args.insert(-1, '--tile-cache-size={}'.format(opts.tile_cache_size))
+            args.insert(-1, '--cache-pass={}'.format(v))
+        elif k == 'affinity':
+            args.insert(-1, '--affinity={}'.format(v))
+        elif k == 'mem_cache':
+            if v:
+                args.insert(-1, '--mem-cache={}'.format(v))
+        elif k == 'order':
+            args.insert(-1, '--order={}'.format(v))
+            if v == 'shuffle':
+                args.insert(-1, '--order-seed={}'.format(opts.order_seed))
+            if v == 'size':
+                args.insert(-1, '--sizes={}'.format(os.path.abspath(opts.sizes_file)))
+        else:
+            args.insert(-1, '--gdal-opt={}={}'.format(k, v))
+    if opts.aws_unsigned:
+        args.insert(-1, '--aws-unsigned')
+    if opts.profile:
+        args.insert(-1, '--profile')
+    if opts.retries > 0:
+        args.insert(-1, '--retries={}'.format(opts.retries))
+    if rate is not None:
+        args.insert(-1, '--rate={:g}'.format(rate))
+        args.insert(-1, '--arrival={}'.format(opts.arrival))
+        if opts.max_inflight is not None:
+            args.insert(-1, '--max-inflight={}'.format(opts.max_inflight))
+    if opts.mode != 'rio':
+        args.insert(-1, '--mode={}'.format(opts.mode))
+    if opts.endpoint_url is not None:
+        args.insert(-1, '--endpoint-url={}'.format(opts.endpoint_url))
+    if opts.scenes:
+        args.insert(-1, '--scenes')
+        if opts.bands:
+            args.insert(-1, '--bands={}'.format(opts.bands))
+    if opts.overview_level is not None:
+        args.insert(-1, '--overview-level={}'.format(opts.overview_level))
+    if opts.out_shape is not None:
+        args.insert(-1, '--out-shape={}x{}'.format(opts.out_shape[1], opts.out_shape[0]))
+    if opts.netcheck:
+        args.insert(-1, '--netcheck={}'.format(NETCHECK_FILE))
+    if run_id is not None:
+        args.insert(-1, '--run-id={}'.format(run_id))
+    return args
+
+
+def plan_suite(url_file, opts, threads=DEFAULT_THREADS, block=None, times=1, log=print):
+    """ Plan runs for every combination of varied settings, create output
+    directory with `urls.txt` and the manifest, and change into it.
+
+    opts  -- suite settings, fields are named after options of `run`
+    block -- None| block to read, default is the center block
+
+    Returns manifest
+    """
+    from .bench import slurp_lines, fetch_file_info, format_file_info, endpoint_gdal_opts
+
+    urls = slurp_lines(url_file)
+    log('Fetching info for {}'.format(urls[0]))
+    env = endpoint_gdal_opts(opts.endpoint_url) if opts.endpoint_url else {}
+    if opts.aws_unsigned:
+        env['AWS_NO_SIGN_REQUEST'] = 'YES'
+    finfo = fetch_file_info(urls[0], gdal_opts=env, overview_level=opts.overview_level)
+    log(format_file_info(finfo))
+
+    if block is None:
+        block = tuple(n//2 for n in finfo['shape_in_blocks'])
+
+    if opts.netcheck and not all(u.startswith(('s3://', 'http://', 'https://')) for u in urls):
+        raise ValueError('Network check needs s3:// or http(s):// urls')
+
+    orders = opts.orders if opts.orders and opts.orders != ('as-is',) else ()
+    grid = [[('header_size', v) for v in opts.header_size]] if opts.header_size else []
+    grid += [[(k, v) for v in vv] for k, vv in opts.gdal_opts]
+    if orders:
+        grid += [[('order', v) for v in orders]]
+    passes = ()
+    if opts.tile_cache:
+        passes = [('cache_pass', v) for v in ('cold', 'warm')]
+    elif opts.mem_cache:
+        passes = [('mem_cache', v) for v in (0, opts.mem_cache)]
+    if passes:
+        grid += [passes]
+    affinities = opts.affinities if opts.affinities and opts.affinities != ('none',) else ()
+    if affinities:
+        grid += [[('affinity', v) for v in affinities]]
+    configs = list(itertools.product(*grid))
+
+    runs = plan_runs(configs, threads, rates=opts.rates, times=times)
+    for r in runs:
+        r['args'] = run_one_args(finfo, block, r['nthreads'], opts, prefix='RIO',
+                                 rate=r['rate'], config=r['config'], run_id=r['id'])
+
+    warmup = None
+    if not opts.skip_bucket_warmup:
+        warmup = dict(nthreads=opts.warmup_threads,
+                      ttl=opts.warmup_ttl,
+                      state_file=os.path.abspath(opts.warmup_state),
+                      endpoint_url=opts.endpoint_url,
+                      aws_unsigned=opts.aws_unsigned)
+
+    nconfigs = len(configs)
+    for vv in (orders, passes, affinities):
+        nconfigs //= max(len(vv), 1)
+
+    setup_output_dir(urls)
+    manifest = new_manifest(url_file, finfo, block, warmup, runs,
+                            open_loop=bool(opts.rates),
+                            nconfigs=nconfigs,
+                            norders=len(orders),
+                            ncache_passes=len(passes),
+                            naffinity=len(affinities),
+                            netcheck=dict(status='planned',
+                                          nthreads=max(threads),
+                                          aws_unsigned=opts.aws_unsigned,
+                                          endpoint_url=opts.endpoint_url) if opts.netcheck else None)
+    save_manifest(manifest)
+    return manifest
+
+
+def resume_suite(out_dir, log=print):
+    """ Change into output directory of an interrupted suite and load its manifest
+    """
+    out_dir = Path(out_dir).resolve()
+    os.chdir(str(out_dir))
+    try:
+        manifest = load_manifest()
+    except FileNotFoundError:
+        raise ValueError('No {} in {}, can not resume'.format(MANIFEST, out_dir))
+    n_left = reconcile(manifest)
+    save_manifest(manifest)
+    log('Resuming {}: {} of {} runs left'.format(out_dir.name, n_left, len(manifest['runs'])))
+    return manifest
+
+
+def run_planned(run, manifest, extra_args=()):
+    """ Launch `run-one` for a planned run in a new process, record outcome in
+    the manifest
+
+    Raises RuntimeError when the run fails
+    """
+    from subprocess import check_call, CalledProcessError
+
+    before = set(glob.glob('*.pickle'))
+    run['status'] = 'running'
+    run['started'] = datetime.now().isoformat()
+    save_manifest(manifest)
+    try:
+        check_call([sys.executable, sys.argv[0], 'run-one', *extra_args, *run['args']])
+    except CalledProcessError:
+        run['status'] = 'failed'
+        save_manifest(manifest)
+        raise RuntimeError('Run {} failed, to continue use:\n   bench-rio-s3 run --resume {}'.format(
+            run.get('id', 'warmup'), os.getcwd()))
+    new_files = sorted(set(glob.glob('*.pickle')) - before)
+    run['status'] = 'done'
+    run['finished'] = datetime.now().isoformat()
+    run['result'] = new_files[-1] if new_files else None
+    save_manifest(manifest)
+
+
+def run_suite(manifest, live=False, metrics_port=None, log=print):
+    """ Bucket warmup, network check and every run not done yet, in the
+    current directory, followed by comparison reports
+
+    live, metrics_port -- monitoring options passed on to every run
+    """
+    from .bench import slurp_lines, endpoint_gdal_opts
+    from .warmup import run_warmup, format_warmup
+
+    warmup = manifest['warmup']
+    if warmup is not None and warmup['status'] != 'done':
+        log('Warming up bucket with {} threads'.format(warmup['nthreads']))
+        gdal_opts = endpoint_gdal_opts(warmup['endpoint_url']) if warmup['endpoint_url'] else None
+        ww = run_warmup(slurp_lines('urls.txt'), manifest['block'],
+                        nthreads=warmup['nthreads'],
+                        ttl=warmup['ttl'],
+                        state_file=warmup['state_file'],
+                        aws_unsigned=warmup['aws_unsigned'],
+                        gdal_opts=gdal_opts)
+        warmup['status'] = 'done'
+        warmup['result'] = ww.__dict__
+        save_manifest(manifest)
+        log(format_warmup(ww))
+
+    nc = manifest.get('netcheck')
+    if nc is not None and nc['status'] != 'done':
+        from .netcheck import NETCHECK_FILE, run_netcheck, save_netcheck, gen_netcheck_report
+        log('Measuring network ceilings with {} threads'.format(nc['nthreads']))
+        rr = run_netcheck(slurp_lines('urls.txt'), nthreads=nc['nthreads'],
+                          aws_unsigned=nc['aws_unsigned'], endpoint_url=nc['endpoint_url'], log=log)
+        save_netcheck(rr, NETCHECK_FILE)
+        nc['status'] = 'done'
+        save_manifest(manifest)
+        log(gen_netcheck_report(rr))
+
+    monitoring = ['--live'] if live else []
+    if metrics_port is not None:
+        monitoring.append('--metrics-port={}'.format(metrics_port))
+
+    for run in manifest['runs']:
+        if run['status'] == 'done':
+            continue
+        log('Running {} with args: "{}"'.format(run['id'], ' '.join(run['args'])))
+        run_planned(run, manifest, extra_args=monitoring)
+
+    if manifest['open_loop']:
+        from .reports import load_dir, load_curve, gen_load_curve_report
+        log(gen_load_curve_report(load_curve(load_dir('.'))))
+
+    if manifest['nconfigs'] > 1:
+        from .reports import load_dir, best_config_per_thread, gen_best_config_report
+        log(gen_best_config_report(best_config_per_thread(load_dir('.'))))
+
+    if manifest.get('norders', 0) > 1:
+        from .reports import load_dir, order_comparison, gen_order_report
+        log(gen_order_report(order_comparison(load_dir('.'))))
+
+    if manifest.get('ncache_passes', 0) > 1:
+        from .reports import load_dir, cache_comparison, gen_cache_comparison_report
+        log(gen_cache_comparison_report(cache_comparison(load_dir('.'))))
+
+    if manifest.get('naffinity', 0) > 1:
+        from .reports import load_dir, affinity_comparison, gen_affinity_report
+        log(gen_affinity_report(affinity_comparison(load_dir('.'))))
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_spread_order():
+    assert spread_order([]) == []
+    assert spread_order([3]) == [3]
+    assert spread_order([1, 2, 4, 8, 16, 32]) == [1, 32, 4, 2, 8, 16]
+
+    tt = [1, 2, 4, 8, 16, 20, 24, 28, 32, 38]
+    oo = spread_order(tt)
+    assert sorted(oo) == tt
+    assert oo[:3] == [1, 38, 16]
+
+
+def test_plan_runs():
+    runs = plan_runs([()], [1, 2, 4], times=2)
+    assert [r['nthreads'] for r in runs] == [1, 4, 2]*2
+    assert [r['rep'] for r in runs] == [0, 0, 0, 1, 1, 1]
+    assert len(set(r['id'] for r in runs)) == len(runs)
+
+
+def test_manifest(tmpdir):
+    dirname = str(tmpdir)
+    mm = new_manifest('urls.txt', dict(dtype='uint16', block_shape=(512, 512)), (7, 7), None,
+                      plan_runs([()], [1, 2], times=1))
+    mm['runs'][0]['status'] = 'running'
+    save_manifest(mm, dirname)
+
+    mm = load_manifest(dirname)
+    assert mm['finfo']['block_shape'] == [512, 512]
+    assert reconcile(mm, dirname) == 2
+    assert all(r['status'] == 'planned' for r in mm['runs'])
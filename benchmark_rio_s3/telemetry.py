@@ -0,0 +1,260 @@
+""" Live view of a running benchmark
+
+Workers report progress into `Telemetry`, a background thread turns that into
+a status line once a second, and optionally the same numbers are served in
+Prometheus text format, so runs can be lined up with infrastructure
+dashboards.
+
+```
+[  12.0s] 1,234/10,000 tiles   98.1/s  queue 64  open 8 read 4 backoff 0  errors 0 (0.0%) retries 0  rss 312.4MiB
+```
+"""
+import sys
+import threading
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler
+from timeit import default_timer as t_now
+from types import SimpleNamespace
+
+from .httpserve import run_server
+from .monitor import rss_bytes
+
+__all__ = ['Telemetry']
+
+STAGES = ('open', 'read', 'backoff')
+
+
+class Telemetry(object):
+    """Thread-safe progress counters with a periodic console line
+
+    ```
+    with Telemetry(total=len(urls), queue_depth=rdr.queue_depth) as tm:
+        with tm.serve(port=9100):  # optional /metrics endpoint
+            rdr.read_blocks(urls, block, dst, telemetry=tm)
+    ```
+
+    Worker threads call `stage(name)` when they move between stages of a read
+    (None -- idle), `tile_done(nbytes)` on success and `error(kind, final)` on
+    every failed attempt. `on_blocked` can be given to `ParallelReader.process`
+    to count how often adding work had to wait for a full queue, status line
+    shows "(blocked)" if that happened since the last update.
+
+    total       -- number of tiles expected, only used for display
+    queue_depth -- None| () -> int
+    window      -- seconds to average throughput and error rate over
+    out         -- where to print status line, None -- don't print
+    """
+    def __init__(self, total=None, queue_depth=None, interval=1.0, window=5, out=sys.stderr):
+        self._total = total
+        self._queue_depth = queue_depth
+        self._interval = interval
+        self._out = out
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._done = 0
+        self._nbytes = 0
+        self._errors = Counter()
+        self._retries = 0
+        self._blocked = 0
+        self._history = deque(maxlen=max(2, int(window/interval) + 1))
+        self._stop = threading.Event()
+        self._thread = None
+        self._t0 = t_now()
+
+    def stage(self, name):
+        self._stages[threading.get_ident()] = name
+
+    def tile_done(self, nbytes=0):
+        with self._lock:
+            self._done += 1
+            self._nbytes += nbytes
+
+    def error(self, kind, final=True):
+        with self._lock:
+            if final:
+                self._errors[kind] += 1
+            else:
+                self._retries += 1
+
+    def on_blocked(self, state):
+        with self._lock:
+            self._blocked += 1
+
+    def snapshot(self):
+        with self._lock:
+            done, nbytes = self._done, self._nbytes
+            errors, retries, blocked = dict(self._errors), self._retries, self._blocked
+            history = list(self._history)
+
+        t = t_now()
+        nerr = sum(errors.values())
+        throughput, error_rate = 0.0, 0.0
+        if history:
+            t_, done_, nerr_, _ = history[0]
+            if t > t_:
+                throughput = (done - done_)/(t - t_)
+            nfinished = (done - done_) + (nerr - nerr_)
+            if nfinished > 0:
+                error_rate = (nerr - nerr_)/nfinished
+
+        inflight = Counter(s for s in list(self._stages.values()) if s is not None)
+
+        return SimpleNamespace(t=t - self._t0,
+                               done=done,
+                               total=self._total,
+                               nbytes=nbytes,
+                               throughput=throughput,
+                               queue=self._queue_depth() if self._queue_depth else None,
+                               pump_blocked=bool(history) and blocked > history[-1][3],
+                               blocked=blocked,
+                               inflight={s: inflight.get(s, 0) for s in STAGES},
+                               errors=errors,
+                               retries=retries,
+                               error_rate=error_rate,
+                               rss=rss_bytes())
+
+    def _tick(self):
+        ss = self.snapshot()
+        if self._out is not None:
+            print(format_status(ss), file=self._out, flush=True)
+        with self._lock:
+            self._history.append((t_now(), ss.done, sum(ss.errors.values()), ss.blocked))
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self._tick()
+
+    def start(self):
+        self._t0 = t_now()
+        self._stop.clear()
+        self._history.clear()
+        self._history.append((self._t0, self._done, sum(self._errors.values()), self._blocked))
+        self._thread = threading.Thread(target=self._run, name='telemetry', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def serve(self, host='127.0.0.1', port=9100):
+        """ Serve `/metrics` in Prometheus text format, use as a context manager
+        """
+        tm = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = format_prometheus(tm.snapshot()).encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return run_server(Handler, host=host, port=port)
+
+
+def format_status(ss):
+    if ss.total:
+        done = '{:,d}/{:,d}'.format(ss.done, ss.total)
+    else:
+        done = '{:,d}'.format(ss.done)
+
+    if ss.queue is None:
+        queue = '-'
+    else:
+        queue = '{:d}{}'.format(ss.queue, ' (blocked)' if ss.pump_blocked else '')
+
+    nerr = sum(ss.errors.values())
+    return ('[{:6.1f}s] {} tiles {:6.1f}/s  queue {}  {}  errors {:d} ({:.1f}%) retries {:d}'
+            '  rss {:.1f}MiB').format(ss.t, done, ss.throughput, queue,
+                                      ' '.join('{} {:d}'.format(s, n) for s, n in ss.inflight.items()),
+                                      nerr, ss.error_rate*100, ss.retries,
+                                      (ss.rss or 0)/(1 << 20))
+
+
+def format_prometheus(ss, prefix='bench_rio_s3'):
+    lines = []
+
+    def add(name, kind, help, values):
+        name = prefix + '_' + name
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, v in values:
+            lbl = ','.join('{}="{}"'.format(lk, lv) for lk, lv in labels)
+            lines.append('{}{} {}'.format(name, '{' + lbl + '}' if lbl else '', repr(float(v))))
+
+    add('tiles_completed_total', 'counter', 'Tiles read successfully', [((), ss.done)])
+    if ss.total is not None:
+        add('tiles_planned', 'gauge', 'Tiles to read in this run', [((), ss.total)])
+    add('bytes_total', 'counter', 'Compressed tile bytes read', [((), ss.nbytes)])
+    add('throughput_tiles_per_second', 'gauge', 'Rolling average throughput', [((), ss.throughput)])
+    if ss.queue is not None:
+        add('queue_depth', 'gauge', 'Urls waiting in the work queue', [((), ss.queue)])
+    add('queue_blocked_total', 'counter', 'Times the work queue was full when adding more work',
+        [((), ss.blocked)])
+    add('inflight', 'gauge', 'Worker threads per stage of a read',
+        [((('stage', s),), n) for s, n in ss.inflight.items()])
+    add('errors_total', 'counter', 'Reads that failed after all retries',
+        [((('kind', k),), n) for k, n in sorted(ss.errors.items())] or [((), 0)])
+    add('retries_total', 'counter', 'Failed attempts that were retried', [((), ss.retries)])
+    add('error_rate', 'gauge', 'Rolling fraction of reads that failed', [((), ss.error_rate)])
+    if ss.rss is not None:
+        add('resident_memory_bytes', 'gauge', 'Resident set size of the process', [((), ss.rss)])
+
+    return '\n'.join(lines) + '\n'
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_telemetry():
+    import requests
+    qq = [3]
+    tm = Telemetry(total=10, queue_depth=lambda: qq[0], interval=0.01, out=None)
+
+    def worker(n):
+        for _ in range(n):
+            tm.stage('open')
+            tm.stage('read')
+            tm.tile_done(100)
+        tm.error('throttled', final=False)
+        tm.error('not_found')
+        tm.stage(None)
+
+    with tm:
+        tt = [threading.Thread(target=worker, args=(3,)) for _ in range(3)]
+        for t in tt:
+            t.start()
+        for t in tt:
+            t.join()
+        tm.on_blocked(None)
+
+        with tm.serve(port=0) as url:
+            txt = requests.get(url + '/metrics').text
+
+    ss = tm.snapshot()
+    assert ss.done == 9
+    assert ss.nbytes == 900
+    assert ss.errors == {'not_found': 3}
+    assert ss.retries == 3
+    assert ss.queue == 3
+    assert ss.inflight == dict(open=0, read=0, backoff=0)
+    assert '9/10 tiles' in format_status(ss)
+
+    assert 'bench_rio_s3_tiles_completed_total 9.0' in txt
+    assert 'bench_rio_s3_errors_total{kind="not_found"} 3.0' in txt
+    assert 'bench_rio_s3_inflight{stage="open"} 0.0' in txt
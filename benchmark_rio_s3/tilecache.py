@@ -0,0 +1,431 @@
+""" Caches of decoded tiles
+
+Two caches with the same interface (`key`, `get`, `put`, `discard`, `stats`),
+tiles are keyed by (url, etag, band, block):
+
+- `DiskTileCache` -- directory shared by threads and processes, survives restarts
+- `MemoryTileCache` -- process-wide LRU shared by worker threads
+
+In `DiskTileCache` tiles are stored one per file. A file is a small JSON header
+padded to `HEADER_SIZE` bytes followed by raw pixels, so cached tiles are read
+back by memory-mapping them. Several threads and processes can share one
+directory:
+
+- tiles are written to a temporary file and renamed into place
+- a hit updates modification time of the file, eviction removes least
+  recently used files first until the directory is below the byte budget
+- only one process evicts at a time (`flock` on a lock file), others skip
+
+Etag is there so that a changed object is not served from the cache. For
+local files it defaults to modification time and size, for remote objects
+it is None unless supplied, i.e. those are assumed to never change.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from types import SimpleNamespace
+import numpy as np
+
+__all__ = ['DiskTileCache', 'MemoryTileCache', 'default_etag', 'load_etags']
+
+HEADER_SIZE = 128
+SUFFIX = '.tile'
+LOW_WATERMARK = 0.9  # evict down to this fraction of the budget
+
+
+def default_etag(url):
+    """ Modification time and size for local files, None for remote urls
+    """
+    if '://' in url:
+        return None
+    try:
+        st = os.stat(url)
+    except OSError:
+        return None
+    return '{:d}-{:d}'.format(st.st_mtime_ns, st.st_size)
+
+
+def load_etags(fname):
+    """ Load url -> etag, one url and etag per line, separated by white space or a comma
+    """
+    etags = {}
+    with open(fname, 'rt') as f:
+        for line in f:
+            tokens = line.replace(',', ' ').split()
+            if len(tokens) == 2:
+                etags[tokens[0]] = tokens[1].strip('"')
+    return etags
+
+
+class DiskTileCache(object):
+    """Directory backed tile store with a byte budget and LRU eviction
+
+    ```
+    cache = DiskTileCache('/tmp/tiles', max_bytes=1 << 30)
+    key = cache.key(url, band, block)
+    pix = cache.get(key)
+    if pix is None:
+        pix = read_tile(url, band, block)
+        cache.put(key, pix, nbytes_remote=compressed_size)
+    ```
+    """
+    def __init__(self, path, max_bytes=1 << 30, etags=None):
+        """
+        path      -- directory, created if missing
+        max_bytes -- byte budget for all tiles in the directory
+        etags     -- None| url -> etag, urls not in there use `default_etag`
+        """
+        self.path = os.path.abspath(path)
+        self.max_bytes = int(max_bytes)
+        self._etags = etags or {}
+        self._lock = threading.Lock()
+        self._counts = dict(hits=0, misses=0, puts=0, evictions=0, bytes_saved=0, bytes_written=0)
+        os.makedirs(self.path, exist_ok=True)
+        self._nbytes = sum(size for _, _, size in self._scan())
+
+    def key(self, url, band, block, etag=None):
+        """ Cache key for a tile, block is anything with a stable repr, e.g. (row, col)
+        """
+        if etag is None:
+            etag = self._etags.get(url) or default_etag(url)
+        return hashlib.sha1(repr((url, etag, band, tuple(block))).encode('utf8')).hexdigest()
+
+    def _fname(self, key):
+        return os.path.join(self.path, key[:2], key + SUFFIX)
+
+    def get(self, key):
+        """ Read-only memory-mapped tile, None on a miss
+        """
+        fname = self._fname(key)
+        try:
+            with open(fname, 'rb') as f:
+                hdr = json.loads(f.read(HEADER_SIZE).decode('utf8'))
+            pix = np.memmap(fname, dtype=hdr['dtype'], mode='r', offset=HEADER_SIZE, shape=tuple(hdr['shape']))
+            os.utime(fname)
+        except (OSError, ValueError):
+            # missing, evicted by another process since, or partially written by an older version
+            with self._lock:
+                self._counts['misses'] += 1
+            return None
+
+        with self._lock:
+            self._counts['hits'] += 1
+            self._counts['bytes_saved'] += hdr.get('nbytes_remote', 0)
+        return pix
+
+    def put(self, key, pix, nbytes_remote=0):
+        """ Store tile, nbytes_remote -- bytes fetched to produce it, reported as saved on hits
+        """
+        pix = np.ascontiguousarray(pix)
+        hdr = json.dumps(dict(dtype=pix.dtype.str, shape=pix.shape, nbytes_remote=int(nbytes_remote)))
+        hdr = hdr.encode('utf8').ljust(HEADER_SIZE)
+        if len(hdr) > HEADER_SIZE:
+            raise ValueError('Tile header does not fit in {} bytes'.format(HEADER_SIZE))
+
+        fname = self._fname(key)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmp = '{}.{:d}.{:d}.tmp'.format(fname, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(hdr)
+            f.write(pix.tobytes())
+        try:
+            # concurrent misses on the same tile all write it, only count it once
+            replaced = os.stat(fname).st_size
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp, fname)
+
+        size = HEADER_SIZE + pix.nbytes
+        with self._lock:
+            self._counts['puts'] += 1
+            self._counts['bytes_written'] += size
+            self._nbytes += size - replaced
+            over = self._nbytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def discard(self, key):
+        """ Reading the tile after a miss failed, nothing to do here as concurrent misses are not deduplicated
+        """
+
+    def _scan(self):
+        """ (mtime, fname, size) for every tile in the cache
+        """
+        for d in os.scandir(self.path):
+            if not d.is_dir():
+                continue
+            for e in os.scandir(d.path):
+                if e.name.endswith(SUFFIX):
+                    try:
+                        st = e.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield st.st_mtime, e.path, st.st_size
+
+    def evict(self, target=None):
+        """ Remove least recently used tiles until total size is below target,
+        default is `LOW_WATERMARK` of the budget. Returns number of tiles removed,
+        None if another process is evicting already.
+        """
+        import fcntl
+
+        if target is None:
+            target = int(self.max_bytes*LOW_WATERMARK)
+
+        with open(os.path.join(self.path, '.lock'), 'wb') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+
+            tiles = sorted(self._scan())
+            total = sum(size for _, _, size in tiles)
+            n = 0
+            for _, fname, size in tiles:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(fname)
+                    n += 1
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+        with self._lock:
+            self._counts['evictions'] += n
+            self._nbytes = total
+        return n
+
+    def clear(self):
+        """ Remove every tile, counters are kept
+        """
+        self.evict(target=0)
+
+    @property
+    def nbytes(self):
+        """ Approximate size of all tiles, includes tiles added by this process since the last scan only
+        """
+        return self._nbytes
+
+    def stats(self):
+        """ SimpleNamespace(hits, misses, puts, evictions, bytes_saved, bytes_written), counts for this instance
+        """
+        with self._lock:
+            return SimpleNamespace(**self._counts)
+
+
+class MemoryTileCache(object):
+    """Process-wide LRU of decoded tiles with a byte budget
+
+    Shared by all worker threads of a reader. Concurrent misses on the same key
+    are deduplicated (single flight): the first thread to miss gets None and
+    has to either `put` the tile or `discard` the key if reading it failed,
+    other threads asking for the key meanwhile wait for that and count as hits.
+
+    ```
+    pix = cache.get(key)
+    if pix is None:
+        try:
+            pix = read_tile(url, band, block)
+        except Exception:
+            cache.discard(key)
+            raise
+        cache.put(key, pix)
+    ```
+    """
+    def __init__(self, max_bytes=256 << 20, etags=None):
+        """
+        max_bytes -- byte budget for pixels of all tiles
+        etags     -- None| url -> etag, urls not in there use `default_etag`
+        """
+        self.path = None
+        self.max_bytes = int(max_bytes)
+        self._etags = etags or {}
+        self._tiles = OrderedDict()  # key -> (pix, nbytes_remote), least recently used first
+        self._loading = {}  # key -> Event, set once the tile is put or discarded
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._counts = dict(hits=0, misses=0, waits=0, puts=0, evictions=0, bytes_saved=0, bytes_written=0)
+
+    def key(self, url, band, block, etag=None):
+        """ Cache key for a tile, block is anything hashable, e.g. (row, col)
+        """
+        if etag is None:
+            etag = self._etags.get(url) or default_etag(url)
+        return (url, etag, band, tuple(block))
+
+    def get(self, key):
+        """ Read-only tile, or None on a miss, in which case caller is
+        responsible for `put` or `discard` of the key. Blocks while another
+        thread is reading the same tile.
+        """
+        waited = False
+        while True:
+            with self._lock:
+                hit = self._tiles.get(key)
+                if hit is not None:
+                    self._tiles.move_to_end(key)
+                    self._counts['hits'] += 1
+                    self._counts['waits'] += waited
+                    self._counts['bytes_saved'] += hit[1]
+                    return hit[0]
+
+                loading = self._loading.get(key)
+                if loading is None:
+                    self._loading[key] = threading.Event()
+                    self._counts['misses'] += 1
+                    return None
+
+            # tile is being read by another thread, if that fails, or the
+            # tile does not fit, one of the waiting threads reads it instead
+            loading.wait()
+            waited = True
+
+    def put(self, key, pix, nbytes_remote=0):
+        """ Store a copy of the tile and wake up threads waiting for it,
+        nbytes_remote -- bytes fetched to produce it, reported as saved on hits
+        """
+        pix = np.array(pix)
+        pix.flags.writeable = False
+
+        with self._lock:
+            old = self._tiles.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[0].nbytes
+            if pix.nbytes <= self.max_bytes:
+                self._tiles[key] = (pix, int(nbytes_remote))
+                self._nbytes += pix.nbytes
+                self._counts['puts'] += 1
+                self._counts['bytes_written'] += pix.nbytes
+                while self._nbytes > self.max_bytes:
+                    _, (evicted, _) = self._tiles.popitem(last=False)
+                    self._nbytes -= evicted.nbytes
+                    self._counts['evictions'] += 1
+            loading = self._loading.pop(key, None)
+
+        if loading is not None:
+            loading.set()
+
+    def discard(self, key):
+        """ Reading the tile after a miss failed, wake up threads waiting for it
+        """
+        with self._lock:
+            loading = self._loading.pop(key, None)
+        if loading is not None:
+            loading.set()
+
+    def clear(self):
+        """ Remove every tile, counters are kept
+        """
+        with self._lock:
+            self._tiles.clear()
+            self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        """ Size of pixels of all tiles
+        """
+        return self._nbytes
+
+    def stats(self):
+        """ SimpleNamespace(hits, misses, waits, puts, evictions, bytes_saved, bytes_written),
+        waits are hits that had to wait for another thread to read the tile
+        """
+        with self._lock:
+            return SimpleNamespace(**self._counts)
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_disk_tile_cache(tmpdir):
+    import time
+
+    cache = DiskTileCache(str(tmpdir/'tiles'), max_bytes=3*(HEADER_SIZE + 64*64*2))
+    tiles = [np.full((64, 64), i, dtype='uint16') for i in range(5)]
+    keys = [cache.key('s3://bucket/im{}.tif'.format(i), 1, (7, 7)) for i in range(5)]
+
+    assert cache.key('s3://bucket/im0.tif', 1, (7, 7)) == keys[0]
+    assert cache.key('s3://bucket/im0.tif', 1, (7, 7), etag='new') != keys[0]
+    assert cache.get(keys[0]) is None
+
+    for k, pix in zip(keys[:3], tiles):
+        cache.put(k, pix, nbytes_remote=1000)
+        time.sleep(0.01)  # distinct modification times
+    pix = cache.get(keys[0])
+    assert isinstance(pix, np.memmap) and (pix == 0).all() and pix.dtype == np.uint16
+
+    cache.put(keys[3], tiles[3])  # over budget, evicts least recently used: keys[1]
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[3]) is not None
+
+    st = cache.stats()
+    assert (st.hits, st.misses, st.puts, st.evictions, st.bytes_saved) == (3, 2, 4, 2, 2000)
+
+    # another instance, as in another process, sees the same tiles
+    other = DiskTileCache(str(tmpdir/'tiles'))
+    assert other.nbytes == cache.nbytes
+    assert (other.get(keys[3]) == 3).all()
+
+    cache.clear()
+    assert other.get(keys[3]) is None
+    assert cache.nbytes == 0
+
+
+def test_etags(tmpdir):
+    fname = str(tmpdir/'etags.txt')
+    with open(fname, 'wt') as f:
+        f.write('s3://b/a.tif "abc"\ns3://b/b.tif,def\nbad line here\n')
+    assert load_etags(fname) == {'s3://b/a.tif': 'abc', 's3://b/b.tif': 'def'}
+
+    assert default_etag('s3://b/a.tif') is None
+    assert default_etag(fname) is not None
+    assert default_etag(str(tmpdir/'missing.tif')) is None
+
+
+def test_memory_tile_cache():
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache = MemoryTileCache(max_bytes=2*64*64*2)
+    keys = [cache.key('s3://bucket/im{}.tif'.format(i), 1, (7, 7)) for i in range(3)]
+    assert cache.key('s3://bucket/im0.tif', 1, (7, 7)) == keys[0]
+
+    # single flight: 8 threads miss on the same tile, only one reads it
+    nreads = []
+
+    def read(key):
+        pix = cache.get(key)
+        if pix is None:
+            nreads.append(key)
+            time.sleep(0.05)
+            pix = np.full((64, 64), 1, dtype='uint16')
+            cache.put(key, pix, nbytes_remote=100)
+        return pix
+
+    with ThreadPoolExecutor(8) as pool:
+        out = list(pool.map(read, [keys[0]]*8))
+    assert len(nreads) == 1
+    assert all((pix == 1).all() for pix in out)
+    st = cache.stats()
+    assert (st.hits, st.misses, st.waits, st.bytes_saved) == (7, 1, 7, 700)
+
+    # failed read: next thread asking gets to read it
+    assert cache.get(keys[1]) is None
+    cache.discard(keys[1])
+    assert cache.get(keys[1]) is None
+    cache.put(keys[1], np.zeros((64, 64), dtype='uint16'))
+
+    # LRU: keys[0] used more recently than keys[1]
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[2]) is None
+    cache.put(keys[2], np.zeros((64, 64), dtype='uint16'))
+    assert cache.stats().evictions == 1
+    assert cache.nbytes == 2*64*64*2
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    cache.discard(keys[1])
@@ -0,0 +1,184 @@
+""" Bucket warmup
+
+Objects that have not been read for a while are slower to fetch from S3, so
+before a suite every url is read once. Warmed urls are remembered with a
+timestamp in a small state file shared between suites, running suites back to
+back on the same list then only touches urls that are cold or were warmed
+longer than `ttl` seconds ago.
+"""
+import json
+import os
+import threading
+import time
+from timeit import default_timer as t_now
+from types import SimpleNamespace
+
+from .pprio import ParallelReader
+
+__all__ = ['run_warmup', 'format_warmup']
+
+DEFAULT_STATE = os.path.join(os.path.expanduser('~'), '.cache', 'bench-rio-s3', 'warmup.json')
+DEFAULT_TTL = 3600
+
+
+def load_state(fname=DEFAULT_STATE):
+    """ url -> unix time it was last warmed, empty if there is no valid state file
+    """
+    try:
+        with open(fname, 'rt') as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def save_state(state, fname=DEFAULT_STATE):
+    """ Write state atomically, several suites might share it
+    """
+    dirname = os.path.dirname(fname)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    tmp = '{}.{:d}.tmp'.format(fname, os.getpid())
+    with open(tmp, 'wt') as f:
+        json.dump(state, f)
+    os.replace(tmp, fname)
+
+
+def select_cold(urls, state, ttl=DEFAULT_TTL, now=None):
+    """ Urls never warmed or warmed more than `ttl` seconds ago, duplicates removed
+    """
+    if now is None:
+        now = time.time()
+    cold = []
+    seen = set()
+    for url in urls:
+        if url in seen:
+            continue
+        seen.add(url)
+        t = state.get(url)
+        if t is None or now - t > ttl:
+            cold.append(url)
+    return cold
+
+
+def warm_urls(urls, block, nthreads=32, band=1, **kwargs):
+    """ Read one block from every url, pixels are discarded
+
+    kwargs are passed on to `ParallelReader`
+
+    Returns SimpleNamespace(warmed, failed, t_total) -- urls read successfully,
+    number of urls that failed after all retries, wall time in seconds
+    """
+    warmed = []
+    failed = [0]
+    lock = threading.Lock()
+
+    def on_file(f, url):
+        f.read(band, window=f.block_window(band, *block))
+        with lock:
+            warmed.append(url)
+
+    def on_error(url, _, err):
+        if err.delay is None:
+            with lock:
+                failed[0] += 1
+
+    rdr = ParallelReader(nthreads, **kwargs)
+    try:
+        rdr.warmup()
+
+        t0 = t_now()
+        rdr.process(((url, url) for url in urls), on_file, on_error=on_error)
+        t_total = t_now() - t0
+    finally:
+        rdr.shutdown()
+
+    return SimpleNamespace(warmed=warmed, failed=failed[0], t_total=t_total)
+
+
+def run_warmup(urls, block, nthreads=32, ttl=DEFAULT_TTL, state_file=DEFAULT_STATE, force=False, **kwargs):
+    """ Warm urls that are cold according to `state_file` and record them as warm
+
+    force -- ignore state, warm every url
+
+    Returns SimpleNamespace with: nurls, ncold, nwarmed, nfailed, nthreads, ttl,
+    t_total and throughput (files per second)
+    """
+    state = {} if force else load_state(state_file)
+    nurls = len(set(urls))
+    cold = select_cold(urls, state, ttl)
+
+    rr = SimpleNamespace(warmed=[], failed=0, t_total=0.0)
+    if cold:
+        rr = warm_urls(cold, block, nthreads=nthreads, **kwargs)
+
+        # re-read, another suite might have updated it in the meantime
+        state = load_state(state_file)
+        now = time.time()
+        state.update((url, now) for url in rr.warmed)
+        save_state(state, state_file)
+
+    return SimpleNamespace(nurls=nurls,
+                           ncold=len(cold),
+                           nwarmed=len(rr.warmed),
+                           nfailed=rr.failed,
+                           nthreads=nthreads,
+                           ttl=ttl,
+                           t_total=rr.t_total,
+                           throughput=len(rr.warmed)/rr.t_total if rr.t_total > 0 else 0.0)
+
+
+def format_warmup(ww):
+    if ww.ncold == 0:
+        return 'Warmup: all {:,d} urls warmed less than {:g}s ago, nothing to do'.format(ww.nurls, ww.ttl)
+
+    return ('Warmup: {:,d} of {:,d} urls were cold, read {:,d} ({:,d} failed) in {:.1f}s'
+            ' with {:d} threads, {:.1f} files per second').format(ww.ncold, ww.nurls, ww.nwarmed, ww.nfailed,
+                                                                  ww.t_total, ww.nthreads, ww.throughput)
+
+#######################################
+# unit tests below
+#######################################
+
+
+def test_select_cold(tmpdir):
+    fname = str(tmpdir/'state'/'warmup.json')
+    assert load_state(fname) == {}
+
+    save_state({'a': 100.0, 'b': 10.0}, fname)
+    state = load_state(fname)
+    assert select_cold(['a', 'b', 'c', 'c'], state, ttl=50, now=120) == ['b', 'c']
+    assert select_cold(['a', 'b'], state, ttl=200, now=120) == []
+
+    with open(fname, 'wt') as f:
+        f.write('{"a": 1')  # truncated file
+    assert load_state(fname) == {}
+
+
+def test_run_warmup(tmpdir):
+    import numpy as np
+    import rasterio
+
+    urls = []
+    for i in range(3):
+        fname = str(tmpdir/'im{}.tif'.format(i))
+        with rasterio.open(fname, 'w', driver='GTiff', width=64, height=64, count=1, dtype='uint8',
+                           tiled=True, blockxsize=32, blockysize=32) as f:
+            f.write(np.full((64, 64), i, dtype='uint8'), 1)
+        urls.append(fname)
+    urls.append(str(tmpdir/'missing.tif'))
+
+    state_file = str(tmpdir/'warmup.json')
+    nthreads = threading.active_count()
+    ww = run_warmup(urls, (1, 1), nthreads=2, state_file=state_file, region_name='us-west-2')
+    assert (ww.nurls, ww.ncold, ww.nwarmed, ww.nfailed) == (4, 4, 3, 1)
+    assert threading.active_count() == nthreads  # worker threads are stopped
+    assert sorted(load_state(state_file)) == sorted(urls[:3])
+
+    ww = run_warmup(urls, (1, 1), nthreads=2, state_file=state_file, region_name='us-west-2')
+    assert (ww.ncold, ww.nwarmed, ww.nfailed) == (1, 0, 1)
+    assert 'were cold' in format_warmup(ww)
+
+    ww = run_warmup(urls[:3], (1, 1), state_file=state_file)
+    assert ww.ncold == 0
+    assert 'nothing to do' in format_warmup(ww)